@@ -0,0 +1,177 @@
+'''
+
+This module contains the ApiMetrics class, which collects per-endpoint statistics of the requests sent by API_Requests.
+
+For every endpoint (the URL path with ids replaced by {id}, e.g. 'floor/{id}/info') it records the number of calls,
+a latency histogram, the number of response bytes, retries, cache hits, coalesced calls and the status codes. Recording
+a request only takes a lock and a few additions, so the metrics can be left on in production.
+
+All API_Requests objects share the module level `metrics` object unless they are given their own.
+
+Usage:
+    from api_metrics import metrics
+
+    ... # run ingestion, the converter, ...
+
+    print(metrics.report())
+    metrics.save('metrics.json')
+
+'''
+
+import re
+import json
+import time
+import bisect
+import threading
+
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def endpoint_name(url: str) -> str:
+    '''Turns a request URL into the name of its endpoint, e.g. '.../rest/v1/floor/930/info' -> 'floor/{id}/info'.'''
+    path = url.split('/rest/v1/', 1)[-1].split('?', 1)[0]
+    return re.sub(r'(?<=/)\d+(?=/|$)|^\d+(?=/|$)', '{id}', path)
+
+
+class EndpointStats:
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.status_codes = {}
+
+    def quantile(self, q: float) -> float:
+        '''Estimates a latency quantile from the histogram (upper bound of the bucket it falls into).'''
+        requests = sum(self.latency_buckets)
+        if requests == 0:
+            return 0.0
+
+        rank = q * requests
+        seen = 0
+        for i, count in enumerate(self.latency_buckets):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.latency_max
+
+        return self.latency_max
+
+    def to_dict(self) -> dict:
+        requests = sum(self.latency_buckets)
+
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'cache_hits': self.cache_hits,
+            'coalesced': self.coalesced,
+            'bytes': self.bytes,
+            'latency_mean': self.latency_total / requests if requests else 0.0,
+            'latency_p50': self.quantile(0.5),
+            'latency_p95': self.quantile(0.95),
+            'latency_max': self.latency_max,
+            'latency_histogram': {
+                **{f'le_{bound}': count for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)},
+                'le_inf': self.latency_buckets[-1],
+            },
+            'status_codes': {str(code): count for code, count in sorted(self.status_codes.items())},
+        }
+
+
+class ApiMetrics:
+
+    def __init__(self) -> None:
+        self.endpoints = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _stats(self, url: str) -> EndpointStats:
+        # Has to be called with the lock held
+        name = endpoint_name(url)
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointStats()
+
+        return self.endpoints[name]
+
+    def record(self, url: str, status_code: int, seconds: float, nbytes: int = 0, retries: int = 0) -> None:
+        '''Records one call that went to the API.
+
+        Args:
+            url (str): URL of the request.
+            status_code (int): Status code of the final response (0 if the request failed without a response).
+            seconds (float): Time from sending the first attempt until the body was read.
+            nbytes (int, optional): Size of the response body.
+            retries (int, optional): Number of attempts after the first one.
+        '''
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+
+        with self._lock:
+            stats = self._stats(url)
+            stats.calls += 1
+            stats.errors += status_code not in (200, 304)
+            stats.retries += retries
+            stats.bytes += nbytes
+            stats.latency_total += seconds
+            stats.latency_max = max(stats.latency_max, seconds)
+            stats.latency_buckets[bucket] += 1
+            stats.status_codes[status_code] = stats.status_codes.get(status_code, 0) + 1
+
+    def record_cache_hit(self, url: str) -> None:
+        '''Records one call that was answered from the response cache without contacting the API.'''
+        with self._lock:
+            stats = self._stats(url)
+            stats.calls += 1
+            stats.cache_hits += 1
+
+    def record_coalesced(self, url: str) -> None:
+        '''Records one call that shared the in-flight request of another caller.'''
+        with self._lock:
+            stats = self._stats(url)
+            stats.calls += 1
+            stats.coalesced += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.endpoints = {}
+            self.started = time.time()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'endpoints': {name: stats.to_dict() for name, stats in sorted(self.endpoints.items())},
+            }
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def report(self) -> str:
+        '''Returns a human readable summary table, one line per endpoint.'''
+        data = self.to_dict()
+
+        lines = [
+            f'{"endpoint":40} {"calls":>7} {"cached":>7} {"shared":>7} {"errors":>7} {"retries":>7} {"MB":>9} '
+            f'{"mean ms":>9} {"p95 ms":>9} {"total s":>9}'
+        ]
+        for name, stats in data['endpoints'].items():
+            requests = stats['calls'] - stats['cache_hits'] - stats['coalesced']
+            lines.append(
+                f'{name:40} {stats["calls"]:>7} {stats["cache_hits"]:>7} {stats["coalesced"]:>7} {stats["errors"]:>7} '
+                f'{stats["retries"]:>7} {stats["bytes"] / 1e6:>9.2f} {stats["latency_mean"] * 1e3:>9.1f} '
+                f'{stats["latency_p95"] * 1e3:>9.1f} {stats["latency_mean"] * requests:>9.2f}'
+            )
+
+        return '\n'.join(lines)
+
+
+metrics = ApiMetrics()
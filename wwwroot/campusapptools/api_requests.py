@@ -5,14 +5,187 @@ This module contains the API_Requests class which is used to make requests to th
 '''
 
 
+import os
+import time
+import codecs
+import threading
+import json
 import requests
 import warnings
 
+from response_cache import ResponseCache
+from api_metrics import ApiMetrics, metrics as default_metrics
 
-class API_Requests:
+
+DEFAULT_API_URL = "https://pim.pythagoras.se/imp_datamanager"
+
+# Status codes that are worth retrying, everything else is returned to the caller straight away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_env_cache = None
+
+
+def _default_cache() -> ResponseCache:
+    '''Returns the shared cache configured through the PYTHAGORAS_CACHE_DIR environment variable, if any.'''
+    global _env_cache
+
+    cache_dir = os.environ.get('PYTHAGORAS_CACHE_DIR')
+    if not cache_dir:
+        return None
+
+    if _env_cache is None or os.path.dirname(_env_cache.path) != os.path.abspath(cache_dir):
+        _env_cache = ResponseCache(os.path.abspath(cache_dir))
+
+    return _env_cache
+
+
+class _SingleFlight:
 
     def __init__(self) -> None:
-        self.api_url="https://pim.pythagoras.se/imp_datamanager"
+        '''Lets concurrent callers of the same request share one in-flight call and its result.
+
+        The first caller of a key (the leader) runs the call, every caller that arrives while it is running waits for
+        it and receives the same result (or exception). Once the call finished, the key is forgotten, so later callers
+        send a new request (or hit the response cache).
+        '''
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn):
+        '''Runs fn, unless a call for the same key is already in flight.
+
+        Returns:
+            tuple: The result of fn and whether it was shared from another caller's call.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = fn()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+        return call['result'], False
+
+
+# Shared by all API_Requests objects, as every module creates its own
+_single_flight = _SingleFlight()
+
+
+def _iter_json_array(chunks, encoding: str = 'utf-8'):
+    '''Incrementally decodes a streamed body whose content is a top-level JSON array.
+
+    Only the bytes of the record currently being decoded (plus one network chunk) are kept in memory, so the peak
+    memory does not grow with the size of the whole document.
+
+    Args:
+        chunks: Iterable of the bytes of the body, e.g. response.iter_content(chunk_size) of a streamed response.
+        encoding (str, optional): Encoding of the body.
+
+    Yields:
+        The elements of the array, one at a time.
+    '''
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(chunks)
+
+    buffer = ''
+    pos = 0
+    exhausted = False
+    started = False
+
+    def read_more() -> bool:
+        nonlocal buffer, pos, exhausted
+        if exhausted:
+            return False
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+        return True
+
+    while True:
+        # Skip whitespace and separators between records
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+
+        if pos == len(buffer):
+            if read_more(): continue
+            raise ValueError('Unexpected end of JSON stream')
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('Expected a JSON array, got {!r}'.format(buffer[pos]))
+            started = True
+            pos += 1
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if read_more(): continue
+            raise
+
+        # A record is only complete once its separator has arrived, as a number cut off by a chunk boundary (e.g.
+        # '1.' of '1.5') still decodes successfully
+        sep = end
+        while sep < len(buffer) and buffer[sep] in ' \t\r\n':
+            sep += 1
+
+        if sep == len(buffer) or buffer[sep] not in ',]':
+            if read_more(): continue
+            raise ValueError('Malformed JSON stream near {!r}'.format(buffer[pos:sep + 1][-40:]))
+
+        pos = end
+        yield record
+
+
+class API_Requests:
+
+    def __init__(self, cache: ResponseCache = None, api_url: str = None, metrics: ApiMetrics = None,
+                 max_retries: int = 2, backoff: float = 0.5, coalesce: bool = True) -> None:
+        '''
+        Args:
+            cache (ResponseCache, optional): Cache for responses. Defaults to the cache configured by the
+                PYTHAGORAS_CACHE_DIR environment variable (no caching if it is not set).
+            api_url (str, optional): Base URL of the API, e.g. of the local stand-in server. Defaults to the
+                PYTHAGORAS_API_URL environment variable, or the live Pythagoras API if it is not set.
+            metrics (ApiMetrics, optional): Where to record per-endpoint statistics. Defaults to the shared
+                api_metrics.metrics.
+            max_retries (int, optional): How often a request is retried on connection errors and 429/5xx responses.
+            backoff (float, optional): Delay before the first retry in seconds, doubled for every further retry.
+            coalesce (bool, optional): Let concurrent identical requests (same URL and parameters) from any thread of
+                this process share one in-flight request and its parsed result. The result is the same object for all
+                callers, so it must not be modified.
+        '''
+        self.cache = cache if cache is not None else _default_cache()
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.coalesce = coalesce
+        self.api_url = (api_url or os.environ.get('PYTHAGORAS_API_URL') or DEFAULT_API_URL).rstrip('/')
         self.headers = {
             'Accept': 'application/json',
             'Accept-Encoding': 'gzip, deflate, br',
@@ -22,13 +195,137 @@ class API_Requests:
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15'
         }
 
+    def _send(self, url: str, headers: dict, params: dict = None, stream: bool = False):
+        '''Sends a GET request, retrying on connection errors and retryable status codes.
+
+        Returns:
+            tuple: The response, the number of retries and the time the request was started.
+        '''
+        start = time.perf_counter()
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = requests.get(url, headers=headers, params=params, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    self.metrics.record(url, 0, time.perf_counter() - start, retries=attempt)
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response, attempt, start
+                response.close()
+
+            time.sleep(self.backoff * 2**attempt)
+
+    def _get(self, url: str, params: dict = None, warn_only: bool = False, updated: int = None):
+        '''Sends a GET request and returns the decoded JSON body.
+
+        Concurrent identical requests share one in-flight request (see the coalesce argument of the constructor).
+        Arguments are the same as for _fetch.
+        '''
+        if not self.coalesce:
+            return self._fetch(url, params, warn_only, updated)
+
+        # `updated` only decides whether a cached response may be served, not what the response is, so callers that
+        # pass it (the converter) and callers that do not (build_db.py) share one request
+        key = json.dumps([self.api_url, url, params, warn_only], sort_keys=True, default=str)
+        data, shared = _single_flight.do(key, lambda: self._fetch(url, params, warn_only, updated))
+        if shared:
+            self.metrics.record_coalesced(url)
+
+        return data
+
+    def _fetch(self, url: str, params: dict = None, warn_only: bool = False, updated: int = None):
+        '''Sends a GET request and returns the decoded JSON body, going through the response cache if there is one.
+
+        Fresh cache entries are returned without contacting the API. Stale entries are revalidated with the ETag and
+        Last-Modified validators of the previous response, so an unchanged resource only costs a 304 response.
+
+        Args:
+            url (str): URL of the endpoint.
+            params (dict, optional): Query string parameters.
+            warn_only (bool, optional): Warn and return None instead of failing on a non-200 status code.
+            updated (int, optional): `updated` timestamp of the requested record, if known. A cached response that was
+                stored for the same timestamp is served without contacting the API.
+
+        Returns:
+            The decoded JSON body of the response.
+        '''
+        headers = self.headers
+        key, entry = None, None
+
+        if self.cache is not None:
+            key = self.cache.key(url, params)
+            entry = self.cache.get(key)
+
+            if entry is not None:
+                if self.cache.is_fresh(entry, updated):
+                    self.metrics.record_cache_hit(url)
+                    return json.loads(entry['body'])
+
+                headers = dict(self.headers)
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+        response, retries, start = self._send(url, headers, params)
+        self.metrics.record(url, response.status_code, time.perf_counter() - start, len(response.content), retries)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.revalidated(key, updated)
+            return json.loads(entry['body'])
+
+        if warn_only and response.status_code != 200:
+            warnings.warn(f"Warning: Received status code {response.status_code}")
+            return None
+        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
+
+        data = response.json()
+
+        if self.cache is not None:
+            self.cache.put(key, url, response.content, etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'), updated=updated)
+
+        return data
+
+    def _stream(self, url: str, params: dict = None, warn_only: bool = False):
+        '''Sends a streaming GET request and yields the records of the returned JSON array as they arrive.
+
+        Args:
+            url (str): URL of the endpoint.
+            params (dict, optional): Query string parameters.
+            warn_only (bool, optional): Warn and yield nothing instead of failing on a non-200 status code.
+
+        Yields:
+            dict: One record of the response at a time.
+        '''
+        response, retries, start = self._send(url, self.headers, params, stream=True)
+        nbytes = 0
+
+        def chunks():
+            nonlocal nbytes
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                nbytes += len(chunk)
+                yield chunk
+
+        with response:
+            try:
+                if warn_only and response.status_code != 200:
+                    warnings.warn(f"Warning: Received status code {response.status_code}")
+                    return
+                assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
+
+                yield from _iter_json_array(chunks(), response.encoding or 'utf-8')
+            finally:
+                # Latency of a stream includes reading the body, as that is where the time goes for large responses
+                self.metrics.record(url, response.status_code, time.perf_counter() - start, nbytes, retries)
+
     def get_component(self) -> list:
         url = f'{self.api_url}/rest/v1/component'
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url)
 
         return data
 
@@ -46,9 +343,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
@@ -57,9 +352,7 @@ class API_Requests:
         url = f'{self.api_url}/rest/v1/building/{building_id}'
     
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url)
 
         return data
 
@@ -68,9 +361,7 @@ class API_Requests:
         url = f'{self.api_url}/rest/v1/building/{building_id}/info'
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url)
 
         return data
             
@@ -79,9 +370,7 @@ class API_Requests:
         url = f'{self.api_url}/rest/v1/building/info'
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url)
 
         return data
 
@@ -104,9 +393,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
@@ -135,14 +422,25 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
-    
-    def get_floor_id_workspace_info(self, floor_id: int) -> list:
+
+    def get_floor_id_workspace_info(self, floor_id: int, updated: int = None) -> list:
+        '''Get the info of all rooms of a floor, i.e. their outlines and attributes.
+
+        A non-200 status code only raises a warning (None is returned).
+
+        Args:
+            floor_id (int): The ID of the floor.
+            updated (int, optional): Latest `updated` timestamp of the rooms of the floor (e.g. from get_workspace).
+                If the cached response was stored for the same timestamp, it is used without contacting the API. The
+                timestamp of the floor itself does not change when only its rooms do, so it can not be used here.
+
+        Returns:
+            list: The info of every room of the floor.
+        '''
         url = f'{self.api_url}/rest/v1/floor/{floor_id}/workspace/info'
 
         # Define the query string parameters
@@ -156,16 +454,45 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        if response.status_code != 200:
-            warnings.warn(f"Warning: Received status code {response.status_code}")
-            return None
-
-        data = response.json()
+        data = self._get(url, params, warn_only=True, updated=updated)
 
         return data
 
 
+    def iter_floor_id_workspace_info(self, floor_id: int, updated: int = None):
+        '''Streaming variant of get_floor_id_workspace_info.
+
+        Like the non-streaming version, a non-200 status code only raises a warning (nothing is yielded). With a
+        response cache and a timestamp, the rooms are read through the cache instead of being streamed, as the whole
+        response has to be stored anyway.
+
+        Args:
+            floor_id (int): The ID of the floor.
+            updated (int, optional): Latest `updated` timestamp of the rooms of the floor, see
+                get_floor_id_workspace_info.
+
+        Yields:
+            dict: The info of one room at a time.
+        '''
+        url = f'{self.api_url}/rest/v1/floor/{floor_id}/workspace/info'
+
+        # Define the query string parameters
+        params = {
+            'includeAttributes': True,
+            'includePolygon': True,
+            'includeOutline': True,
+            'includeOutlineHoles': True,
+            'includeUtilityCoord': True,
+            'invertY': False,
+        }
+
+        if updated is not None and self.cache is not None:
+            yield from self._get(url, params, warn_only=True, updated=updated) or []
+            return
+
+        yield from self._stream(url, params, warn_only=True)
+
+
     def get_floor_id_component_all_info(self, floor_id: int) -> list:
         url = f'{self.api_url}/rest/v1/floor/{floor_id}/component/all/info'
 
@@ -175,9 +502,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
@@ -185,7 +510,17 @@ class API_Requests:
     def get_floor_id_info(self, floor_id: int, includeWallInfos: bool = True, includeWallDoorInfos: bool = True,
                           includeWallWindowInfos: bool = True, includeColumnInfos: bool = True,
                           includeColumnOutlines: bool = True, includeFloorComponentInfos: bool = True, 
-                          includeWorkspaceComponentInfos: bool = True) -> dict:
+                          includeWorkspaceComponentInfos: bool = True, updated: int = None) -> dict:
+        '''Get the info of a floor, i.e. its walls (with doors and windows), columns and components.
+
+        Args:
+            floor_id (int): The ID of the floor.
+            updated (int, optional): `updated` timestamp of the floor (e.g. from get_building_id_floor). If the cached
+                response was stored for the same timestamp, it is used without contacting the API.
+
+        Returns:
+            dict: The floor info.
+        '''
         url = f'{self.api_url}/rest/v1/floor/{floor_id}/info'
 
         # Define the query string parameters
@@ -201,9 +536,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params, updated=updated)
 
         return data
 
@@ -217,12 +550,10 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
-    
+
 
     def get_floor_info(self, ids: list) -> dict:
         url = f'{self.api_url}/rest/v1/floor/info'
@@ -235,9 +566,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
@@ -246,13 +575,22 @@ class API_Requests:
         url = f'{self.api_url}/rest/v1/workspace'
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url)
 
         return data
 
 
+    def iter_workspace(self):
+        '''Streaming variant of get_workspace, which lists every room of the campus.
+
+        Yields:
+            dict: One room at a time (without its outline).
+        '''
+        url = f'{self.api_url}/rest/v1/workspace'
+
+        yield from self._stream(url)
+
+
     def get_workspace_info(self) -> dict:
         url = f'{self.api_url}/rest/v1/workspace/info'
 
@@ -262,9 +600,7 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
 
@@ -278,8 +614,6 @@ class API_Requests:
         }
 
         # Send a GET request to the API
-        response = requests.get(url, headers=self.headers, params=params)
-        assert response.status_code == 200, "Error: Received status code {}".format(response.status_code)
-        data = response.json()
+        data = self._get(url, params)
 
         return data
\ No newline at end of file
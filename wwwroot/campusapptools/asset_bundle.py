@@ -0,0 +1,191 @@
+'''
+
+This module packs all assets of a building into one bundle file, so a client can load a building with one request
+(or a few ranged ones) instead of one request per floor and asset kind.
+
+Bundle layout (all integers little endian):
+
+    magic       4 bytes   b'CMAB'
+    version     uint32    BUNDLE_VERSION
+    index size  uint32    length of the index in bytes
+    index       JSON      {'building_id': ..., 'created': ..., 'entries': [...]}, padded with spaces to 8 bytes
+    assets      bytes     the glb files, each starting at a multiple of 8 bytes
+
+Every entry of the index has the path, floor_id, kind and lod of an asset (see converter.asset_info) and its offset
+(from the start of the file), length and sha256. Entries are sorted by level of detail, then floor, so the coarse
+assets of a building are one contiguous byte range: a client can read the first BUNDLE_PREFIX_SIZE + index size bytes
+and then fetch exactly the assets it needs with HTTP range requests.
+
+Bundles are stored at bundles/building_{id}.bundle, next to the assets they contain.
+
+Usage:
+    python asset_bundle.py --buildings BLACKETT HUXLEY --output-dir out/
+
+'''
+
+import json
+import time
+import struct
+import hashlib
+import argparse
+
+from api_requests import API_Requests
+from asset_manifest import AssetManifest
+from asset_sink import AssetSink, open_sink
+import converter
+
+
+BUNDLE_MAGIC = b'CMAB'
+BUNDLE_VERSION = 1
+BUNDLE_PREFIX = struct.Struct('<4sII')
+BUNDLE_PREFIX_SIZE = BUNDLE_PREFIX.size
+
+
+def bundle_path(building_id: int) -> str:
+    return f'bundles/building_{building_id}.bundle'
+
+
+def _align(n: int, alignment: int = 8) -> int:
+    return n + (-n % alignment)
+
+
+def pack_bundle(building_id: int, assets: dict) -> bytes:
+    '''Packs assets into a bundle.
+
+    Args:
+        building_id (int): ID of the building the assets belong to.
+        assets (dict): The glb files by their path in the container, e.g. {'model_floors/floor_930_floors.glb': b'...'}.
+
+    Returns:
+        bytes: The bundle.
+    '''
+    entries = []
+    for path in assets:
+        info = converter.asset_info(path)
+        entries.append(dict(info, path=path, length=len(assets[path]),
+                            sha256=hashlib.sha256(assets[path]).hexdigest()))
+    entries.sort(key=lambda entry: (entry['lod'], entry['floor_id'], entry['kind']))
+
+    def encode_index():
+        index = {'building_id': building_id, 'created': created, 'entries': entries}
+        return json.dumps(index, separators=(',', ':')).encode()
+
+    created = int(time.time())
+
+    # The offsets are part of the index, so its size is only known once they are filled in. The size is reserved with
+    # placeholders that are wider than any real offset, and the index is padded to it.
+    for entry in entries:
+        entry['offset'] = 10 ** 12
+    index_size = _align(BUNDLE_PREFIX_SIZE + len(encode_index())) - BUNDLE_PREFIX_SIZE
+
+    offset = BUNDLE_PREFIX_SIZE + index_size
+    for entry in entries:
+        entry['offset'] = offset
+        offset = _align(offset + entry['length'])
+
+    index = encode_index().ljust(index_size)
+
+    parts = [BUNDLE_PREFIX.pack(BUNDLE_MAGIC, BUNDLE_VERSION, index_size), index]
+    for entry in entries:
+        data = assets[entry['path']]
+        parts.append(data + b'\x00' * (_align(len(data)) - len(data)))
+
+    return b''.join(parts)
+
+
+def index_size(prefix: bytes) -> int:
+    '''Returns the size of the index from the first BUNDLE_PREFIX_SIZE bytes of a bundle.'''
+    magic, version, size = BUNDLE_PREFIX.unpack(prefix[:BUNDLE_PREFIX_SIZE])
+    if magic != BUNDLE_MAGIC:
+        raise ValueError('Not an asset bundle')
+    if version != BUNDLE_VERSION:
+        raise ValueError(f'Unsupported bundle version {version}')
+
+    return size
+
+
+def read_index(data: bytes) -> dict:
+    '''Reads the index of a bundle from its first BUNDLE_PREFIX_SIZE + index size bytes (or the whole bundle).'''
+    size = index_size(data)
+    return json.loads(data[BUNDLE_PREFIX_SIZE:BUNDLE_PREFIX_SIZE + size])
+
+
+def unpack_bundle(data: bytes, verify: bool = True) -> dict:
+    '''Returns the assets of a bundle by their path.
+
+    Args:
+        data (bytes): The bundle.
+        verify (bool, optional): Check the sha256 of every asset.
+    '''
+    assets = {}
+    for entry in read_index(data)['entries']:
+        asset = data[entry['offset']:entry['offset'] + entry['length']]
+        if verify and hashlib.sha256(asset).hexdigest() != entry['sha256']:
+            raise ValueError(f'Corrupt asset {entry["path"]} in bundle')
+        assets[entry['path']] = asset
+
+    return assets
+
+
+def building_assets(floor_ids: list, manifest: AssetManifest) -> list:
+    '''Returns the paths of the stored assets of the floors, according to the manifest.'''
+    floors = {str(floor_id) for floor_id in floor_ids}
+
+    return [path for floor_id, lods in manifest.lod_index().items() if floor_id in floors
+            for paths in lods.values() for path in paths]
+
+
+def bundle_building(building_id: int, floor_ids: list, sink: AssetSink, manifest: AssetManifest) -> int:
+    '''Packs the stored assets of a building into a bundle and stores it next to them.
+
+    Args:
+        building_id (int): ID of the building.
+        floor_ids (list): IDs of the floors of the building.
+        sink (AssetSink): Sink the assets were stored in. The bundle is stored there too.
+        manifest (AssetManifest): Manifest of the stored assets.
+
+    Returns:
+        int: Size of the bundle (0 if the building has no assets).
+    '''
+    paths = building_assets(floor_ids, manifest)
+    if len(paths) == 0:
+        return 0
+
+    bundle = pack_bundle(building_id, {path: sink.get(path) for path in paths})
+    sink.put(bundle_path(building_id), bundle).result()
+
+    return len(bundle)
+
+
+def bundle_buildings(building_ids: list, sink: AssetSink, manifest: AssetManifest, api: API_Requests = None) -> None:
+    '''Creates the bundle of every building, e.g. after converting them.'''
+    api = api or API_Requests()
+
+    for building_id in building_ids:
+        floor_ids = [floor['id'] for floor in api.get_building_id_floor(building_id)]
+        size = bundle_building(building_id, floor_ids, sink, manifest)
+        print(f'Bundle of building {building_id}: {size / 1e6:.2f} MB')
+
+
+def buildings_of_floors(floor_ids: list, api: API_Requests = None) -> list:
+    '''Returns the IDs of the buildings the floors belong to.'''
+    api = api or API_Requests()
+    floor_ids = set(floor_ids)
+
+    return [building['id'] for building in api.get_building()
+            if any(floor['id'] in floor_ids for floor in api.get_building_id_floor(building['id']))]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Packs the assets of buildings into one bundle per building.')
+    parser.add_argument('--buildings', nargs='*', default=converter.SOUTH_KEN_LIGHT, help='Names of the buildings')
+    parser.add_argument('--output-dir', help='Read assets from and write bundles into this directory')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    args = parser.parse_args()
+
+    api = API_Requests()
+    building_ids = [building['id'] for building in api.get_building() if building['name'] in args.buildings]
+
+    with open_sink(args.output_dir, args.connection_string) as sink:
+        bundle_buildings(building_ids, sink, AssetManifest.for_sink(sink), api)
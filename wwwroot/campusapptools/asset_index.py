@@ -0,0 +1,162 @@
+'''
+
+This module generates an index of the metadata of all assets (size, hash, bounds, triangles), so servers and clients
+can answer questions like "how big is floor X" without downloading or loading any glb file.
+
+The metadata is read with glb.GLBReader, which memory-maps every file and only parses its JSON chunk and the
+accessors it needs, so indexing the whole campus takes seconds. Files whose size and modification time are unchanged
+since the previous index are not read again.
+
+Every entry of the index (by path relative to the root, e.g. 'model_floors/floor_930_floors.glb') has:
+    floor_id, kind, lod    see converter.asset_info
+    size                   bytes
+    sha256                 of the file
+    triangles              triangles drawn (instanced meshes count once per instance)
+    bounds                 [[min x, min y, min z], [max x, max y, max z]] in the coordinates of the asset (z-up)
+    mtime                  modification time of the file when it was indexed
+
+Usage:
+    python asset_index.py                                  # indexes the model_* directories next to this file
+    python asset_index.py --root out/ --publish            # also stores the index in the container
+    python asset_index.py --floor 930                      # prints the entries of a floor from the index
+
+'''
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from glb import GLBReader
+from asset_sink import AssetSink, open_sink
+import converter
+
+
+ASSET_DIRS = ['model_floors', 'model_insides', 'model_outsides', 'model_shells']
+
+# Path of the index, relative to the root of the assets (locally and in the container)
+ASSET_INDEX_PATH = 'asset_index.json'
+
+DEFAULT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def index_entry(filename: str) -> dict:
+    '''Reads the metadata of a glb file (without its path dependent fields floor_id, kind and lod).'''
+    stat = os.stat(filename)
+
+    with GLBReader(filename) as glb:
+        # hashlib reads the mapped file directly, without copying it into a bytes object
+        sha256 = hashlib.sha256(glb.data).hexdigest()
+        bounds = glb.bounds()
+        triangles = glb.triangles()
+
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256,
+        'triangles': triangles,
+        'bounds': bounds.round(6).tolist() if bounds is not None else None,
+    }
+
+
+def build_asset_index(root: str = DEFAULT_ROOT, dirs: list = ASSET_DIRS, previous: dict = None,
+                      workers: int = 8) -> dict:
+    '''Indexes all glb files in the asset directories below a root.
+
+    Args:
+        root (str, optional): Directory containing the asset directories.
+        dirs (list, optional): Asset directories to index.
+        previous (dict, optional): An earlier index. Entries of files with unchanged size and modification time are
+            reused.
+        workers (int, optional): Number of files read concurrently (hashing releases the GIL).
+
+    Returns:
+        dict: The entry of every asset by its path relative to the root, sorted by path.
+    '''
+    previous = previous or {}
+
+    paths = []
+    for directory in dirs:
+        if not os.path.isdir(os.path.join(root, directory)):
+            continue
+        paths += [f'{directory}/{name}' for name in os.listdir(os.path.join(root, directory)) if name.endswith('.glb')]
+
+    def entry(path):
+        filename = os.path.join(root, path)
+        old = previous.get(path)
+        if old is not None:
+            stat = os.stat(filename)
+            if old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+                return old
+
+        try:
+            info = converter.asset_info(path)
+        except (ValueError, KeyError):
+            info = {} # Not named like an asset of the converter
+
+        return dict(info, **index_entry(filename))
+
+    with ThreadPoolExecutor(workers) as pool:
+        entries = dict(zip(paths, pool.map(entry, paths)))
+
+    return dict(sorted(entries.items()))
+
+
+def load_index(path: str) -> dict:
+    '''Loads an index saved by save_index (an empty index if the file does not exist).'''
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, 'r') as f:
+        return json.load(f)['assets']
+
+
+def save_index(index: dict, path: str) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'created': int(time.time()), 'assets': index}, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def floor_assets(index: dict, floor_id: int) -> dict:
+    '''Returns the entries of the assets of a floor.'''
+    return {path: entry for path, entry in index.items() if entry.get('floor_id') == floor_id}
+
+
+def publish_index(index: dict, sink: AssetSink) -> None:
+    '''Stores the index in the container, next to the assets.'''
+    data = json.dumps({'created': int(time.time()), 'assets': index}, separators=(',', ':')).encode()
+    sink.put(ASSET_INDEX_PATH, data).result()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Indexes size, hash, bounds and triangles of all assets.')
+    parser.add_argument('--root', default=DEFAULT_ROOT, help='Directory containing the model_* directories')
+    parser.add_argument('--out', help=f'Path of the index (default: {ASSET_INDEX_PATH} in the root)')
+    parser.add_argument('--full', action='store_true', help='Read every file, even if it is unchanged')
+    parser.add_argument('--floor', type=int, help='Print the entries of a floor from the index instead of indexing')
+    parser.add_argument('--publish', action='store_true', help='Also store the index in the blob storage container')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    args = parser.parse_args()
+
+    out = args.out or os.path.join(args.root, ASSET_INDEX_PATH)
+
+    if args.floor is not None:
+        print(json.dumps(floor_assets(load_index(out), args.floor), indent=4))
+
+    else:
+        start = time.time()
+        index = build_asset_index(args.root, previous=None if args.full else load_index(out))
+        save_index(index, out)
+        end = time.time()
+
+        print(f'{len(index)} assets, {sum(e["size"] for e in index.values()) / 1e6:.1f} MB, '
+              f'{sum(e["triangles"] for e in index.values())} triangles')
+        print(f"Time taken: {end - start} seconds")
+
+        if args.publish:
+            with open_sink(connection_string=args.connection_string) as sink:
+                publish_index(index, sink)
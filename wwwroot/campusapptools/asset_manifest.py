@@ -0,0 +1,203 @@
+'''
+
+This module contains the AssetManifest class, which lets the converter skip floors whose geometry has not changed.
+
+For every output asset (e.g. model_outsides/floor_930_outsides.glb) the manifest stores a hash of the normalized input
+geometry it was generated from: only the fields of walls, columns and room outlines that end up in the mesh are
+hashed, so changes to timestamps, names or attributes do not trigger a rebuild. If the hash of the current input
+matches the stored one, meshing and upload of that asset are skipped.
+
+CONVERTER_VERSION is part of every hash. Bump it whenever the meshing itself changes, so all assets are rebuilt.
+
+Every destination (an output directory or a blob container, see AssetSink.destination) has its own manifest file in
+MANIFEST_DIR: an asset that is current in one destination is not necessarily stored in another. Entries of assets a
+floor no longer has (or of removed floors) are pruned with remove_floor.
+
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+CONVERTER_VERSION = 2 # 2: walls and outlines are simplified before meshing
+
+MANIFEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manifests')
+
+
+def manifest_path(destination: str, directory: str = MANIFEST_DIR) -> str:
+    '''Returns the manifest file of a destination (see AssetSink.destination).'''
+    return os.path.join(directory, f'{hashlib.sha256(destination.encode()).hexdigest()[:16]}.json')
+
+
+def _round(value, digits: int = 6):
+    return round(value, digits) if isinstance(value, float) else value
+
+
+def _coords(data: dict) -> list:
+    return [[_round(v['x']), _round(v['y'])] for v in data['outline']['coords']]
+
+
+def normalize_wall(wall: dict) -> list:
+    holes = [
+        [[_round(h['x']), _round(h['y']), _round(h['typeWidth']), _round(h['typeHeight']), _round(h['typeThreshold'])]
+         for h in wall[key]]
+        for key in ('doorInfos', 'windowInfos')
+    ]
+
+    return [_round(wall['startX']), _round(wall['startY']), _round(wall['endX']), _round(wall['endY']),
+            _round(wall['height']), _round(wall['typeThickness']), wall['typeName'], holes]
+
+
+def normalize_column(column: dict) -> list:
+    return [_round(column['height']), _coords(column)]
+
+
+def normalize_outline(outline: dict) -> list:
+    return [outline['id'], _coords(outline)]
+
+
+def content_hash(*parts) -> str:
+    '''Hashes JSON serializable (normalized) input geometry together with the converter version.'''
+    canonical = json.dumps([CONVERTER_VERSION, parts], separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class AssetManifest:
+
+    def __init__(self, path: str = None, assets: dict = None) -> None:
+        '''Loads the manifest from a JSON file (an empty manifest if the file does not exist yet).
+
+        Args:
+            path (str, optional): Path of the manifest file. Use for_sink to get the manifest of a sink. Without a
+                path, the manifest is only kept in memory.
+            assets (dict, optional): Entries of an in-memory manifest by asset path.
+        '''
+        self.path = path
+        self.assets = dict(assets or {})
+        self._lock = threading.Lock() # assets are recorded from upload threads (see converter.store_assets)
+        self._changed = set() # paths updated or removed since the last save
+
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.assets = json.load(f)
+
+    @classmethod
+    def for_sink(cls, sink, directory: str = MANIFEST_DIR) -> 'AssetManifest':
+        '''Loads the manifest of the destination of a sink (see AssetSink.destination).'''
+        return cls(manifest_path(sink.destination, directory))
+
+    def is_current(self, asset_path: str, input_hash: str) -> bool:
+        '''Checks whether an asset was generated from input with the given hash.'''
+        return asset_path in self.assets and self.assets[asset_path]['hash'] == input_hash
+
+    def update(self, asset_path: str, input_hash: str, **info) -> None:
+        '''Records that an asset was generated from input with the given hash.
+
+        Args:
+            asset_path (str): Path of the asset, e.g. 'model_floors/floor_930_floors.glb'.
+            input_hash (str): Hash of the input geometry.
+            **info: Additional information to store with the entry (e.g. size, floor_id, lod).
+        '''
+        with self._lock:
+            self.assets[asset_path] = dict(info, hash=input_hash, generated=time.time())
+            self._changed.add(asset_path)
+
+    def lod_index(self) -> dict:
+        '''Returns the assets of every floor grouped by level of detail, e.g. {'930': {'0': [...], '2': [...]}}.
+
+        Clients can load the coarsest level of a floor first and refine it when it gets close to the camera. Only
+        entries recorded with a floor_id and lod are included.
+        '''
+        with self._lock:
+            assets = dict(self.assets)
+
+        index = {}
+        for asset_path, entry in sorted(assets.items()):
+            if 'floor_id' not in entry or 'lod' not in entry:
+                continue
+            lods = index.setdefault(str(entry['floor_id']), {})
+            lods.setdefault(str(entry['lod']), []).append(asset_path)
+
+        return index
+
+    def remove(self, asset_path: str) -> None:
+        with self._lock:
+            self.assets.pop(asset_path, None)
+            self._changed.add(asset_path)
+
+    def remove_floor(self, floor_id: int, keep=()) -> list:
+        '''Removes the entries of a floor, e.g. of assets it no longer has or of a floor removed upstream.
+
+        Args:
+            floor_id (int): ID of the floor.
+            keep (optional): Paths of assets of the floor to keep, e.g. those it still has.
+
+        Returns:
+            list: Paths of the removed entries.
+        '''
+        with self._lock:
+            removed = [asset_path for asset_path, entry in self.assets.items()
+                       if entry.get('floor_id') == floor_id and asset_path not in keep]
+        for asset_path in removed:
+            self.remove(asset_path)
+
+        return removed
+
+    def save(self) -> None:
+        '''Writes the manifest atomically, so an interrupted run never leaves a corrupt manifest behind.
+
+        Only the entries changed by this object are written over the current file, under a lock file, so several
+        processes can share one manifest. Their entries are loaded in the process. A manifest without a file (e.g.
+        the one job_queue.py keeps in the queue) is not written.
+        '''
+        if self.path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        with self._lock, _file_lock(f'{self.path}.lock'):
+            assets = {}
+            if os.path.isfile(self.path):
+                with open(self.path, 'r') as f:
+                    assets = json.load(f)
+
+            for asset_path in self._changed:
+                if asset_path in self.assets:
+                    assets[asset_path] = self.assets[asset_path]
+                else:
+                    assets.pop(asset_path, None)
+
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(assets, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+            self.assets = assets
+            self._changed = set()
+
+
+@contextmanager
+def _file_lock(path: str, timeout: float = 30):
+    '''Holds a lock file while the context is active. A lock older than the timeout is considered stale.'''
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > timeout:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
@@ -0,0 +1,262 @@
+'''
+
+This module contains the storage sinks the converter writes its assets to.
+
+    - LocalSink: Writes assets into a directory (atomically, so readers never see half written files).
+    - BlobSink: Uploads assets to an Azure blob storage container.
+
+Both have the same interface: destination identifies where the assets go (the asset manifest is kept per
+destination), put(path, data) returns a concurrent.futures.Future that completes when the asset is
+stored, flush() waits for all pending writes and close() also releases the resources. put_file(path, filename) stores
+the content of a file without reading it into memory (e.g. a large glb streamed to disk by StreamingGLBBuilder).
+BlobSink uploads in a pool of worker threads sharing one client, so the caller (meshing) only waits on the network
+when more than max_pending assets are queued, which bounds the memory held by pending uploads.
+
+The Azure credential and client are only created on the first upload, so importing this module (e.g. in the worker
+processes of parallel_converter.py) does not authenticate. BlobSink can be pointed at a local emulator (Azurite) with a
+connection string, either passed explicitly or in the AZURE_STORAGE_CONNECTION_STRING environment variable:
+
+    AZURE_STORAGE_CONNECTION_STRING=UseDevelopmentStorage=true python converter.py
+
+Usage:
+    with open_sink(output_dir='out/') as sink:
+        future = sink.put('model_floors/floor_930_floors.glb', data)
+
+'''
+
+import os
+import shutil
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from azure.storage.blob import BlobServiceClient
+
+
+DEFAULT_ACCOUNT_URL = "https://campusmapsbuild.blob.core.windows.net/"
+DEFAULT_CONTAINER = "campusmapsbuildings"
+
+
+class AssetSink(ABC):
+    '''Base class of all sinks.'''
+
+    @property
+    @abstractmethod
+    def destination(self) -> str:
+        '''Identifies where the assets are stored, e.g. 'file:///data/out' (see AssetManifest.for_sink).'''
+
+    @abstractmethod
+    def put(self, path: str, data: bytes) -> Future:
+        '''Stores an asset.
+
+        Args:
+            path (str): Path of the asset, e.g. 'model_floors/floor_930_floors.glb'.
+            data (bytes): Content of the asset.
+
+        Returns:
+            Future: Completes (with None) when the asset is stored, or with the exception if storing failed.
+        '''
+
+    @abstractmethod
+    def put_file(self, path: str, filename: str, delete: bool = False) -> Future:
+        '''Stores an asset from a file, without reading it into memory (e.g. a glb written by StreamingGLBBuilder).
+
+        Args:
+            path (str): Path of the asset.
+            filename (str): File with the content of the asset. It must not change until the asset is stored.
+            delete (bool, optional): Delete the file once the asset is stored (or failed).
+
+        Returns:
+            Future: Completes (with None) when the asset is stored, or with the exception if storing failed.
+        '''
+
+    @abstractmethod
+    def get(self, path: str) -> bytes:
+        '''Reads back a stored asset (e.g. to pack it into a bundle).'''
+
+    def flush(self) -> None:
+        '''Waits until all assets that were put are stored (or failed).'''
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class LocalSink(AssetSink):
+
+    def __init__(self, output_dir: str) -> None:
+        '''Writes assets into a directory, keeping the paths of the container (e.g. output_dir/model_floors/...).'''
+        self.output_dir = output_dir
+
+    @property
+    def destination(self) -> str:
+        return f'file://{os.path.abspath(self.output_dir)}'
+
+    def put(self, path: str, data: bytes) -> Future:
+        future = Future()
+        try:
+            filename = os.path.join(self.output_dir, path)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+            tmp_filename = f'{filename}.tmp'
+            with open(tmp_filename, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_filename, filename)
+
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def put_file(self, path: str, filename: str, delete: bool = False) -> Future:
+        future = Future()
+        try:
+            target = os.path.join(self.output_dir, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            tmp_filename = f'{target}.tmp'
+            shutil.copyfile(filename, tmp_filename)
+            os.replace(tmp_filename, target)
+
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            if delete:
+                os.remove(filename)
+
+        return future
+
+    def get(self, path: str) -> bytes:
+        with open(os.path.join(self.output_dir, path), 'rb') as f:
+            return f.read()
+
+
+class BlobSink(AssetSink):
+
+    def __init__(self, account_url: str = DEFAULT_ACCOUNT_URL, container: str = DEFAULT_CONTAINER,
+                 connection_string: str = None, credential=None, max_workers: int = 8,
+                 create_container: bool = False, max_pending: int = None) -> None:
+        '''Uploads assets to a blob storage container.
+
+        Args:
+            account_url (str, optional): URL of the storage account. Ignored if a connection string is given.
+            container (str, optional): Name of the container.
+            connection_string (str, optional): Connection string, e.g. 'UseDevelopmentStorage=true' for Azurite.
+                Defaults to the AZURE_STORAGE_CONNECTION_STRING environment variable.
+            credential (optional): Credential for account_url. Defaults to DefaultAzureCredential, created on the first
+                upload.
+            max_workers (int, optional): Number of concurrent uploads.
+            create_container (bool, optional): Create the container if it does not exist (useful with an emulator).
+            max_pending (int, optional): Maximum number of assets put but not yet stored (default: 2 * max_workers).
+                put and put_file block while it is reached, so the data of queued uploads can not pile up in memory
+                when meshing is faster than uploading.
+        '''
+        self.account_url = account_url
+        self.container = container
+        self.connection_string = connection_string or os.environ.get('AZURE_STORAGE_CONNECTION_STRING')
+        self.credential = credential
+        self.create_container = create_container
+
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='upload')
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+
+    @property
+    def destination(self) -> str:
+        if self.connection_string is None:
+            return f'{self.account_url.rstrip("/")}/{self.container}'
+
+        # Only the account identifies the destination, the key in the connection string may be rotated
+        fields = dict(part.split('=', 1) for part in self.connection_string.split(';') if '=' in part)
+        if fields.get('UseDevelopmentStorage') == 'true':
+            account = 'devstoreaccount1'
+        else:
+            account = fields.get('BlobEndpoint') or fields.get('AccountName')
+        if account is None:
+            account = hashlib.sha256(self.connection_string.encode()).hexdigest()[:16]
+
+        return f'{account.rstrip("/")}/{self.container}'
+
+    def container_client(self):
+        '''Returns the container client shared by all uploads, creating it on first use.'''
+        with self._client_lock:
+            if self._client is None:
+                if self.connection_string is not None:
+                    service_client = BlobServiceClient.from_connection_string(self.connection_string)
+                else:
+                    if self.credential is None:
+                        # Imported here, as it is only needed (and slow to set up) when uploading to Azure
+                        from azure.identity import DefaultAzureCredential
+                        self.credential = DefaultAzureCredential()
+                    service_client = BlobServiceClient(self.account_url, credential=self.credential)
+
+                client = service_client.get_container_client(self.container)
+                if self.create_container and not client.exists():
+                    client.create_container()
+                self._client = client
+
+        return self._client
+
+    def _upload(self, path: str, data: bytes) -> None:
+        self.container_client().upload_blob(path, data, overwrite=True)
+
+    def _upload_file(self, path: str, filename: str, delete: bool) -> None:
+        try:
+            with open(filename, 'rb') as f:
+                # The client reads the file in blocks, so large assets are never held in memory
+                self.container_client().upload_blob(path, f, length=os.path.getsize(filename), overwrite=True)
+        finally:
+            if delete:
+                os.remove(filename)
+
+    def get(self, path: str) -> bytes:
+        return self.container_client().download_blob(path).readall()
+
+    def put(self, path: str, data: bytes) -> Future:
+        self._slots.acquire()
+        return self._track(self._pool.submit(self._upload, path, data))
+
+    def put_file(self, path: str, filename: str, delete: bool = False) -> Future:
+        self._slots.acquire()
+        return self._track(self._pool.submit(self._upload_file, path, filename, delete))
+
+    def _track(self, future: Future) -> Future:
+        # The slot taken in put is released in _done
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._pending_lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def flush(self) -> None:
+        with self._pending_lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def close(self) -> None:
+        self.flush()
+        self._pool.shutdown()
+
+
+def open_sink(output_dir: str = None, connection_string: str = None, **kwargs) -> AssetSink:
+    '''Returns a LocalSink if an output directory is given, otherwise a BlobSink.'''
+    if output_dir is not None:
+        return LocalSink(output_dir)
+
+    return BlobSink(connection_string=connection_string, **kwargs)
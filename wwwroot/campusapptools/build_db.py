@@ -1,25 +1,60 @@
+'''
+
+This module builds the spaces database (buildings, floors and rooms) served by client_api_sqllite.py from the
+Pythagoras API.
+
+Every sync writes a new snapshot of the database (e.g. data/spaces-1718000000000.db for data/spaces.db) instead of
+modifying the one being served. The snapshot is validated and then published by atomically replacing the pointer file
+data/spaces.db.current, which names the current snapshot. The API notices the new pointer and serves the new snapshot
+from its next request on, so a sync never exposes empty or partial tables. An incremental sync copies the current
+snapshot and only refetches the floors that changed (see sync_planner.py).
+
+Usage:
+    python build_db.py                                          # full sync
+    python build_db.py --incremental --plan-out sync_plan.json
+
+'''
+
 import os
 import sys
 sys.path.append('../')
 
-import psycopg2
 from api_requests import API_Requests
+from api_metrics import metrics
+from sync_planner import plan_sync
+import argparse
 import time
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','data', 'spaces.db')
 
+# Floors fetched concurrently, fetched floors waiting for the writer, and floors written per executemany
+FETCH_WORKERS = 8
+QUEUE_SIZE = 64
+BATCH_FLOORS = 32
 
+# Stored in `pragma user_version`; databases of an older schema are rebuilt by a full sync
+# 2: room outlines are float32 blobs with bounding boxes, foreign keys are indexed
+SCHEMA_VERSION = 2
 
-def create_tables():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        drop table if exists buildings;
-        '''
-    )   
-    conn.commit()     
+# Number of snapshots kept on disk, including the current one (see publish_snapshot)
+KEEP_SNAPSHOTS = 3
+
+
+
+def create_tables(cursor, drop: bool = True):
+    if drop:
+        cursor.execute(
+            '''
+            drop table if exists buildings;
+            '''
+        )
     cursor.execute(
         '''
         create table if not exists buildings (
@@ -34,11 +69,12 @@ def create_tables():
         '''
     )
 
-    cursor.execute(
-        '''
-        drop table if exists floors;
-        '''
-    )      
+    if drop:
+        cursor.execute(
+            '''
+            drop table if exists floors;
+            '''
+        )
 
     cursor.execute(
         '''
@@ -52,11 +88,12 @@ def create_tables():
         '''
     )
 
-    cursor.execute(
-        '''
-        drop table if exists rooms;
-        '''
-    )    
+    if drop:
+        cursor.execute(
+            '''
+            drop table if exists rooms;
+            '''
+        )
 
     cursor.execute(
         '''
@@ -65,96 +102,465 @@ def create_tables():
             room_uid varchar(200),
             floor_id int references floors(floor_id),
             name varchar(200),
-            outline float[][],
+            outline blob,
+            min_x float,
+            min_y float,
+            max_x float,
+            max_y float,
             timestamp bigint
         );
         '''
     )
 
-    conn.close()
+    cursor.execute('create index if not exists floors_building_id on floors(building_id);')
+    cursor.execute('create index if not exists rooms_floor_id on rooms(floor_id);')
 
-api = API_Requests()
+    if drop:
+        cursor.execute(f'pragma user_version = {SCHEMA_VERSION};')
 
-#conn.autocommit = True
 
+INSERT_BUILDING = '''
+    insert into buildings (building_id, building_uid, name, x, y, rotation, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (building_id) DO UPDATE SET
+        building_uid = EXCLUDED.building_uid,
+        name = EXCLUDED.name,
+        x = EXCLUDED.x,
+        y = EXCLUDED.y,
+        rotation = EXCLUDED.rotation,
+        timestamp = EXCLUDED.timestamp;
+'''
 
-create_tables()
+INSERT_FLOOR = """
+    insert into floors (floor_id, floor_uid, building_id, name, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (floor_id) DO UPDATE SET
+        floor_uid = EXCLUDED.floor_uid,
+        building_id = EXCLUDED.building_id,
+        name = EXCLUDED.name,
+        timestamp = EXCLUDED.timestamp;
+"""
 
-buildings = api.get_building() 
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
+INSERT_ROOM = '''
+    insert into rooms (room_id, room_uid, floor_id, name, outline, min_x, min_y, max_x, max_y, timestamp)
+    values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    on conflict (room_id) do update set
+        room_uid = excluded.room_uid,
+        floor_id = excluded.floor_id,
+        name = excluded.name,
+        outline = excluded.outline,
+        min_x = excluded.min_x,
+        min_y = excluded.min_y,
+        max_x = excluded.max_x,
+        max_y = excluded.max_y,
+        timestamp = excluded.timestamp;
+'''
 
-for building in buildings:
 
-    print(building.keys())
-    # print(building['geoLocation'].keys())
-    cursor.execute(
-        '''
-        insert into buildings (building_id, building_uid, name, x, y, rotation, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT (building_id) DO UPDATE SET
-            building_uid = EXCLUDED.building_uid,
-            name = EXCLUDED.name,
-            x = EXCLUDED.x,
-            y = EXCLUDED.y,
-            rotation = EXCLUDED.rotation,
-            timestamp = EXCLUDED.timestamp;
-        ''',
-        (building['id'], building['uid'], building['name'], building['geoLocation']['x'], building['geoLocation']['y'], building['geoLocation']['rotation'], building['updated'])
-    )
-conn.commit()
-conn.close()
+def connect(path: str = None) -> sqlite3.Connection:
+    '''Opens the database for bulk writes.
 
+    The connection is in autocommit mode, so transactions are only started explicitly (see transaction). While it is
+    built, the database uses WAL journaling and synchronous=NORMAL, which only syncs at checkpoints; a crash can lose
+    the last transactions, but never corrupts the database. Snapshots are switched back to a rollback journal before
+    they are published (see publish_snapshot).
+    '''
+    # The connection is only used by one thread at a time, but the writer of ingest_floors is not the one opening it
+    conn = sqlite3.connect(path or db_path, isolation_level=None, cached_statements=64, check_same_thread=False)
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('pragma synchronous=normal')
+    conn.execute('pragma cache_size=-65536') # 64 MB
+    conn.execute('pragma temp_store=memory')
 
-tic = time.perf_counter()
+    return conn
 
-building_ids = [building['id'] for building in buildings]
-for building_id in building_ids:
-    floors = api.get_building_id_floor(building_id)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    for i,floor in enumerate(floors):
-        print(i/len(floors), '$')
 
-        floor_info = api.get_floor_id_info(floor['id'])
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    '''Runs the statements of the context in one transaction, which is rolled back if an exception is raised.'''
+    conn.execute('begin')
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute('rollback')
+        raise
+    conn.execute('commit')
 
-        cursor.execute(
-            """
-            insert into floors (floor_id, floor_uid, building_id, name, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT (floor_id) DO UPDATE SET
-                floor_uid = EXCLUDED.floor_uid,
-                building_id = EXCLUDED.building_id,
-                name = EXCLUDED.name,
-                timestamp = EXCLUDED.timestamp;
-            """,
-            (floor['id'], floor['uid'], floor_info['buildingId'], floor_info['name'], floor['updated'])
-        )
 
-        workspace_info = api.get_floor_id_workspace_info(floor['id'])
-        if workspace_info is None: continue
-        for room in workspace_info:
-            coords = [[elem['x'], elem['y']] for elem in room['outline']['coords']]
-            print(coords)
-
-            cursor.execute(
-                '''
-                insert into rooms (room_id, room_uid, floor_id, name, outline, timestamp)
-                values (?, ?, ?, ?, ?, ?)
-                on conflict (room_id) do update set
-                    room_uid = excluded.room_uid,
-                    floor_id = excluded.floor_id,
-                    name = excluded.name,
-                    outline = excluded.outline,
-                    timestamp = excluded.timestamp;
-                ''',
-                (room['id'], room['uid'], floor['id'], room['name'], ''.join(str(v) for v in coords), room['updated'])
-            )
-    conn.commit()
+def building_rows(buildings: list) -> list:
+    return [(building['id'], building['uid'], building['name'], building['geoLocation']['x'],
+             building['geoLocation']['y'], building['geoLocation']['rotation'], building['updated'])
+            for building in buildings]
+
+
+def insert_buildings(cursor, buildings: list):
+    cursor.executemany(INSERT_BUILDING, building_rows(buildings))
+
+
+def encode_outline(coords: list) -> tuple:
+    '''Packs the vertices of a room outline into a blob of little-endian float32 (x0, y0, x1, y1, ...).
+
+    Returns:
+        tuple: The blob and the bounding box (min x, min y, max x, max y), which is None for an empty outline.
+    '''
+    vertices = np.array([[vertex['x'], vertex['y']] for vertex in coords], dtype=np.float64).reshape(-1, 2)
+    if len(vertices) == 0:
+        return b'', (None, None, None, None)
+
+    # The bounding box keeps full precision, so range queries on it are exact
+    return vertices.astype('<f4').tobytes(), (*vertices.min(axis=0).tolist(), *vertices.max(axis=0).tolist())
+
+
+def fetch_floor_rows(api: API_Requests, floor: dict) -> tuple:
+    '''Fetches the info and the rooms of a floor and converts them into rows of the floors and rooms tables.
+
+    Args:
+        api (API_Requests): API to fetch from.
+        floor (dict): Record of the floor from the floor list of its building.
+
+    Returns:
+        tuple: The row of the floor and the rows of its rooms.
+    '''
+    floor_info = api.get_floor_id_info(floor['id'])
+    floor_row = (floor['id'], floor['uid'], floor_info['buildingId'], floor_info['name'], floor['updated'])
+
+    # Rooms are streamed and converted as they arrive instead of loading the whole floor first
+    room_rows = []
+    for room in api.iter_floor_id_workspace_info(floor['id']):
+        outline, bbox = encode_outline(room['outline']['coords'])
+        room_rows.append((room['id'], room['uid'], floor['id'], room['name'], outline, *bbox, room['updated']))
+
+    return floor_row, room_rows
+
+
+def write_floors(cursor, records: list, replace: bool = False):
+    '''Writes fetched floors (see fetch_floor_rows) with one executemany per table.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to write with.
+        records (list): The row of every floor and the rows of its rooms.
+        replace (bool, optional): Delete the stored rooms of the floors first, so rooms that moved or were removed do
+            not linger on them.
+    '''
+    if replace:
+        cursor.executemany('delete from rooms where floor_id=?', [(floor_row[0],) for floor_row, _ in records])
+    cursor.executemany(INSERT_FLOOR, [floor_row for floor_row, _ in records])
+    cursor.executemany(INSERT_ROOM, [room_row for _, room_rows in records for room_row in room_rows])
+
+
+def ingest_floors(cursor, api: API_Requests, floors: list, fetch_workers: int = FETCH_WORKERS,
+                  replace: bool = False):
+    '''Fetches floors concurrently and writes them from a single writer thread.
+
+    Fetcher threads put the rows of every floor on a bounded queue, so at most QUEUE_SIZE fetched floors are held in
+    memory. The writer drains the queue in batches of up to BATCH_FLOORS floors, so fetching and writing overlap while
+    SQLite only ever sees one writer. If a floor can not be fetched or written, the remaining fetches are skipped and
+    the exception is raised (the caller's transaction is then rolled back).
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor to write with, inside a transaction.
+        api (API_Requests): API to fetch from.
+        floors (list): Records of the floors from the floor lists of their buildings.
+        fetch_workers (int, optional): Number of threads fetching floors.
+        replace (bool, optional): Delete the stored rooms of every floor before writing it (see write_floors).
+    '''
+    records = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        # Gives up once the writer stopped, instead of blocking on a queue nobody drains
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(floor):
+        if stop.is_set():
+            return
+        try:
+            put(fetch_floor_rows(api, floor))
+        except BaseException as e:
+            put(e)
+
+    def write():
+        written = 0
+        try:
+            while written < len(floors) and not stop.is_set():
+                try:
+                    batch = [records.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+                while len(batch) < BATCH_FLOORS:
+                    try:
+                        batch.append(records.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for record in batch:
+                    if isinstance(record, BaseException):
+                        raise record
+
+                write_floors(cursor, batch, replace)
+                written += len(batch)
+                print(f'{written}/{len(floors)} floors written')
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    writer = threading.Thread(target=write, name='db-writer')
+    writer.start()
+    pool = ThreadPoolExecutor(fetch_workers, thread_name_prefix='fetch')
+
+    try:
+        for floor in floors:
+            pool.submit(fetch, floor)
+        writer.join()
+    finally:
+        # Also on an interrupt: the writer must be gone before the caller rolls back (or deletes) the database, as it
+        # shares the connection
+        stop.set()
+        writer.join()
+        pool.shutdown(cancel_futures=True)
+
+    if errors:
+        raise errors[0]
+
+
+def snapshot_path(path: str, version: int) -> str:
+    '''Returns the file of a snapshot of a database, e.g. data/spaces-1718000000000.db for data/spaces.db.'''
+    root, ext = os.path.splitext(path)
+    return f'{root}-{version}{ext}'
+
+
+def pointer_path(path: str) -> str:
+    '''Returns the file naming the current snapshot of a database, e.g. data/spaces.db.current.'''
+    return f'{path}.current'
+
+
+def current_snapshot(path: str = None) -> str:
+    '''Returns the file of the published snapshot of a database.
+
+    Falls back to the database file itself for databases written before snapshots (None if it does not exist either).
+    '''
+    path = path or db_path
+    try:
+        with open(pointer_path(path), 'r') as f:
+            return os.path.join(os.path.dirname(path), f.read().strip())
+    except FileNotFoundError:
+        return path if os.path.isfile(path) else None
+
+
+def validate_snapshot(conn: sqlite3.Connection, buildings: int = None, floors: int = None):
+    '''Checks a snapshot before it is published and raises a ValueError if it is not fit to serve.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the snapshot.
+        buildings (int, optional): Expected number of buildings.
+        floors (int, optional): Expected number of floors.
+    '''
+    check = conn.execute('pragma quick_check').fetchone()[0]
+    if check != 'ok':
+        raise ValueError(f'Snapshot is corrupt: {check}')
+
+    version = conn.execute('pragma user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        raise ValueError(f'Snapshot has schema version {version} instead of {SCHEMA_VERSION}')
+
+    counts = {table: conn.execute(f'select count(*) from {table}').fetchone()[0]
+              for table in ('buildings', 'floors', 'rooms')}
+    if counts['buildings'] == 0 or counts['floors'] == 0:
+        raise ValueError(f'Snapshot is empty: {counts}')
+    for table, expected in (('buildings', buildings), ('floors', floors)):
+        if expected is not None and counts[table] != expected:
+            raise ValueError(f'Snapshot has {counts[table]} {table} instead of {expected}')
+
+    orphans = conn.execute('''
+        select
+            (select count(*) from floors where building_id not in (select building_id from buildings)),
+            (select count(*) from rooms where floor_id not in (select floor_id from floors))
+    ''').fetchone()
+    if any(orphans):
+        raise ValueError(f'Snapshot has {orphans[0]} floors without building and {orphans[1]} rooms without floor')
+
+    print(f"Snapshot valid: {counts['buildings']} buildings, {counts['floors']} floors, {counts['rooms']} rooms")
+
+
+def publish_snapshot(path: str, snapshot: str, conn: sqlite3.Connection, keep: int = KEEP_SNAPSHOTS):
+    '''Makes a validated snapshot the current database and removes old snapshots.
+
+    The snapshot is switched to a rollback journal first, which checkpoints and removes its WAL file, so the published
+    file is self-contained and readers never need to write next to it. The pointer file is then replaced atomically:
+    readers see either the old or the new snapshot, never a partial one.
+
+    Args:
+        path (str): Path of the database.
+        snapshot (str): File of the snapshot.
+        conn (sqlite3.Connection): Connection to the snapshot. Closed by this function.
+        keep (int, optional): Number of snapshots to keep, including the new one. Readers that still have an older
+            one open can finish their requests on it.
+    '''
+    conn.execute('pragma journal_mode=delete')
     conn.close()
 
-toc = time.perf_counter()
+    tmp_path = f'{pointer_path(path)}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(os.path.basename(snapshot))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path(path))
+    print(f'Published {snapshot}')
+
+    root, ext = os.path.splitext(os.path.basename(path))
+    directory = os.path.dirname(path) or '.'
+    versions = sorted(int(name[len(root) + 1:-len(ext)]) for name in os.listdir(directory)
+                      if name.startswith(f'{root}-') and name.endswith(ext) and name[len(root) + 1:-len(ext)].isdigit())
+    for version in versions[:-keep]:
+        try:
+            os.remove(snapshot_path(path, version))
+        except OSError:
+            pass # Still open by a reader on a platform that does not allow removing open files, retried next time
+
+
+def _discard_snapshot(snapshot: str):
+    for filename in (snapshot, f'{snapshot}-wal', f'{snapshot}-shm'):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def full_sync(api: API_Requests, path: str = None, fetch_workers: int = FETCH_WORKERS):
+    '''Fetches every building, floor and room into a new snapshot and publishes it.
+
+    The current database is never modified, so readers keep serving it until the new snapshot is validated and
+    swapped in (see publish_snapshot). A failed sync leaves no trace.
+
+    Args:
+        api (API_Requests): API to fetch from.
+        path (str, optional): Path of the database. Defaults to db_path.
+        fetch_workers (int, optional): Number of threads fetching floors.
+    '''
+    path = path or db_path
+    snapshot = snapshot_path(path, time.time_ns() // 1000000)
+    conn = connect(snapshot)
+
+    try:
+        with transaction(conn) as cursor:
+            create_tables(cursor)
+
+            buildings = api.get_building()
+            insert_buildings(cursor, buildings)
+
+            with ThreadPoolExecutor(fetch_workers) as pool:
+                floor_lists = pool.map(lambda building: api.get_building_id_floor(building['id']), buildings)
+                floors = [floor for floor_list in floor_lists for floor in floor_list]
+            print(f'{len(buildings)} buildings, {len(floors)} floors')
+
+            ingest_floors(cursor, api, floors, fetch_workers)
+
+        validate_snapshot(conn, len(buildings), len(floors))
+    except BaseException:
+        conn.close()
+        _discard_snapshot(snapshot)
+        raise
+
+    publish_snapshot(path, snapshot, conn)
+
+
+def incremental_sync(api: API_Requests, plan_out: str = None, path: str = None, fetch_workers: int = FETCH_WORKERS):
+    '''Only refetches the floors that changed since the last run, based on the stored `updated` timestamps.
+
+    The changes are applied to a copy of the current snapshot, which is validated and published like a full sync. If
+    nothing changed, no snapshot is made.
+
+    Args:
+        api (API_Requests): API to fetch from.
+        plan_out (str, optional): Path to save the sync plan to, for the converter and the graph build.
+        path (str, optional): Path of the database. Defaults to db_path.
+        fetch_workers (int, optional): Number of threads fetching floors.
+    '''
+    path = path or db_path
+    current = current_snapshot(path)
+    if current is None:
+        print('No database yet, running a full sync instead')
+        full_sync(api, path, fetch_workers)
+        return
+
+    source = sqlite3.connect(current)
+    outdated = source.execute('pragma user_version').fetchone()[0] < SCHEMA_VERSION
+
+    plan = plan_sync(api, source)
+    print(plan.summary())
+    if plan_out is not None:
+        plan.save(plan_out)
+
+    if outdated:
+        # The timestamps of the old schema are still valid for the plan, but its rows can not be updated in place
+        source.close()
+        print('The database has an older schema, running a full sync instead')
+        full_sync(api, path, fetch_workers)
+        return
+
+    if plan.is_empty():
+        source.close()
+        return
+
+    snapshot = snapshot_path(path, time.time_ns() // 1000000)
+    conn = connect(snapshot)
+
+    try:
+        # Page by page copy of the current snapshot, consistent even while other processes read it
+        source.backup(conn)
+        source.close()
+        conn.execute('pragma journal_mode=wal') # The copy has the journal mode of the published snapshot
+
+        with transaction(conn) as cursor:
+            insert_buildings(cursor, plan.buildings)
+
+            cursor.executemany('delete from rooms where floor_id=?', [(floor_id,) for floor_id in plan.removed_floors])
+            cursor.executemany('delete from floors where floor_id=?', [(floor_id,) for floor_id in plan.removed_floors])
+            cursor.executemany('delete from buildings where building_id=?',
+                               [(building_id,) for building_id in plan.removed_buildings])
+
+            ingest_floors(cursor, api, [plan.floors[floor_id] for floor_id in plan.refetch_floors], fetch_workers,
+                          replace=True)
+
+            cursor.executemany('delete from rooms where room_id=?', [(room_id,) for room_id in plan.removed_rooms])
+
+        validate_snapshot(conn)
+    except BaseException:
+        source.close()
+        conn.close()
+        _discard_snapshot(snapshot)
+        raise
+
+    publish_snapshot(path, snapshot, conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the spaces database from the Pythagoras API.')
+    parser.add_argument('--incremental', action='store_true', help='Only refetch floors that changed since the last run')
+    parser.add_argument('--plan-out', help='Save the sync plan (floors to re-mesh, graphs to rebuild) to this file')
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS, help='Number of threads fetching floors')
+    parser.add_argument('--metrics-out', help='Save per-endpoint API metrics as JSON to this file')
+    args = parser.parse_args()
+
+    api = API_Requests()
+
+    #conn.autocommit = True
+
+    tic = time.perf_counter()
+
+    if args.incremental:
+        incremental_sync(api, args.plan_out, fetch_workers=args.fetch_workers)
+    else:
+        full_sync(api, fetch_workers=args.fetch_workers)
 
+    toc = time.perf_counter()
 
-print('time elapsed: ', toc-tic)
 
+    print('time elapsed: ', toc-tic)
+    print(metrics.report())
+    if args.metrics_out:
+        metrics.save(args.metrics_out)
@@ -0,0 +1,188 @@
+'''
+
+This module places every floor of the campus in one coordinate frame (the campus frame), so the floors of all buildings
+can be meshed and tiled together (see campus_tiles.py).
+
+Placement:
+    Every building is moved by its hand-tuned correction from position_corrections.json ([x,y,z,angle around z], the
+    same format as the offset of the converter). The floors of a building are stacked in the order the API lists them,
+    each one as high as its tallest wall plus the floor slab (LEVEL_HEIGHT if it has no walls with a height).
+
+Every floor gets one 4x4 matrix. The API data of a floor (walls, doors, windows, columns, room outlines) is moved into
+the campus frame as a whole: the points of all of it are gathered into one array per kind, transformed with one NumPy
+operation and split back, so the converter meshes the result with only a height offset.
+
+Usage:
+    frame = CampusFrame()
+    frame.add_building(corrections[name], floor_ids, data_floors)
+    data_floor, data_outlines, offset = frame.campus_floor(floor_id, data_floor, data_outlines)
+
+'''
+
+import os
+import json
+
+import numpy as np
+
+
+CORRECTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'position_corrections.json')
+
+# Height of a floor without walls (walls of 3.0 m on a slab of 0.2 m)
+LEVEL_HEIGHT = 3.2
+SLAB_HEIGHT = 0.2
+
+
+def load_corrections(path: str = CORRECTIONS_PATH) -> dict:
+    '''Returns the offset [x,y,z,angle around z] of every building by name.'''
+    with open(path, 'r') as f:
+        corrections = json.load(f)
+
+    return {name: [c['x'], c['y'], c['z'], c['angle']] for name, c in corrections.items()}
+
+
+def storey_height(data_floor: dict) -> float:
+    '''Returns the height of a floor: its tallest wall plus the slab, or LEVEL_HEIGHT if no wall has a height.'''
+    heights = [wall['height'] for wall in data_floor['wallInfos'] if wall['height'] is not None]
+    return max(heights) + SLAB_HEIGHT if heights else LEVEL_HEIGHT
+
+
+def floor_offsets(building_offset: list[float], data_floors: list) -> list:
+    '''Returns the offset of every floor of a building: the building offset, raised by the heights of the floors below.
+
+    Args:
+        building_offset (list[float]): Offset of the building. Format is [x,y,z,angle around z].
+        data_floors (list): Floor infos of the building (as returned by API_Requests.get_floor_id_info), bottom first.
+    '''
+    x, y, z, angle = building_offset
+    heights = [storey_height(data_floor) for data_floor in data_floors]
+    elevations = np.concatenate([[0], np.cumsum(heights)[:-1]]) + z
+
+    return [[x, y, float(elevation), angle] for elevation in elevations]
+
+
+class CampusFrame:
+
+    def __init__(self) -> None:
+        '''Places floors in the campus frame. Floors are added with add_building.'''
+        self.placements = {} # floor id -> offset [x,y,z,angle around z]
+        self._matrices = {} # floor id -> 4x4 matrix of the offset
+
+    def add_building(self, building_offset: list[float], floor_ids: list, data_floors: list) -> None:
+        '''Places the floors of a building (see floor_offsets).
+
+        Args:
+            building_offset (list[float]): Offset of the building. Format is [x,y,z,angle around z].
+            floor_ids (list): IDs of the floors, bottom first.
+            data_floors (list): Floor infos of the floors, in the same order.
+        '''
+        for floor_id, offset in zip(floor_ids, floor_offsets(building_offset, data_floors)):
+            x, y, z, angle = offset
+            matrix = np.eye(4)
+            matrix[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+            matrix[:3, 3] = x, y, z
+
+            self.placements[floor_id] = offset
+            self._matrices[floor_id] = matrix
+
+    def __contains__(self, floor_id: int) -> bool:
+        return floor_id in self.placements
+
+    def floor_offset(self, floor_id: int) -> list[float]:
+        '''Returns the offset [x,y,z,angle around z] of a floor, for the offset parameters of the converter.'''
+        return self.placements[floor_id]
+
+    def transform(self, points: np.ndarray, floor_id: int) -> np.ndarray:
+        '''Transforms points of a floor into the campus frame.
+
+        Args:
+            points (np.ndarray): (n, 2) or (n, 3) points. 2D points are on the floor (z = 0).
+            floor_id (int): ID of the floor.
+
+        Returns:
+            np.ndarray: (n, 3) points in the campus frame.
+        '''
+        if floor_id not in self._matrices:
+            raise KeyError(f'Floor {floor_id} is not in the campus frame')
+
+        points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+        if points.shape[1] == 2:
+            points = np.hstack([points, np.zeros((len(points), 1))])
+
+        matrix = self._matrices[floor_id]
+        return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+    def campus_floor(self, floor_id: int, data_floor: dict, data_outlines: list) -> tuple:
+        '''Moves the API data of a floor into the campus frame.
+
+        The coordinates of walls, doors, windows, columns and room outlines (and room utility points) are gathered
+        into one array, transformed at once and split back by kind. Heights are relative to the floor, so the data is
+        meshed with the returned offset, which only raises it to the elevation of the floor.
+
+        Args:
+            floor_id (int): ID of the floor.
+            data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info. Not modified.
+            data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info. Not modified.
+
+        Returns:
+            tuple: The floor info, the room outlines in the campus frame (None if there are none) and the offset
+            [0,0,elevation,0] to mesh them with.
+        '''
+        walls = data_floor['wallInfos']
+        columns = data_floor['columnInfos']
+        outlines = data_outlines or []
+        utilities = [outline.get('utilityCoord') for outline in outlines]
+
+        # One (n, 2) array of every kind of point, transformed together and split back into the kinds
+        parts = [
+            _points(walls, 'startX', 'startY'),
+            _points(walls, 'endX', 'endY'),
+            _points([door for wall in walls for door in wall['doorInfos']]),
+            _points([window for wall in walls for window in wall['windowInfos']]),
+            _points([vertex for column in columns for vertex in column['outline']['coords']]),
+            _points([vertex for outline in outlines for vertex in outline['outline']['coords']]),
+            _points([utility for utility in utilities if utility]),
+        ]
+        points = self.transform(np.concatenate(parts), floor_id)[:, :2]
+        starts, ends, doors, windows, column_coords, outline_coords, utility_coords = np.split(
+            points, np.cumsum([len(part) for part in parts])[:-1])
+
+        # Then split into the points of every wall, column and outline
+        doors = _split(doors, [len(wall['doorInfos']) for wall in walls])
+        windows = _split(windows, [len(wall['windowInfos']) for wall in walls])
+        column_coords = _split(column_coords, [len(column['outline']['coords']) for column in columns])
+        outline_coords = _split(outline_coords, [len(outline['outline']['coords']) for outline in outlines])
+        utility_coords = iter(utility_coords.tolist())
+
+        data_floor = dict(data_floor, wallInfos=[
+            dict(wall, startX=x0, startY=y0, endX=x1, endY=y1,
+                 doorInfos=_moved(wall['doorInfos'], wall_doors), windowInfos=_moved(wall['windowInfos'], wall_windows))
+            for wall, (x0, y0), (x1, y1), wall_doors, wall_windows
+            in zip(walls, starts.tolist(), ends.tolist(), doors, windows)
+        ], columnInfos=[
+            dict(column, outline=dict(column['outline'], coords=_moved(column['outline']['coords'], coords)))
+            for column, coords in zip(columns, column_coords)
+        ])
+
+        if data_outlines is not None:
+            data_outlines = [dict(outline, outline=dict(outline['outline'],
+                                                        coords=_moved(outline['outline']['coords'], coords)))
+                             for outline, coords in zip(outlines, outline_coords)]
+            for outline, utility in zip(data_outlines, utilities):
+                if utility:
+                    outline['utilityCoord'] = _moved([utility], [next(utility_coords)])[0]
+
+        return data_floor, data_outlines, [0, 0, self.placements[floor_id][2], 0]
+
+
+def _points(records: list, key_x: str = 'x', key_y: str = 'y') -> np.ndarray:
+    return np.array([[record[key_x], record[key_y]] for record in records], dtype=np.float64).reshape(-1, 2)
+
+
+def _split(points: np.ndarray, counts: list) -> list:
+    '''Splits (n, 2) points into consecutive groups of the given sizes, as lists of (x, y).'''
+    return [group.tolist() for group in np.split(points, np.cumsum(counts, dtype=np.int64)[:-1])][:len(counts)]
+
+
+def _moved(records: list, points: list) -> list:
+    '''Returns copies of records with x and y replaced by the points.'''
+    return [{**record, 'x': x, 'y': y} for record, (x, y) in zip(records, points)]
@@ -0,0 +1,325 @@
+'''
+
+This module places the geometry of every floor in one campus frame and cuts it into a spatial tile hierarchy in the
+style of 3D Tiles, so a client can stream only the parts of the campus that are in view.
+
+Positioning:
+    Every floor is placed in the campus frame (see campus_frame.py): buildings are moved by their hand-tuned
+    correction from position_corrections.json and their floors are stacked by their heights. Buildings without a
+    correction are skipped.
+
+Streaming:
+    The campus is never held in memory as a whole. A first pass places every building, moves its floors into the
+    campus frame and spools the data of every floor to a temporary directory, keeping only the bounds of the building.
+    The content of every tile is then created one floor at a time from the spool and written with
+    converter.stream_glb, which spools the meshes to disk as well, so the peak memory is that of the largest floor
+    (plus the JSON of the largest tile), however large the campus is.
+
+Hierarchy:
+    Buildings are sorted into a quadtree over the campus (by the center of their footprint) until every leaf holds a
+    single building. The content of a tile depends on its height in the tree:
+        - leaves: the buildings at full detail (level of detail 0, see converter.ASSET_LODS),
+        - parents of leaves: walls without openings (level 1),
+        - all tiles above: the exterior shells of all floors below them (level 2).
+    Tiles refine by replacement. Every tile has a bounding box around all the geometry below it and a geometric error
+    that grows with the coarseness of its content.
+
+Output (through an asset sink, see asset_sink.py):
+    tiles/tileset.json       the tileset index
+    tiles/{address}.glb      content of every tile, addressed by its path in the tree, e.g. 'root_2_0'
+
+The glb files are z-up like all assets of the converter, so the tileset declares gltfUpAxis 'Z'.
+
+Usage:
+    python campus_tiles.py --output-dir out/
+    python campus_tiles.py --buildings BLACKETT HUXLEY --quantize
+
+'''
+
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import trimesh
+
+from api_requests import API_Requests
+from api_metrics import metrics
+from asset_sink import AssetSink, open_sink
+from simplify import simplify_floor
+from sync_planner import rooms_updated
+from campus_frame import CampusFrame, CORRECTIONS_PATH, load_corrections
+import converter
+
+
+# Geometric error (in metres) of a tile's content, i.e. how far it deviates from the full detail geometry
+GEOMETRIC_ERROR_LOD1 = 1.0 # doors and windows are missing
+GEOMETRIC_ERROR_LOD2 = 4.0 # only the shell of every floor
+
+TILES_DIR = 'tiles'
+
+
+def floor_meshes(data_floor: dict, data_outlines: list, offset: list[float], lod: int) -> list:
+    '''Creates the geometry of a floor at a level of detail (see converter.ASSET_LODS), moved by the offset.'''
+    if lod == 2:
+        shell = converter.build_shell_mesh(data_floor, data_outlines, offset)
+        return [shell] if shell is not None else []
+
+    meshes = [mesh for mesh in converter.build_wall_meshes(data_floor['wallInfos'], offset, openings=lod == 0)
+              if mesh is not None]
+    meshes += [converter.Column(column, offset=offset).mesh for column in data_floor['columnInfos']]
+    meshes += [converter.Floor(outline, offset=offset).mesh for outline in data_outlines or []]
+
+    return meshes
+
+
+def floor_bounds(data_floor: dict, data_outlines: list, offset: list[float]) -> tuple:
+    '''Returns the (2, 3) bounds of the geometry of a floor at every level of detail (see floor_meshes) and the levels
+    it has geometry at, without creating all of it.
+
+    The walls are created without openings (which do not change their extent) and columns and room floors are
+    prisms, so their bounds follow from their outlines. Only the shell is meshed, as its footprint is simplified.
+    '''
+    boxes = [mesh.bounds for mesh in converter.build_wall_meshes(data_floor['wallInfos'], offset, openings=False)
+             if mesh is not None]
+
+    prisms = [([[v['x'], v['y']] for v in column['outline']['coords']],
+               column['height'] + 0.2 if column['height'] is not None else 3.2) for column in data_floor['columnInfos']]
+    prisms += [([[v['x'], v['y']] for v in outline['outline']['coords']], 0.2) for outline in data_outlines or []]
+    matrix = converter.offset_matrix(offset)
+    for coords, height in prisms:
+        coords = np.array(coords, dtype=float)
+        corners = np.vstack([np.column_stack([coords, np.full(len(coords), z)]) for z in (0, height)])
+        corners = corners @ matrix[:3, :3].T + matrix[:3, 3]
+        boxes.append([corners.min(axis=0), corners.max(axis=0)])
+
+    lods = {0, 1} if len(boxes) > 0 else set()
+
+    shell = converter.build_shell_mesh(data_floor, data_outlines, offset)
+    if shell is not None:
+        boxes.append(shell.bounds)
+        lods.add(2)
+
+    if len(boxes) == 0:
+        return None, lods
+
+    boxes = np.array(boxes)
+    return np.array([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)]), lods
+
+
+def spool_building(frame: CampusFrame, floor_ids: list, data: list, spool_dir: str) -> tuple:
+    '''Moves the floors of a building into the campus frame and spools them, so their geometry can be created again
+    one floor at a time (see tile_objects).
+
+    Args:
+        frame (CampusFrame): Frame the floors are placed in.
+        floor_ids (list): IDs of the floors.
+        data (list): Floor info and room outlines of every floor.
+        spool_dir (str): Directory to write the floors to.
+
+    Returns:
+        tuple: The (2, 3) bounds of the building and the levels of detail it has geometry at (None and an empty set
+        if it has no geometry).
+    '''
+    bounds, lods = [], set()
+    for floor_id, (data_floor, data_outlines) in zip(floor_ids, data):
+        floor = frame.campus_floor(floor_id, data_floor, data_outlines)
+        with open(os.path.join(spool_dir, f'{floor_id}.json'), 'w') as f:
+            json.dump(floor, f)
+
+        floor_box, floor_lods = floor_bounds(*floor)
+        if floor_box is not None:
+            bounds.append(floor_box)
+            lods |= floor_lods
+
+    if len(bounds) == 0:
+        return None, lods
+
+    bounds = np.array(bounds)
+    return np.array([bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)]), lods
+
+
+def tile_objects(spool_dir: str, buildings: list, lod: int):
+    '''Yields the geometry of buildings at a level of detail, one object per floor, reading the floors from the
+    spool of spool_building.
+
+    Args:
+        spool_dir (str): Directory the floors were spooled to.
+        buildings (list): Name and floor ids of every building.
+        lod (int): Level of detail (see converter.ASSET_LODS).
+    '''
+    for name, floor_ids in buildings:
+        for floor_id in floor_ids:
+            with open(os.path.join(spool_dir, f'{floor_id}.json'), 'r') as f:
+                data_floor, data_outlines, offset = json.load(f)
+
+            meshes = floor_meshes(data_floor, data_outlines, offset, lod)
+            if len(meshes) > 0:
+                yield converter.Object(trimesh.util.concatenate(meshes), f'{name}/{floor_id}')
+
+
+def build_quadtree(centers: dict, max_depth: int = 12) -> dict:
+    '''Sorts items into a quadtree until every leaf holds one item (or the maximum depth is reached).
+
+    Args:
+        centers (dict): The 2D position of every item by its key.
+        max_depth (int, optional): Maximum depth of the tree.
+
+    Returns:
+        dict: The root node. Every node has an 'address', the 'keys' of all items below it and its 'children'.
+    '''
+    points = np.array(list(centers.values()), dtype=float)
+    lo = points.min(axis=0)
+    size = max(float((points.max(axis=0) - lo).max()), 1e-6) * (1 + 1e-9)
+
+    def build(address, keys, lo, size, depth):
+        node = {'address': address, 'keys': keys, 'children': []}
+        if len(keys) <= 1 or depth == max_depth:
+            return node
+
+        quadrants = {}
+        for key in keys:
+            i, j = ((np.asarray(centers[key]) - lo) * 2 // size).clip(0, 1).astype(int)
+            quadrants.setdefault((int(i), int(j)), []).append(key)
+
+        half = size / 2
+        if len(quadrants) == 1:
+            # Everything is in one quadrant: zoom in without creating a tile
+            (i, j), = quadrants
+            return build(address, keys, lo + half * np.array([i, j]), half, depth + 1)
+
+        for (i, j), quadrant_keys in sorted(quadrants.items()):
+            child_lo = lo + half * np.array([i, j])
+            node['children'].append(build(f'{address}_{2 * j + i}', quadrant_keys, child_lo, half, depth + 1))
+
+        return node
+
+    return build('root', list(centers), lo, size, 0)
+
+
+def _height(node: dict) -> int:
+    return 1 + max(_height(child) for child in node['children']) if node['children'] else 0
+
+
+def _bounding_box(bounds: np.ndarray) -> list:
+    '''Converts (2, 3) bounds into a 3D Tiles box: the center and the three half axes.'''
+    center = (bounds[0] + bounds[1]) / 2
+    half = np.maximum((bounds[1] - bounds[0]) / 2, 1e-3)
+
+    return [float(v) for v in center] + [float(half[0]), 0, 0, 0, float(half[1]), 0, 0, 0, float(half[2])]
+
+
+def create_tileset(api: API_Requests, buildings: list, sink: AssetSink, corrections: dict = None,
+                   export_options: dict = None) -> dict:
+    '''Creates the tiles of the campus and the tileset index, and stores them.
+
+    Args:
+        api (API_Requests): API to fetch from.
+        buildings (list): Records of the buildings to include (as returned by API_Requests.get_building).
+        sink (AssetSink): Where to store the tiles.
+        corrections (dict, optional): Offset of every building by name. Defaults to position_corrections.json.
+        export_options (dict, optional): Options of Scene.to_glb for the tile content, e.g. {'quantize': True}.
+
+    Returns:
+        dict: The tileset.
+    '''
+    corrections = corrections if corrections is not None else load_corrections()
+    export_options = export_options or {}
+    frame = CampusFrame()
+    # Streamed, the room list has every room of the campus
+    room_versions = rooms_updated(api.iter_workspace())
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        floors, bounds, lods = {}, {}, {}
+        for building in buildings:
+            if building['name'] not in corrections:
+                print(f"Skipping {building['name']}: no position correction")
+                continue
+
+            records = api.get_building_id_floor(building['id'])
+            floor_ids = [floor['id'] for floor in records]
+            data = [simplify_floor(*converter.fetch_floor(floor['id'], floor.get('updated'),
+                                                          room_versions.get(floor['id']))) for floor in records]
+            frame.add_building(corrections[building['name']], floor_ids, [data_floor for data_floor, _ in data])
+
+            building_bounds, building_lods = spool_building(frame, floor_ids, data, spool_dir)
+            if building_bounds is not None:
+                floors[building['name']] = floor_ids
+                bounds[building['name']] = building_bounds
+                lods[building['name']] = building_lods
+
+        if len(floors) == 0:
+            raise ValueError('None of the buildings has a position correction and geometry')
+
+        centers = {name: (b[0, :2] + b[1, :2]) / 2 for name, b in bounds.items()}
+        uploads = []
+
+        def tile(node):
+            height = _height(node)
+            lod = min(height, 2)
+            geometric_error = [0.0, GEOMETRIC_ERROR_LOD1, GEOMETRIC_ERROR_LOD2 * 2 ** max(height - 2, 0)][lod]
+
+            node_bounds = np.array([bounds[name] for name in node['keys']])
+            node_bounds = np.array([node_bounds[:, 0].min(axis=0), node_bounds[:, 1].max(axis=0)])
+
+            result = {
+                'boundingVolume': {'box': _bounding_box(node_bounds)},
+                'geometricError': geometric_error,
+                'refine': 'REPLACE',
+                'extras': {'buildings': sorted(node['keys']), 'lod': lod},
+            }
+            if any(lod in lods[name] for name in node['keys']):
+                uri = f"{node['address']}.glb"
+                # Tiles near the root hold the whole campus, so they are streamed to disk instead of built in memory
+                with tempfile.NamedTemporaryFile(suffix='.glb', delete=False) as f:
+                    filename = f.name
+                objects = tile_objects(spool_dir, [(name, floors[name]) for name in node['keys']], lod)
+                converter.stream_glb(objects, filename, node_bounds, **export_options)
+                uploads.append(sink.put_file(f'{TILES_DIR}/{uri}', filename, delete=True))
+                result['content'] = {'uri': uri}
+            if node['children']:
+                result['children'] = [tile(child) for child in node['children']]
+
+            return result
+
+        root = tile(build_quadtree(centers))
+
+    tileset = {
+        'asset': {'version': '1.0', 'gltfUpAxis': 'Z', 'generator': 'campusapptools'},
+        'geometricError': 2 * max(root['geometricError'], GEOMETRIC_ERROR_LOD2),
+        'root': root,
+    }
+
+    # The tileset is only published once every tile it points at is stored; result() raises if an upload failed
+    for future in uploads:
+        future.result()
+    sink.put(f'{TILES_DIR}/tileset.json', json.dumps(tileset, indent=1).encode()).result()
+
+    return tileset
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Cuts the campus into 3D tiles for streaming.')
+    parser.add_argument('--buildings', nargs='*', default=converter.SOUTH_KEN_LIGHT, help='Names of the buildings')
+    parser.add_argument('--corrections', default=CORRECTIONS_PATH, help='Position corrections of the buildings')
+    parser.add_argument('--output-dir', help='Write tiles into this directory instead of uploading them')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    parser.add_argument('--quantize', action='store_true', help='Write welded, quantized glb files (KHR_mesh_quantization)')
+    args = parser.parse_args()
+
+    start = time.time()
+
+    api = API_Requests()
+    buildings = [building for building in api.get_building() if building['name'] in args.buildings]
+
+    with open_sink(args.output_dir, args.connection_string) as sink:
+        tileset = create_tileset(api, buildings, sink, load_corrections(args.corrections),
+                                 {'quantize': True} if args.quantize else None)
+
+    end = time.time()
+
+    print(f"Time taken: {end - start} seconds")
+    print(metrics.report())
@@ -3,14 +3,25 @@ This file contains the code for converting the data retrieved from the API into
 
 The main classes are:
     - Scene: A scene is a collection of objects. This class is used to export the scene into a glb file.
+      stream_glb writes objects into a glb file one by one instead, for scenes too large to hold in memory.
     - Object: A general object class for all objects.
     - ExtrudedPolygon: A class for all objects without holes (e.g. columns, floors, ...).
     - CuboidWithHole: A cuboid with a hole in it. Used for things such as wall elements that have windows or doors.
+    - InstancedObject: A mesh repeated at several positions (identical columns), written once with
+      EXT_mesh_gpu_instancing if the scene is exported with instancing.
 
 The main functions are:
     - create_floor: Creates outsides walls, inside walls, and floors separately for each floor/level.
     - create_building: Retrives floors of a building and calls create_floor for each floor.
 
+create_floor is split into fetch_floor (network), build_floor_assets (meshing) and store_assets (network), so the
+meshing can be distributed over a process pool. See parallel_converter.py. Assets are stored by an AssetSink (a local
+directory or the blob storage container, see asset_sink.py) in the background, so meshing never waits on uploads.
+
+Every floor is converted at several levels of detail (see ASSET_LODS): full detail, walls without openings and the
+exterior shell only (model_shells). The asset manifest records the level of each asset, and the index of all assets
+by floor and level (asset_lods.json) is uploaded with them, so clients can stream coarse geometry first.
+
     
 Current Implementation:
 
@@ -26,21 +37,23 @@ The main function in this script best demonstrates how to use the classes and fu
 '''
 
 import warnings
+import argparse
 import time
 import json
+import functools
+from concurrent.futures import Future
 
 from api_requests import API_Requests
+from api_metrics import metrics
+from asset_manifest import AssetManifest, content_hash, normalize_wall, normalize_column, normalize_outline
+from sync_planner import SyncPlan, rooms_updated
+from glb import GLBBuilder, StreamingGLBBuilder, quantization_grid
+from asset_sink import AssetSink, open_sink
+from simplify import simplify_floor
 
 import trimesh
 import shapely
 import numpy as np
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-
-
-connection_string = "https://campusmapsbuild.blob.core.windows.net/"
-container_name = "campusmapsbuildings"
-default_credential = DefaultAzureCredential()
 
 
 # Not needed in current implementation:
@@ -83,8 +96,88 @@ class Scene:
         for obj in self.objects:
             self.scene.add_geometry({f'{obj.name}': obj.mesh})
 
-    def export(self, filename: str) -> None:
-        trimesh.exchange.export.export_scene(self.scene, filename, file_type="glb")
+    def to_glb(self, quantize: bool = False, tolerance: float = 0.005, normals: bool = False,
+               instancing: bool = False) -> bytes:
+        '''Returns the scene as a glb file.
+
+        Args:
+            quantize (bool, optional): Weld vertices and quantize positions/normals (KHR_mesh_quantization), see glb.py.
+            tolerance (float, optional): Maximum position error in metres that quantization may introduce. Scenes that
+                would exceed it keep float positions.
+            normals (bool, optional): Also write (flat) vertex normals.
+            instancing (bool, optional): Store the mesh of an InstancedObject once and draw it per instance
+                (EXT_mesh_gpu_instancing). Otherwise all of its instances are written as one mesh.
+
+        Without quantize and instancing, the scene is exported by trimesh, and normals are not written.
+        '''
+        instanced = [obj for obj in self.objects if instancing and isinstance(obj, InstancedObject)]
+        if not quantize and len(instanced) == 0:
+            return self.scene.export(file_type="glb")
+
+        grid = None
+        if quantize:
+            bounds = np.array([obj.mesh.bounds for obj in self.objects if obj not in instanced] or [[[0, 0, 0]] * 2])
+            grid = quantization_grid([bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)], tolerance)
+
+        builder = GLBBuilder(grid, normals)
+        for obj in self.objects:
+            if obj in instanced:
+                builder.add_instanced_mesh(obj.name, obj.template, obj.translations(), obj.rotations())
+            else:
+                builder.add_mesh(obj.name, obj.mesh)
+
+        return builder.to_bytes()
+
+    def export(self, filename: str, **options) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.to_glb(**options))
+
+
+def stream_glb(objects, filename: str, bounds: np.ndarray = None, quantize: bool = False, tolerance: float = 0.005,
+               normals: bool = False, instancing: bool = False) -> int:
+    '''Writes objects into a glb file one at a time, without assembling a Scene (see glb.StreamingGLBBuilder).
+
+    Peak memory is bounded by the largest object, if the objects are created lazily (e.g. by a generator) and not
+    referenced elsewhere.
+
+    Args:
+        objects (iterable): The objects to write, e.g. a generator creating them.
+        filename (str): Path of the glb file.
+        bounds (np.ndarray, optional): (2, 3) bounds of all objects. Quantization needs them up front, as the objects
+            are not known before they are written; without them positions are written as float32.
+        quantize, tolerance, normals, instancing: See Scene.to_glb.
+
+    Returns:
+        int: Size of the file.
+    '''
+    grid = None
+    if quantize:
+        if bounds is None:
+            warnings.warn('stream_glb cannot quantize without the bounds of the objects, writing float positions')
+        else:
+            grid = quantization_grid(bounds, tolerance)
+
+    with StreamingGLBBuilder(grid, normals) as builder:
+        for obj in objects:
+            if instancing and isinstance(obj, InstancedObject):
+                builder.add_instanced_mesh(obj.name, obj.template, obj.translations(), obj.rotations())
+            else:
+                builder.add_mesh(obj.name, obj.mesh)
+
+        return builder.write(filename)
+
+
+def offset_matrix(offset: list[float]) -> np.ndarray:
+    '''Returns the 4x4 transformation matrix of an offset of the format [x,y,z,angle around z].'''
+    x, y, z, angle = offset
+    transformation_matrix = np.array([
+        [np.cos(angle), -np.sin(angle), 0, x],
+        [np.sin(angle), np.cos(angle), 0, y],
+        [0, 0, 1, z],
+        [0, 0, 0, 1]
+    ])
+
+    return transformation_matrix
 
 
 class Object:
@@ -100,14 +193,7 @@ class Object:
         self.mesh = mesh
         self.tags = {} # internal/external wall, ...
 
-        x, y, z, angle = offset
-        transformation_matrix = np.array([
-            [np.cos(angle), -np.sin(angle), 0, x],
-            [np.sin(angle), np.cos(angle), 0, y],
-            [0, 0, 1, z],
-            [0, 0, 0, 1]
-        ])
-        self.mesh.apply_transform(transformation_matrix)
+        self.mesh.apply_transform(offset_matrix(offset))
 
     def export(self, filename: str) -> None:
         trimesh.exchange.export.export_mesh(self.mesh, filename, file_type="glb")
@@ -172,6 +258,39 @@ class Column(ExtrudedPolygon):
         super().__init__(vertices_2d, height, name, offset)
 
 
+class InstancedObject(Object):
+    def __init__(self, mesh: trimesh.base.Trimesh, transforms: np.ndarray, name: str) -> None:
+        '''A mesh repeated at several positions, e.g. identical columns.
+
+        The `mesh` attribute holds all instances merged into one mesh, so the object can be used like any other
+        Object. Scene.to_glb(instancing=True) writes the mesh of a single instance once instead.
+
+        Args:
+            mesh (trimesh.base.Trimesh): Mesh of a single instance, in its local coordinates.
+            transforms (np.ndarray): (n, 4, 4) transformation matrices of the instances. Only rotations around z and
+                translations are supported.
+            name (str): Name of the object.
+        '''
+        self.template = mesh
+        self.transforms = np.asarray(transforms, dtype=np.float64)
+
+        vertices = np.einsum('nij,mj->nmi', self.transforms[:, :3, :3], mesh.vertices) + self.transforms[:, None, :3, 3]
+        faces = mesh.faces[None, :, :] + len(mesh.vertices) * np.arange(len(self.transforms))[:, None, None]
+        merged = trimesh.Trimesh(vertices.reshape(-1, 3), faces.reshape(-1, 3), process=False)
+
+        super().__init__(merged, name)
+
+    def translations(self) -> np.ndarray:
+        return self.transforms[:, :3, 3]
+
+    def rotations(self) -> np.ndarray:
+        '''Returns the rotation of every instance as a unit quaternion (x, y, z, w).'''
+        angle = np.arctan2(self.transforms[:, 1, 0], self.transforms[:, 0, 0])
+        zeros = np.zeros_like(angle)
+
+        return np.stack([zeros, zeros, np.sin(angle / 2), np.cos(angle / 2)], axis=1)
+
+
 class Floor(ExtrudedPolygon):
     def __init__(self, data: dict, name: str = 'room', offset: list[float] = [0,0,0,0]) -> None:
         vertices_2d = []
@@ -240,87 +359,522 @@ class Wall(CuboidWithHole):
 
         super().__init__(exterior_points, interior_points, postition, angle, thickness, name, offset)
         
-        if 'I' in data['typeName']:
-            self.tags['isInternalWall'] = True
-            self.tags['isExternalWall'] = False
-        elif 'E' in data['typeName']:
-            self.tags['isInternalWall'] = False
-            self.tags['isExternalWall'] = True
+        self.tags['isInternalWall'], self.tags['isExternalWall'] = wall_category(data)
+
+
+def column_shape(data: dict) -> tuple:
+    '''Splits a column into its shape and its placement, so identical columns can be instanced.
+
+    The outline is moved to its centroid, rotated so its first longest edge points along x and starts at that edge.
+    Columns that only differ by position and rotation around z get the same key.
+
+    Args:
+        data (dict): Column data retrieved from the API.
+
+    Returns:
+        tuple: The key of the shape (None if the outline is degenerate), the outline in local coordinates, the height
+        and the 4x4 matrix that places the local outline on the floor.
+    '''
+    height = data['height'] + 0.2 if data['height'] is not None else 3.2
+    points = np.array([[vertex['x'], vertex['y']] for vertex in data['outline']['coords']], dtype=float)
+
+    if len(points) > 1 and np.allclose(points[0], points[-1]):
+        points = points[:-1]
+    if len(points) < 3:
+        return None, None, height, None
+
+    # Counter-clockwise, so mirrored columns get a different key
+    area = np.sum(points[:, 0] * np.roll(points[:, 1], -1) - np.roll(points[:, 0], -1) * points[:, 1])
+    if area < 0:
+        points = points[::-1]
+
+    center = points.mean(axis=0)
+    edges = np.roll(points, -1, axis=0) - points
+    lengths = np.round(np.linalg.norm(edges, axis=1), 3)
+    first = int(np.argmax(lengths))
+    angle = np.arctan2(edges[first, 1], edges[first, 0])
+
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    local = np.roll(points - center, -first, axis=0) @ rotation # rotates by -angle
+
+    placement = offset_matrix([center[0], center[1], 0, angle])
+    key = (round(height, 3), tuple(np.round(local, 3).ravel().tolist()))
+
+    return key, local, height, placement
+
+
+def instance_columns(data_columns: list, offset: list[float] = [0,0,0,0], min_instances: int = 2) -> list:
+    '''Creates the columns of a floor, merging identical ones into InstancedObjects.
+
+    Args:
+        data_columns (list): The columnInfos of a floor retrieved from the API.
+        offset (list[float], optional): Offset to apply to the columns. Format is [x,y,z,angle around z].
+        min_instances (int, optional): Shapes that occur fewer times are created as single Column objects.
+
+    Returns:
+        list: InstancedObject and Column objects.
+    '''
+    groups = {}
+    singles = []
+    for data in data_columns:
+        key, local, height, placement = column_shape(data)
+        if key is None:
+            singles.append(data)
         else:
-            self.tags['isInternalWall'] = True 
-            self.tags['isExternalWall'] = True
+            groups.setdefault(key, []).append((data, local, height, placement))
 
+    objects = []
+    for i, members in enumerate(groups.values()):
+        if len(members) < min_instances:
+            singles += [data for data, _, _, _ in members]
+            continue
 
-def create_floor(floor_id: int, offset: list[float] = [0,0,0,0]) -> None:
-    '''Creates outsides walls, inside walls, and floors separately for each floor/level.
+        _, local, height, _ = members[0]
+        template = ExtrudedPolygon(local, height, 'column').mesh
+        transforms = offset_matrix(offset) @ np.array([placement for _, _, _, placement in members])
+        objects.append(InstancedObject(template, transforms, f'columns_{i}'))
 
-    The offset is for for positioning the floor/building globally. W/o offset, the floor is positioned at the origin.
+    return objects + [Column(data, offset=offset) for data in singles]
+
+
+def wall_category(data: dict) -> tuple:
+    '''Returns whether a wall is an internal and/or an external wall, based on its type name (e.g. 'I10', 'E30').'''
+    if 'I' in data['typeName']:
+        return True, False
+    elif 'E' in data['typeName']:
+        return False, True
+    else:
+        return True, True
+
+
+# Unit cube [0,1]^3 with outward facing triangles, the template for walls without openings
+_UNIT_BOX = trimesh.creation.box(bounds=[[0, 0, 0], [1, 1, 1]])
+
+
+def build_wall_meshes(data_walls: list, offset: list[float] = [0,0,0,0], openings: bool = True) -> tuple:
+    '''Creates the walls of a whole floor as one interior and one exterior mesh.
+
+    Most walls have no doors or windows, so they are plain boxes. Instead of triangulating a polygon for each of them
+    (as Wall does), the boxes of all of them are generated at once as NumPy vertex and face arrays. Only walls with
+    openings go through Wall. Everything is merged into one mesh per category and the offset is applied once.
+
+    The resulting geometry is the same as that of the Wall objects.
 
     Args:
-        floor_id (int): ID of the floor to create.
-        offset (list[float], optional): Offset to apply to the floor. Format is [x,y,z,angle around z].
+        data_walls (list): The wallInfos of a floor retrieved from the API.
+        offset (list[float], optional): Offset to apply to the walls. Format is [x,y,z,angle around z].
+        openings (bool, optional): Cut doors and windows. Without them, every wall is a plain box (coarser LOD).
+
+    Returns:
+        tuple: Mesh of the interior walls and mesh of the exterior walls (None if there are no such walls).
+    '''
+    if openings:
+        boxes = [wall for wall in data_walls if not wall['doorInfos'] and not wall['windowInfos']]
+        with_holes = [wall for wall in data_walls if wall['doorInfos'] or wall['windowInfos']]
+    else:
+        boxes, with_holes = data_walls, []
+
+    meshes_interior, meshes_exterior = [], []
+
+    if len(boxes) > 0:
+        start = np.array([[wall['startX'], wall['startY']] for wall in boxes], dtype=float)
+        end = np.array([[wall['endX'], wall['endY']] for wall in boxes], dtype=float)
+        height = np.array([wall['height'] + 0.2 if wall['height'] is not None else 3.2 for wall in boxes])
+        thickness = np.array([wall['typeThickness'] for wall in boxes], dtype=float)
+        categories = np.array([wall_category(wall) for wall in boxes], dtype=bool).reshape(-1, 2)
+
+        direction = end - start
+        length = np.linalg.norm(direction, axis=1)
+        e1 = direction / np.where(length > 0, length, 1)[:, None]
+        e2 = np.stack([-e1[:, 1], e1[:, 0]], axis=1)
+
+        # Corner (a, b, c) of the unit cube -> start + a*length*e1 + (b - 1/2)*thickness*e2 + c*height*e3
+        a, b, c = _UNIT_BOX.vertices.T
+        xy = (start[:, None, :]
+              + (a[None, :, None] * length[:, None, None]) * e1[:, None, :]
+              + ((b[None, :, None] - 0.5) * thickness[:, None, None]) * e2[:, None, :])
+        z = c[None, :] * height[:, None]
+        vertices = np.concatenate([xy, z[:, :, None]], axis=2) # (n, 8, 3)
+
+        for is_category, meshes in ((categories[:, 0], meshes_interior), (categories[:, 1], meshes_exterior)):
+            selected = is_category & (length > 0) & (thickness > 0)
+            n = int(selected.sum())
+            if n == 0: continue
+
+            faces = _UNIT_BOX.faces[None, :, :] + 8 * np.arange(n)[:, None, None]
+            meshes.append(trimesh.Trimesh(vertices[selected].reshape(-1, 3), faces.reshape(-1, 3), process=False))
+
+    for data in with_holes:
+        wall = Wall(data)
+        if wall.tags['isInternalWall']:
+            meshes_interior.append(wall.mesh)
+        if wall.tags['isExternalWall']:
+            meshes_exterior.append(wall.mesh)
+
+    transformation_matrix = offset_matrix(offset)
+    merged = []
+    for meshes in (meshes_interior, meshes_exterior):
+        if len(meshes) == 0:
+            merged.append(None)
+            continue
+
+        mesh = trimesh.util.concatenate(meshes)
+        mesh.apply_transform(transformation_matrix)
+        merged.append(mesh)
+
+    return tuple(merged)
+
+
+# Level of detail of every kind of asset: 0 is full detail, higher levels are coarser
+#   0: walls with doors and windows, columns, room floors
+#   1: walls without openings, columns (room floors are the same as in level 0)
+#   2: exterior shell only (footprint of the floor extruded to the wall height)
+ASSET_LODS = {
+    'outsides': 0,
+    'insides': 0,
+    'floors': 0,
+    'outsides_lod1': 1,
+    'insides_lod1': 1,
+    'shells': 2,
+}
+
+# Path of the index of all assets by floor and level of detail in the container
+LOD_INDEX_PATH = 'asset_lods.json'
+
+# Holes of the footprint smaller than this (m^2) are filled in the shell
+SHELL_MIN_COURTYARD = 25.0
+
+
+def build_shell_mesh(data_floor: dict, data_outlines: list, offset: list[float] = [0,0,0,0]) -> trimesh.Trimesh:
+    '''Creates the exterior shell of a floor: its footprint extruded to the height of the walls.
+
+    The footprint is the union of the exterior walls and the room outlines. Small holes (e.g. gaps between rooms) are
+    filled, courtyards are kept.
+
+    Args:
+        data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info.
+        data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info.
+        offset (list[float], optional): Offset to apply to the shell. Format is [x,y,z,angle around z].
+
+    Returns:
+        trimesh.Trimesh: Mesh of the shell (None if the floor has neither exterior walls nor rooms).
+    '''
+    parts = []
+    heights = [3.2]
+    for wall in data_floor['wallInfos']:
+        if not wall_category(wall)[1]:
+            continue
+        line = shapely.geometry.LineString([(wall['startX'], wall['startY']), (wall['endX'], wall['endY'])])
+        if line.length > 0 and wall['typeThickness'] > 0:
+            parts.append(line.buffer(wall['typeThickness'] / 2, cap_style='flat'))
+        if wall['height'] is not None:
+            heights.append(wall['height'] + 0.2)
+
+    for outline in data_outlines or []:
+        polygon = shapely.geometry.Polygon([[v['x'], v['y']] for v in outline['outline']['coords']])
+        parts.append(polygon.buffer(0))
+
+    if len(parts) == 0:
+        return None
+
+    # Closes the gaps of wall thickness between neighbouring rooms
+    footprint = shapely.unary_union(parts).buffer(0.2, join_style='mitre').buffer(-0.2, join_style='mitre')
+    footprint = footprint.simplify(0.05)
+
+    meshes = []
+    for polygon in getattr(footprint, 'geoms', [footprint]):
+        if polygon.is_empty or polygon.area <= 0:
+            continue
+        courtyards = [ring for ring in polygon.interiors if shapely.geometry.Polygon(ring).area > SHELL_MIN_COURTYARD]
+        meshes.append(trimesh.creation.extrude_polygon(shapely.geometry.Polygon(polygon.exterior, courtyards),
+                                                       max(heights)))
+
+    if len(meshes) == 0:
+        return None
+
+    mesh = trimesh.util.concatenate(meshes)
+    mesh.apply_transform(offset_matrix(offset))
+
+    return mesh
+
+
+def asset_path(floor_id: int, kind: str) -> str:
+    '''Returns the path of an asset in the container, e.g. (930, 'insides_lod1') -> 'model_insides/floor_930_insides_lod1.glb'.'''
+    return f'model_{kind.split("_")[0]}/floor_{floor_id}_{kind}.glb'
+
+
+def asset_info(path: str) -> dict:
+    '''Returns the floor id, kind and level of detail of an asset from its path (the inverse of asset_path).'''
+    floor_id, kind = path.rsplit('/', 1)[-1][len('floor_'):-len('.glb')].split('_', 1)
+    return {'floor_id': int(floor_id), 'kind': kind, 'lod': ASSET_LODS[kind]}
+
+
+def fetch_floor(floor_id: int, updated: int = None, rooms_updated: int = None) -> tuple:
+    '''Retrieves the data of a floor that is needed to create its assets.
+
+    Args:
+        floor_id (int): ID of the floor.
+        updated (int, optional): `updated` timestamp of the floor. Lets a response cache skip the API if unchanged.
+        rooms_updated (int, optional): Latest `updated` timestamp of the rooms of the floor, likewise for the room
+            outlines (see API_Requests.get_floor_id_workspace_info).
+
+    Returns:
+        tuple: The floor info (walls, columns, ...) and the room outlines (None if the floor has none).
     '''
     api = API_Requests()
 
-    data_floor = api.get_floor_id_info(floor_id)
-    data_outlines = api.get_floor_id_workspace_info(floor_id)
+    data_floor = api.get_floor_id_info(floor_id, updated=updated)
+    data_outlines = api.get_floor_id_workspace_info(floor_id, updated=rooms_updated)
 
-    walls = []
+    return data_floor, data_outlines
+
+
+def asset_input_hashes(floor_id: int, data_floor: dict, data_outlines: list, offset: list[float] = [0,0,0,0],
+                       export_options: dict = None) -> dict:
+    '''Hashes the normalized input geometry of every asset of a floor (see asset_manifest.py).
+
+    Args:
+        floor_id (int): ID of the floor.
+        data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info.
+        data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info.
+        offset (list[float], optional): Offset to apply to the floor. Format is [x,y,z,angle around z].
+        export_options (dict, optional): Options of Scene.to_glb. Part of the hash, so changing them rebuilds assets.
+
+    Returns:
+        dict: The input hash by asset path, only for assets that would be generated.
+    '''
+    walls_interior, walls_exterior = [], []
     for wall in data_floor['wallInfos']:
-        walls.append(Wall(wall, offset=offset))
+        is_internal, is_external = wall_category(wall)
+        if is_internal:
+            walls_interior.append(normalize_wall(wall))
+        if is_external:
+            walls_exterior.append(normalize_wall(wall))
+
+    columns = [normalize_column(column) for column in data_floor['columnInfos']]
+    outlines = [normalize_outline(outline) for outline in data_outlines or []]
+
+    # Coarser levels do not depend on the openings (the last element of a normalized wall)
+    boxes_interior = [wall[:-1] for wall in walls_interior]
+    boxes_exterior = [wall[:-1] for wall in walls_exterior]
+
+    # Assets exported with the default options keep the hashes they had before export options existed
+    options = [export_options] if export_options else []
+
+    hashes = {}
+    if len(walls_exterior) > 0 or len(columns) > 0:
+        hashes[asset_path(floor_id, 'outsides')] = content_hash('outsides', offset, walls_exterior, columns, *options)
+        hashes[asset_path(floor_id, 'outsides_lod1')] = content_hash('outsides_lod1', offset, boxes_exterior, columns,
+                                                                     *options)
+    if len(walls_interior) > 0:
+        hashes[asset_path(floor_id, 'insides')] = content_hash('insides', offset, walls_interior, *options)
+        hashes[asset_path(floor_id, 'insides_lod1')] = content_hash('insides_lod1', offset, boxes_interior, *options)
+    if len(outlines) > 0:
+        hashes[asset_path(floor_id, 'floors')] = content_hash('floors', offset, outlines, *options)
+    if len(walls_exterior) > 0 or len(outlines) > 0:
+        hashes[asset_path(floor_id, 'shells')] = content_hash('shells', offset, boxes_exterior, outlines, *options)
+
+    return hashes
+
+
+def build_floor_assets(floor_id: int, data_floor: dict, data_outlines: list, offset: list[float] = [0,0,0,0],
+                       include: set = None, export_options: dict = None) -> dict:
+    '''Creates the outsides, insides and floors assets of a floor from its data, at every level of detail (see
+    ASSET_LODS).
+
+    Does not touch the network, so it can run in a worker process (see parallel_converter.py). The data is simplified
+    first (see simplify.py).
 
-    room_floors = []
-    if data_outlines is not None:
-        for outline in data_outlines:
-            room_floors.append(Floor(outline, offset=offset))
+    Args:
+        floor_id (int): ID of the floor.
+        data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info.
+        data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info.
+        offset (list[float], optional): Offset to apply to the floor. Format is [x,y,z,angle around z].
+        include (set, optional): Only create the assets with these paths. Defaults to all assets.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True, 'tolerance': 0.005}.
+
+    Returns:
+        dict: The glb files by their path in the container, e.g. {'model_outsides/floor_930_outsides.glb': b'...'}.
+    '''
+    def included(kind):
+        return include is None or asset_path(floor_id, kind) in include
+
+    export_options = export_options or {}
+    assets = {}
+
+    # Merges split walls and drops redundant outline points, so there are fewer boxes and triangles to create
+    data_floor, data_outlines = simplify_floor(data_floor, data_outlines)
+
+    def add(kind, objects):
+        if len(objects) > 0 and included(kind):
+            assets[asset_path(floor_id, kind)] = Scene(objects).to_glb(**export_options)
 
     columns = []
-    for column in data_floor['columnInfos']:
-        columns.append(Column(column, offset=offset))
+    if included('outsides') or included('outsides_lod1'):
+        if export_options.get('instancing'):
+            columns = instance_columns(data_floor['columnInfos'], offset)
+        else:
+            for column in data_floor['columnInfos']:
+                columns.append(Column(column, offset=offset))
 
-    walls_interior = []
-    walls_exterior = []
-    for wall in walls:
-        if wall.tags['isInternalWall']:
-            walls_interior.append(wall)
-        if wall.tags['isExternalWall']:
-            walls_exterior.append(wall)
+    # Walls get the offset applied by build_wall_meshes
+    for suffix, openings in (('', True), ('_lod1', False)):
+        if not (included('outsides' + suffix) or included('insides' + suffix)):
+            continue
 
-    # Blob service client
-    blob_service_client = BlobServiceClient(connection_string, credential=default_credential)
-    #blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)        
+        mesh_interior, mesh_exterior = build_wall_meshes(data_floor['wallInfos'], offset, openings)
+        walls_interior = [Object(mesh_interior, 'walls_interior')] if mesh_interior is not None else []
+        walls_exterior = [Object(mesh_exterior, 'walls_exterior')] if mesh_exterior is not None else []
 
-    if len(walls_exterior) > 0 or len(columns) > 0:
-        scene_outsides = Scene(walls_exterior + columns)
-        #scene_outsides.export(f'model_outsides/floor_{floor_id}_outsides.glb')
-        scene_outsides.export(container_client.upload_blob(f"model_outsides/floor_{floor_id}_outsides.glb", scene_outsides.scene.export(file_type="glb")))
-  
-
-    if len(walls_interior) > 0: 
-        scene_insides = Scene(walls_interior)
-        #scene_insides.export(f'model_insides/floor_{floor_id}_insides.glb')
-        scene_insides.export(container_client.upload_blob(f"model_insides/floor_{floor_id}_insides.glb", scene_insides.scene.export(file_type="glb")))
-    
-    if len(room_floors) > 0:
-        scene_floors = Scene(room_floors)
-        #scene_floors.export(f'model_floors/floor_{floor_id}_floors.glb')
-        scene_floors.export(container_client.upload_blob(f"model_floors/floor_{floor_id}_floors.glb", scene_floors.scene.export(file_type="glb")))
+        add('outsides' + suffix, walls_exterior + columns)
+        add('insides' + suffix, walls_interior)
+
+    if data_outlines is not None and included('floors'):
+        add('floors', [Floor(outline, offset=offset) for outline in data_outlines])
+
+    if included('shells'):
+        mesh_shell = build_shell_mesh(data_floor, data_outlines, offset)
+        add('shells', [Object(mesh_shell, 'shell')] if mesh_shell is not None else [])
 
     #scene_all = Scene(walls_exterior + columns + walls_interior + room_floors)
     #scene_all.export(f'floor_{floor_id}_all.glb')
 
+    return assets
+
+
+_default_sink = None
+
+
+def default_sink() -> AssetSink:
+    '''Returns the sink shared by all calls that do not pass one (the blob storage container, see asset_sink.py).'''
+    global _default_sink
+    if _default_sink is None:
+        _default_sink = open_sink()
+
+    return _default_sink
+
+
+def _record_stored(manifest: AssetManifest, path: str, input_hash: str, size: int, recorded: Future,
+                   future: Future) -> None:
+    # Runs in an upload thread once the asset is stored
+    if future.exception() is not None:
+        recorded.set_exception(future.exception())
+        return
+
+    manifest.update(path, input_hash, size=size, **asset_info(path))
+    recorded.set_result(None)
+
+
+def store_assets(assets: dict, sink: AssetSink = None, hashes: dict = None, manifest: AssetManifest = None) -> list:
+    '''Puts assets into a sink, without waiting for them to be stored.
+
+    Args:
+        assets (dict): The glb files by their path in the container.
+        sink (AssetSink, optional): Where to store the assets. Defaults to the shared blob storage sink.
+        hashes (dict, optional): Input hashes of the assets by path. Needed with a manifest.
+        manifest (AssetManifest, optional): Record every asset in the manifest once it is stored. Assets that fail to
+            upload are not recorded, so they are created again on the next run.
+
+    Returns:
+        list: One future per asset, see AssetSink.put. With a manifest, a future only completes once the asset is
+        also recorded in it.
+    '''
+    sink = sink or default_sink()
+
+    futures = []
+    for path, data in assets.items():
+        future = sink.put(path, data)
+        if manifest is not None:
+            # Done callbacks run after waiters are woken, so the caller waits on a future completed by the callback
+            recorded = Future()
+            future.add_done_callback(functools.partial(_record_stored, manifest, path, hashes[path], len(data),
+                                                       recorded))
+            future = recorded
+        futures.append(future)
+
+    return futures
+
+
+def publish_lod_index(manifest: AssetManifest, sink: AssetSink = None) -> None:
+    '''Stores the assets of every floor grouped by level of detail, so clients can stream coarse geometry first.'''
+    store_assets({LOD_INDEX_PATH: json.dumps(manifest.lod_index()).encode()}, sink)
+
+
+def changed_assets(hashes: dict, manifest: AssetManifest = None) -> set:
+    '''Returns the paths of the assets whose input hash differs from the one recorded in the manifest.'''
+    if manifest is None:
+        return set(hashes)
 
-def create_building(building_id: int) -> None:
+    return {path for path, input_hash in hashes.items() if not manifest.is_current(path, input_hash)}
+
+
+def create_floor(floor_id: int, offset: list[float] = [0,0,0,0], updated: int = None,
+                 manifest: AssetManifest = None, force: bool = False, export_options: dict = None,
+                 sink: AssetSink = None, rooms_updated: int = None) -> list:
+    '''Creates outsides walls, inside walls, and floors separately for each floor/level.
+
+    The offset is for for positioning the floor/building globally. W/o offset, the floor is positioned at the origin.
+
+    Args:
+        floor_id (int): ID of the floor to create.
+        offset (list[float], optional): Offset to apply to the floor. Format is [x,y,z,angle around z].
+        updated (int, optional): `updated` timestamp of the floor. Lets a response cache skip the API if unchanged.
+        manifest (AssetManifest, optional): Skip meshing and upload of assets whose input geometry is unchanged
+            according to the manifest. Assets are recorded in it once they are stored; it is saved with the assets
+            stored so far.
+        force (bool, optional): Create all assets, even if they are unchanged according to the manifest.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True}.
+        sink (AssetSink, optional): Where to store the assets. Defaults to the shared blob storage sink.
+        rooms_updated (int, optional): Version of the rooms of the floor (see sync_planner.rooms_updated). Lets a
+            response cache skip the API for the room outlines if unchanged.
+
+    Returns:
+        list: One future per stored asset. The assets are stored in the background, so the next floor can be meshed
+        in the meantime; call sink.flush() to wait for all of them.
+    '''
+    data_floor, data_outlines = fetch_floor(floor_id, updated, rooms_updated)
+
+    hashes = asset_input_hashes(floor_id, data_floor, data_outlines, offset, export_options)
+    removed = []
+    if manifest is not None:
+        # Assets the floor no longer has (e.g. all its interior walls were removed) must not stay in the LOD index
+        removed = manifest.remove_floor(floor_id, keep=hashes)
+
+    include = changed_assets(hashes, None if force else manifest)
+    if len(include) == 0:
+        if len(removed) > 0:
+            manifest.save()
+        return []
+
+    assets = build_floor_assets(floor_id, data_floor, data_outlines, offset, include, export_options)
+
+    futures = store_assets(assets, sink, hashes, manifest)
+
+    if manifest is not None:
+        manifest.save()
+
+    return futures
+
+
+def create_building(building_id: int, manifest: AssetManifest = None, force: bool = False,
+                    export_options: dict = None, sink: AssetSink = None, room_versions: dict = None) -> None:
     '''Creates assets of each floor for a building. Separates outside walls, inside walls, and floors of rooms.
 
     Best way of generating floors as it includes height offset + extra correcting offsets.
 
     Args:
         building_id (int): ID of the building to create.
+        manifest (AssetManifest, optional): Skip floors whose input geometry is unchanged (see create_floor).
+        force (bool, optional): Create all assets, even if they are unchanged according to the manifest.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True}.
+        sink (AssetSink, optional): Where to store the assets (see create_floor).
+        room_versions (dict, optional): Version of the rooms of every floor, see sync_planner.rooms_updated. Fetched
+            if not given; pass it when converting several buildings, so the room list is only fetched once.
     '''
 
     api = API_Requests()
+    if room_versions is None:
+        room_versions = rooms_updated(api.get_workspace())
 
     # Retrieving data from Pythagoras
     # building = api.get_building_id(building_id)
@@ -328,26 +882,71 @@ def create_building(building_id: int) -> None:
 
     # Looping through every possible level code and every floor
     for floor in floors:
-        create_floor(floor['id'])
+        create_floor(floor['id'], updated=floor.get('updated'), manifest=manifest, force=force,
+                     export_options=export_options, sink=sink, rooms_updated=room_versions.get(floor['id']))
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Converts floors from the Pythagoras API into glb assets.')
+    parser.add_argument('--plan', help='Sync plan saved by build_db.py --incremental; only its floors are re-meshed')
+    parser.add_argument('--metrics-out', help='Save per-endpoint API metrics as JSON to this file')
+    parser.add_argument('--force', action='store_true', help='Rebuild all assets, even if their input is unchanged')
+    parser.add_argument('--quantize', action='store_true', help='Write welded, quantized glb files (KHR_mesh_quantization)')
+    parser.add_argument('--tolerance', type=float, default=0.005, help='Maximum position error of quantization in metres')
+    parser.add_argument('--instancing', action='store_true',
+                        help='Store repeated columns once and draw them per instance (EXT_mesh_gpu_instancing)')
+    parser.add_argument('--output-dir', help='Write assets into this directory instead of uploading them')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    parser.add_argument('--upload-workers', type=int, default=8, help='Number of concurrent uploads')
+    args = parser.parse_args()
+
+    if args.output_dir:
+        sink = open_sink(args.output_dir)
+    else:
+        sink = open_sink(connection_string=args.connection_string, max_workers=args.upload_workers)
+    manifest = AssetManifest.for_sink(sink)
+    export_options = {}
+    if args.quantize:
+        export_options.update(quantize=True, tolerance=args.tolerance)
+    if args.instancing:
+        export_options['instancing'] = True
+
     start = time.time()
     # ----------------------------------------------------------------------------------------------
 
-    api = API_Requests()
-    buildings = api.get_building()
-
-    curr_count = 0
-    total_count = len(SOUTH_KEN_LIGHT)
-
-    for building in buildings:
-        if building['name'] in SOUTH_KEN_LIGHT: 
-            create_building(building['id'])
-            print(f"Building {building['id']} done. {curr_count}/{total_count}")
+    if args.plan:
+        plan = SyncPlan.load(args.plan)
+        for floor_id in plan['removed_floors']:
+            manifest.remove_floor(floor_id)
+        for i, floor in enumerate(plan['floors']):
+            create_floor(floor['id'], updated=floor['updated'], manifest=manifest, force=args.force,
+                         export_options=export_options, sink=sink, rooms_updated=floor['roomsUpdated'])
+            print(f"Floor {floor['id']} done. {i + 1}/{len(plan['floors'])}")
+
+    else:
+        api = API_Requests()
+        buildings = api.get_building()
+        room_versions = rooms_updated(api.get_workspace())
+
+        curr_count = 0
+        total_count = len(SOUTH_KEN_LIGHT)
+
+        for building in buildings:
+            if building['name'] in SOUTH_KEN_LIGHT: 
+                create_building(building['id'], manifest, args.force, export_options, sink, room_versions)
+                print(f"Building {building['id']} done. {curr_count}/{total_count}")
+
+    # The index should only list assets that are stored
+    sink.flush()
+    manifest.save()
+    publish_lod_index(manifest, sink)
+    sink.close()
 
     # ----------------------------------------------------------------------------------------------
     end = time.time()
 
     print(f"Time taken: {end - start} seconds")
+    print(metrics.report())
+    if args.metrics_out:
+        metrics.save(args.metrics_out)
@@ -0,0 +1,290 @@
+'''
+
+This module benchmarks the converter on recorded (or synthetic) floor payloads, so changes to the meshing and export
+code can be measured instead of guessed.
+
+Every floor is converted with build_floor_assets (the part of create_floor that does not touch the network) and the
+time is split into stages by wrapping the functions the converter calls:
+
+    - simplify:     merging of walls and cleanup of outlines (see simplify.py), excluding the stages below
+    - polygon:      construction of shapely polygons
+    - triangulate:  trimesh.creation.extrude_polygon
+    - transform:    Trimesh.apply_transform
+    - walls:        build_wall_meshes, excluding the stages above (the vectorized boxes of walls without openings)
+    - shell:        build_shell_mesh, excluding the stages above (union of the footprint)
+    - scene:        assembly of the trimesh Scene
+    - serialize:    Scene.to_glb, i.e. the glb export
+    - other:        everything else (columns, instancing, ...)
+
+Stage times are exclusive (a stage called by another one is only counted once) and the median over all repeats. Peak
+memory is measured in a separate run with tracemalloc, as tracing slows down the conversion. Triangle counts and sizes
+are reported per asset kind (see converter.ASSET_LODS).
+
+Results are saved as JSON and can be compared with an earlier run, e.g. before and after an optimisation:
+
+Usage:
+    python converter_benchmark.py --synthetic 10 40 160 --out baseline.json
+    python converter_benchmark.py --synthetic 10 40 160 --out optimised.json --compare baseline.json
+    python converter_benchmark.py --fixtures fixtures/ --repeat 5 --quantize
+
+Fixtures are recorded from the live API with standin_server.py --record.
+
+'''
+
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import shapely
+import trimesh
+
+from asset_manifest import CONVERTER_VERSION
+from glb import GLBReader
+from standin_server import SyntheticCampus, FixtureCampus
+import converter
+
+
+STAGES = ['simplify', 'polygon', 'triangulate', 'transform', 'walls', 'shell', 'scene', 'serialize', 'other']
+
+
+class StageProfiler:
+
+    def __init__(self) -> None:
+        '''Measures the exclusive wall time of the converter stages (see the module docstring).'''
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._stack = []
+
+    def _wrap(self, stage: str, function):
+        profiler = self
+
+        def wrapper(*args, **kwargs):
+            profiler._stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = profiler._stack.pop()
+                profiler.seconds[stage] += elapsed - children
+                if profiler._stack:
+                    profiler._stack[-1] += elapsed
+
+        return wrapper
+
+    @contextmanager
+    def patched(self):
+        '''Wraps the functions of every stage while the context is active.'''
+        targets = [
+            (converter, 'simplify_floor', 'simplify'),
+            (shapely.geometry, 'Polygon', 'polygon'),
+            (trimesh.creation, 'extrude_polygon', 'triangulate'),
+            (trimesh.base.Trimesh, 'apply_transform', 'transform'),
+            (converter, 'build_wall_meshes', 'walls'),
+            (converter, 'build_shell_mesh', 'shell'),
+            (converter.Scene, '__init__', 'scene'),
+            (converter.Scene, 'to_glb', 'serialize'),
+        ]
+        originals = [(owner, name, getattr(owner, name)) for owner, name, _ in targets]
+        try:
+            for owner, name, stage in targets:
+                setattr(owner, name, self._wrap(stage, getattr(owner, name)))
+            yield self
+        finally:
+            for owner, name, original in originals:
+                setattr(owner, name, original)
+
+    def run(self, function, *args, **kwargs):
+        '''Calls a function with all stages wrapped; the time outside of them is counted as 'other'.'''
+        with self.patched():
+            result = self._wrap('other', function)(*args, **kwargs)
+
+        return result
+
+
+def load_floors(campus) -> list:
+    '''Returns the payloads of all floors of a campus (SyntheticCampus or FixtureCampus).
+
+    Returns:
+        list: (floor_id, floor info, room outlines) of every floor.
+    '''
+    floors = []
+    for building in campus.respond('building', {}) or []:
+        for floor in campus.respond(f'building/{building["id"]}/floor', {}) or []:
+            data_floor = campus.respond(f'floor/{floor["id"]}/info', {})
+            if data_floor is None:
+                continue
+            data_outlines = campus.respond(f'floor/{floor["id"]}/workspace/info', {}) or None
+            floors.append((floor['id'], data_floor, data_outlines))
+
+    return floors
+
+
+def synthetic_cases(room_counts: list) -> dict:
+    '''Returns one floor of a synthetic campus per number of rooms, e.g. {'synthetic_40': (floor_id, ...)}.'''
+    cases = {}
+    for rooms in room_counts:
+        floor_id, data_floor, data_outlines = load_floors(SyntheticCampus(buildings=1, floors=1, rooms=rooms))[0]
+        cases[f'synthetic_{rooms}'] = (floor_id, data_floor, data_outlines)
+
+    return cases
+
+
+def fixture_cases(fixtures_dir: str) -> dict:
+    '''Returns every recorded floor of a fixtures directory, e.g. {'floor_930': (930, ...)}.'''
+    return {f'floor_{floor_id}': (floor_id, data_floor, data_outlines)
+            for floor_id, data_floor, data_outlines in load_floors(FixtureCampus(fixtures_dir))}
+
+
+def count_triangles(glb: bytes) -> int:
+    '''Returns the number of triangles of a glb file.'''
+    with GLBReader(glb) as reader:
+        return reader.triangles()
+
+
+def benchmark_floor(floor_id: int, data_floor: dict, data_outlines: list, repeat: int = 3,
+                    export_options: dict = None) -> dict:
+    '''Converts a floor several times and measures it.
+
+    Args:
+        floor_id (int): ID of the floor.
+        data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info.
+        data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info.
+        repeat (int, optional): Number of timed runs. Times are the median over them.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True}.
+
+    Returns:
+        dict: Size of the input, total and per-stage seconds, peak memory, and triangles and bytes per asset kind.
+    '''
+    args = (floor_id, data_floor, data_outlines, [0,0,0,0], None, export_options)
+
+    runs = []
+    for _ in range(repeat):
+        profiler = StageProfiler()
+        assets = profiler.run(converter.build_floor_assets, *args)
+        runs.append(profiler.seconds)
+
+    tracemalloc.start()
+    converter.build_floor_assets(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    kinds = {converter.asset_info(path)['kind']: data for path, data in assets.items()}
+
+    return {
+        'walls': len(data_floor['wallInfos']),
+        'columns': len(data_floor['columnInfos']),
+        'rooms': len(data_outlines or []),
+        'seconds': statistics.median(sum(run.values()) for run in runs),
+        'stages': {stage: statistics.median(run[stage] for run in runs) for stage in STAGES},
+        'peak_memory_mb': peak / 1e6,
+        'triangles': {kind: count_triangles(data) for kind, data in sorted(kinds.items())},
+        'bytes': {kind: len(data) for kind, data in sorted(kinds.items())},
+    }
+
+
+def run_benchmark(cases: dict, repeat: int = 3, export_options: dict = None) -> dict:
+    '''Benchmarks every case and returns the results in the format saved by the command line.'''
+    results = {
+        'created': int(time.time()),
+        'converter_version': CONVERTER_VERSION,
+        'python': platform.python_version(),
+        'versions': {'numpy': np.__version__, 'shapely': shapely.__version__, 'trimesh': trimesh.__version__},
+        'repeat': repeat,
+        'export_options': export_options or {},
+        'cases': {},
+    }
+
+    for name, (floor_id, data_floor, data_outlines) in cases.items():
+        print(f'Benchmarking {name}')
+        results['cases'][name] = benchmark_floor(floor_id, data_floor, data_outlines, repeat, export_options)
+
+    return results
+
+
+def report(results: dict) -> str:
+    '''Formats the results as a table with one row per case.'''
+    header = f'{"case":<20}{"walls":>7}{"rooms":>7}{"total s":>9}' + ''.join(f'{s[:9]:>10}' for s in STAGES)
+    header += f'{"peak MB":>9}{"triangles":>11}{"bytes":>11}'
+
+    lines = [header]
+    for name, case in results['cases'].items():
+        line = f'{name:<20}{case["walls"]:>7}{case["rooms"]:>7}{case["seconds"]:>9.3f}'
+        line += ''.join(f'{case["stages"][stage]:>10.3f}' for stage in STAGES)
+        line += f'{case["peak_memory_mb"]:>9.1f}{sum(case["triangles"].values()):>11}{sum(case["bytes"].values()):>11}'
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def compare(baseline: dict, results: dict) -> str:
+    '''Formats the relative change of every metric between two runs, for the cases they have in common.'''
+    def change(old, new):
+        return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+    lines = []
+    if baseline['export_options'] != results['export_options']:
+        lines.append(f'Warning: export options differ ({baseline["export_options"]} vs {results["export_options"]})')
+
+    for name, case in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        old = baseline['cases'][name]
+
+        metrics = [('seconds', old['seconds'], case['seconds'])]
+        metrics += [(stage, old['stages'].get(stage, 0.0), case['stages'][stage]) for stage in STAGES]
+        metrics += [('peak_memory_mb', old['peak_memory_mb'], case['peak_memory_mb']),
+                    ('triangles', sum(old['triangles'].values()), sum(case['triangles'].values())),
+                    ('bytes', sum(old['bytes'].values()), sum(case['bytes'].values()))]
+
+        lines.append(name)
+        for metric, old_value, new_value in metrics:
+            lines.append(f'    {metric:<16}{old_value:>12.4g}{new_value:>12.4g}{change(old_value, new_value):>10}')
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the converter on recorded or synthetic floors.')
+    parser.add_argument('--fixtures', help='Directory of recorded API responses (standin_server.py --record)')
+    parser.add_argument('--synthetic', nargs='*', type=int, default=None,
+                        help='Numbers of rooms of synthetic floors (default: 10 40 160 if no fixtures are given)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per floor')
+    parser.add_argument('--out', help='Save the results as JSON to this file')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    parser.add_argument('--quantize', action='store_true', help='Write welded, quantized glb files (KHR_mesh_quantization)')
+    parser.add_argument('--instancing', action='store_true',
+                        help='Store repeated columns once and draw them per instance (EXT_mesh_gpu_instancing)')
+    args = parser.parse_args()
+
+    export_options = {}
+    if args.quantize:
+        export_options['quantize'] = True
+    if args.instancing:
+        export_options['instancing'] = True
+
+    cases = {}
+    if args.fixtures:
+        cases.update(fixture_cases(args.fixtures))
+    if args.synthetic is not None or not args.fixtures:
+        cases.update(synthetic_cases(args.synthetic or [10, 40, 160]))
+
+    if len(cases) == 0:
+        sys.exit('No floors to benchmark')
+
+    results = run_benchmark(cases, args.repeat, export_options)
+    print(report(results))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(json.load(f), results))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,619 @@
+'''
+
+This module contains a small binary glTF (GLB) writer used by the converter instead of the trimesh exporter.
+
+Compared to the trimesh exporter, it writes compact assets:
+    - duplicate vertices are welded,
+    - positions are quantized to int16 (the dequantization is stored in the transform of the root node) and normals to int8, as
+      allowed by the KHR_mesh_quantization extension,
+    - indices use the smallest valid component type (uint8, uint16 or uint32),
+    - repeated meshes can be stored once and drawn per instance (EXT_mesh_gpu_instancing).
+
+StreamingGLBBuilder writes the same files without holding the binary data in memory: every mesh is spooled to disk as
+it is added, so campus-scale scenes can be exported with the memory of their largest mesh.
+
+GLBReader reads the metadata of any GLB file (triangles, bounds, ...) from its JSON chunk and accessors. The file is
+memory-mapped and the binary chunk is never copied, so inspecting large assets is cheap.
+
+All meshes of a file are quantized on one grid spanning their combined bounds. Quantization is only used if the
+resulting position error (half a grid step) is within the given tolerance, otherwise positions are written as float32.
+
+Usage:
+    builder = GLBBuilder(quantization_grid(bounds, tolerance=0.005))
+    builder.add_mesh('walls', mesh)
+    builder.write('floor.glb')
+
+    with StreamingGLBBuilder(grid) as builder:
+        for name, mesh in meshes:
+            builder.add_mesh(name, mesh)
+        builder.write('campus.glb')
+
+    with GLBReader('floor.glb') as glb:
+        print(glb.triangles(), glb.bounds())
+
+'''
+
+import json
+import mmap
+import struct
+import tempfile
+
+import numpy as np
+
+
+# glTF constants
+BYTE = 5120
+UNSIGNED_BYTE = 5121
+SHORT = 5122
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+FLOAT = 5126
+
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+GLB_MAGIC = 0x46546C67
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+
+def _pad(data: bytes, fill: bytes = b'\x00') -> bytes:
+    return data + fill * (-len(data) % 4)
+
+
+def weld(vertices: np.ndarray, faces: np.ndarray, normals: np.ndarray = None, decimals: int = 6) -> tuple:
+    '''Merges duplicate vertices (and drops unreferenced ones).
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex positions.
+        faces (np.ndarray): (m, 3) vertex indices of the triangles.
+        normals (np.ndarray, optional): (n, 3) vertex normals. Vertices are only merged if their normals match too.
+        decimals (int, optional): Positions (and normals) that agree to this many decimals are considered equal.
+
+    Returns:
+        tuple: Welded vertices, faces and normals (None if no normals were given).
+    '''
+    used = np.unique(faces)
+    keys = np.round(vertices[used], decimals)
+    if normals is not None:
+        keys = np.hstack([keys, np.round(normals[used], 3)])
+
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+    remap = np.zeros(len(vertices), dtype=np.int64)
+    remap[used] = inverse.reshape(-1)
+
+    welded_normals = normals[used][first] if normals is not None else None
+
+    return vertices[used][first], remap[faces], welded_normals
+
+
+def index_component_type(vertex_count: int) -> tuple:
+    '''Returns the smallest index component type (and NumPy dtype) for the vertex count.
+
+    The maximum value of a type is reserved (primitive restart), so it cannot be used as an index.
+    '''
+    if vertex_count < 0xFF:
+        return UNSIGNED_BYTE, np.uint8
+    if vertex_count < 0xFFFF:
+        return UNSIGNED_SHORT, np.uint16
+
+    return UNSIGNED_INT, np.uint32
+
+
+def quantization_grid(bounds: np.ndarray, tolerance: float) -> tuple:
+    '''Returns the int16 grid (translation, uniform scale) covering the bounds, or None if it is too coarse.
+
+    Positions are dequantized as position = quantized * scale + translation, so the maximum error is half a step.
+
+    Args:
+        bounds (np.ndarray): (2, 3) minimum and maximum corner of everything that is quantized on the grid.
+        tolerance (float): Maximum position error in metres.
+    '''
+    lo, hi = np.asarray(bounds, dtype=np.float64)
+    translation = np.round((lo + hi) / 2, 6)
+    # The rounded center may be off by up to 5e-7, so the grid has to cover slightly more than the bounds
+    scale = max(float((hi - lo).max() + 2e-6) / (2 * 32767), 1e-9)
+
+    if scale / 2 > tolerance:
+        return None
+
+    return translation, scale
+
+
+class GLBBuilder:
+
+    def __init__(self, quantization: tuple = None, normals: bool = False) -> None:
+        '''Collects meshes and writes them as a GLB file with one node per mesh.
+
+        Accessors of the same kind (e.g. all int16 positions) share one buffer view, which keeps the JSON chunk small
+        for scenes with many small meshes, like the room floors.
+
+        Args:
+            quantization (tuple, optional): Grid from quantization_grid. If given, positions are stored as int16 on the
+                grid and normals as int8 (KHR_mesh_quantization). The mesh nodes are children of
+                a root node that holds the dequantization transform. Otherwise positions are float32.
+            normals (bool, optional): Also write per-vertex normals. Vertices are duplicated along hard edges, so the
+                flat shading of walls is preserved.
+        '''
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'campusapptools'},
+            'scene': 0,
+            'scenes': [{'nodes': [0]}],
+            'nodes': [{'name': 'world', 'children': []}],
+            'meshes': [],
+            'accessors': [],
+            'bufferViews': [],
+            'buffers': [],
+        }
+        self.quantization = quantization
+        self.normals = normals
+        self.views = {} # (target, byte stride) -> index of the buffer view
+        self.view_chunks = [] # data of every buffer view
+        self.view_lengths = []
+        self.extensions = set()
+
+        if quantization is not None:
+            translation, scale = quantization
+            self.gltf['nodes'][0]['translation'] = [float(v) for v in translation]
+            self.gltf['nodes'][0]['scale'] = [scale] * 3
+            self.extensions.add('KHR_mesh_quantization')
+
+    def buffer_view(self, target: int = None, byte_stride: int = None) -> int:
+        '''Returns the index of the buffer view for data with the given target and stride, creating it if needed.'''
+        key = (target, byte_stride)
+        if key not in self.views:
+            view = {'buffer': 0}
+            if target is not None:
+                view['target'] = target
+            if byte_stride is not None:
+                view['byteStride'] = byte_stride
+
+            self.gltf['bufferViews'].append(view)
+            self.view_chunks.append([])
+            self.view_lengths.append(0)
+            self.views[key] = len(self.gltf['bufferViews']) - 1
+
+        return self.views[key]
+
+    def append(self, view: int, data: bytes) -> int:
+        '''Appends data (4-byte aligned) to a buffer view and returns its offset within the view.'''
+        offset = self.view_lengths[view]
+        data = _pad(data)
+        self.view_chunks[view].append(data)
+        self.view_lengths[view] += len(data)
+
+        return offset
+
+    def add_accessor(self, array: np.ndarray, component_type: int, accessor_type: str, target: int = None,
+                     normalized: bool = False, min_max: bool = False) -> int:
+        '''Writes an array into the buffer view of its kind and returns the index of the accessor.
+
+        Vertex attributes with elements that are not a multiple of 4 bytes (e.g. int16 VEC3) are padded, as glTF
+        requires a 4-byte aligned stride.
+        '''
+        array = np.ascontiguousarray(array)
+        count = len(array)
+        byte_stride = None
+
+        if target == ARRAY_BUFFER:
+            element_size = array.itemsize * array.shape[1]
+            if element_size % 4 != 0:
+                padded = np.zeros((count, array.shape[1] + (-element_size % 4) // array.itemsize), dtype=array.dtype)
+                padded[:, :array.shape[1]] = array
+                array = padded
+            byte_stride = array.itemsize * array.shape[1]
+
+        view = self.buffer_view(target, byte_stride)
+        accessor = {
+            'bufferView': view,
+            'byteOffset': self.append(view, array.tobytes()),
+            'componentType': component_type,
+            'count': count,
+            'type': accessor_type,
+        }
+        if normalized:
+            accessor['normalized'] = True
+        if min_max:
+            values = array[:, :3] if accessor_type == 'VEC3' else array.reshape(count, -1)
+            cast = float if component_type == FLOAT else int
+            accessor['min'] = [cast(v) for v in values.min(axis=0)]
+            accessor['max'] = [cast(v) for v in values.max(axis=0)]
+
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_primitive(self, name: str, mesh, quantize: bool) -> int:
+        '''Writes the vertices and faces of a mesh and returns the index of the glTF mesh.'''
+        vertices = np.asarray(mesh.vertices, dtype=np.float64)
+        faces = np.asarray(mesh.faces, dtype=np.int64)
+        vertex_normals = None
+
+        if self.normals:
+            # Flat shading: every corner of a triangle gets the normal of the triangle
+            vertex_normals = np.repeat(np.asarray(mesh.face_normals, dtype=np.float64), 3, axis=0)
+            vertices = vertices[faces.reshape(-1)]
+            faces = np.arange(len(vertices)).reshape(-1, 3)
+
+        vertices, faces, vertex_normals = weld(vertices, faces, vertex_normals)
+        attributes = {}
+
+        if quantize:
+            translation, scale = self.quantization
+            quantized = np.round((vertices - translation) / scale).astype(np.int16)
+            attributes['POSITION'] = self.add_accessor(quantized, SHORT, 'VEC3', ARRAY_BUFFER, min_max=True)
+            if vertex_normals is not None:
+                attributes['NORMAL'] = self.add_accessor(np.round(vertex_normals * 127).astype(np.int8), BYTE, 'VEC3',
+                                                         ARRAY_BUFFER, normalized=True)
+        else:
+            attributes['POSITION'] = self.add_accessor(vertices.astype(np.float32), FLOAT, 'VEC3', ARRAY_BUFFER,
+                                                       min_max=True)
+            if vertex_normals is not None:
+                attributes['NORMAL'] = self.add_accessor(vertex_normals.astype(np.float32), FLOAT, 'VEC3', ARRAY_BUFFER)
+
+        component_type, dtype = index_component_type(len(vertices))
+        indices = self.add_accessor(faces.reshape(-1).astype(dtype), component_type, 'SCALAR', ELEMENT_ARRAY_BUFFER)
+
+        self.gltf['meshes'].append({'name': name, 'primitives': [{'attributes': attributes, 'indices': indices}]})
+        return len(self.gltf['meshes']) - 1
+
+    def add_mesh(self, name: str, mesh, node: dict = None) -> int:
+        '''Adds a mesh and a node referencing it.
+
+        Args:
+            name (str): Name of the mesh and its node.
+            mesh (trimesh.Trimesh): Mesh to add. With quantization, it has to lie within the bounds of the grid.
+            node (dict, optional): Additional properties of the node (e.g. extensions).
+
+        Returns:
+            int: Index of the node.
+        '''
+        node = dict(node or {}, name=name, mesh=self.add_primitive(name, mesh, self.quantization is not None))
+        self.gltf['nodes'].append(node)
+        self.gltf['nodes'][0]['children'].append(len(self.gltf['nodes']) - 1)
+
+        return len(self.gltf['nodes']) - 1
+
+    def add_instanced_mesh(self, name: str, mesh, translations: np.ndarray, rotations: np.ndarray) -> int:
+        '''Adds a mesh that is drawn once per instance, using EXT_mesh_gpu_instancing.
+
+        The node is a direct child of the scene (not of the quantized root node), so the instance transforms are in
+        world coordinates. The positions of the mesh itself are not quantized; it is only stored once anyway.
+
+        Args:
+            name (str): Name of the mesh and its node.
+            mesh (trimesh.Trimesh): Mesh of a single instance, in its local coordinates.
+            translations (np.ndarray): (n, 3) translation of every instance.
+            rotations (np.ndarray): (n, 4) rotation of every instance as a unit quaternion (x, y, z, w).
+
+        Returns:
+            int: Index of the node.
+        '''
+        attributes = {
+            'TRANSLATION': self.add_accessor(np.asarray(translations, dtype=np.float32), FLOAT, 'VEC3'),
+            'ROTATION': self.add_accessor(np.asarray(rotations, dtype=np.float32), FLOAT, 'VEC4'),
+        }
+        node = {
+            'name': name,
+            'mesh': self.add_primitive(name, mesh, False),
+            'extensions': {'EXT_mesh_gpu_instancing': {'attributes': attributes}},
+        }
+        self.extensions.add('EXT_mesh_gpu_instancing')
+
+        self.gltf['nodes'].append(node)
+        self.gltf['scenes'][0]['nodes'].append(len(self.gltf['nodes']) - 1)
+
+        return len(self.gltf['nodes']) - 1
+
+    def json_chunk(self) -> bytes:
+        gltf = dict(self.gltf)
+
+        byte_length = 0
+        for view, length in zip(gltf['bufferViews'], self.view_lengths):
+            view['byteOffset'] = byte_length
+            view['byteLength'] = length
+            byte_length += length
+        gltf['buffers'] = [{'byteLength': byte_length}] if byte_length > 0 else []
+
+        if len(self.extensions) > 0:
+            gltf['extensionsUsed'] = sorted(self.extensions)
+            # Quantized attributes cannot be read without the extension, and without instancing only one instance
+            # would be drawn
+            required = sorted(self.extensions & {'KHR_mesh_quantization', 'EXT_mesh_gpu_instancing'})
+            if required:
+                gltf['extensionsRequired'] = required
+
+        return _pad(json.dumps(gltf, separators=(',', ':')).encode(), b' ')
+
+    def bin_chunks(self):
+        '''Yields the content of the binary chunk in pieces, in the order of the buffer views.'''
+        for chunks in self.view_chunks:
+            yield from chunks
+
+    def header(self) -> bytes:
+        '''Returns everything before the content of the binary chunk: the GLB header, the JSON chunk and the header of
+        the binary chunk.'''
+        json_chunk = self.json_chunk()
+        bin_length = sum(self.view_lengths)
+
+        length = 12 + 8 + len(json_chunk) + (8 + bin_length if bin_length else 0)
+        parts = [struct.pack('<III', GLB_MAGIC, 2, length), struct.pack('<II', len(json_chunk), CHUNK_JSON), json_chunk]
+        if bin_length:
+            parts.append(struct.pack('<II', bin_length, CHUNK_BIN))
+
+        return b''.join(parts)
+
+    def write_to(self, stream) -> int:
+        '''Writes the GLB file to a binary stream (e.g. an open file) and returns the number of bytes written.'''
+        size = stream.write(self.header())
+        for data in self.bin_chunks():
+            size += stream.write(data)
+
+        return size
+
+    def to_bytes(self) -> bytes:
+        return self.header() + b''.join(self.bin_chunks())
+
+    def write(self, filename: str) -> int:
+        with open(filename, 'wb') as f:
+            return self.write_to(f)
+
+
+class StreamingGLBBuilder(GLBBuilder):
+
+    def __init__(self, quantization: tuple = None, normals: bool = False, spool_dir: str = None,
+                 block_size: int = 1 << 16) -> None:
+        '''A GLBBuilder that spools the data of every buffer view to a temporary file as meshes are added.
+
+        The JSON chunk has to precede the binary chunk but is only known once all meshes are added, so the binary data
+        is kept on disk until the file is written. Memory is then bounded by the largest single mesh (plus the JSON),
+        not by the whole scene. The output is identical to that of GLBBuilder.
+
+        As the grid has to be known before the first mesh is written, quantization needs the bounds of the whole scene
+        up front (see quantization_grid).
+
+        Args:
+            quantization (tuple, optional): Grid from quantization_grid, see GLBBuilder.
+            normals (bool, optional): Also write per-vertex normals, see GLBBuilder.
+            spool_dir (str, optional): Directory of the temporary files. Defaults to the system temporary directory.
+            block_size (int, optional): Size of the blocks the spooled data is copied in when writing.
+        '''
+        super().__init__(quantization, normals)
+        self.spool_dir = spool_dir
+        self.block_size = block_size
+        self.spools = {} # index of the buffer view -> temporary file
+
+    def append(self, view: int, data: bytes) -> int:
+        if view not in self.spools:
+            self.spools[view] = tempfile.TemporaryFile(dir=self.spool_dir)
+
+        offset = self.view_lengths[view]
+        data = _pad(data)
+        self.spools[view].write(data)
+        self.view_lengths[view] += len(data)
+
+        return offset
+
+    def bin_chunks(self):
+        for view in range(len(self.view_lengths)):
+            if view not in self.spools:
+                continue
+
+            spool = self.spools[view]
+            spool.seek(0)
+            while True:
+                data = spool.read(self.block_size)
+                if not data:
+                    break
+                yield data
+
+    def close(self) -> None:
+        '''Deletes the temporary files.'''
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+# Number of components per accessor type
+ACCESSOR_SIZES = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT2': 4, 'MAT3': 9, 'MAT4': 16}
+
+COMPONENT_DTYPES = {BYTE: np.int8, UNSIGNED_BYTE: np.uint8, SHORT: np.int16, UNSIGNED_SHORT: np.uint16,
+                    UNSIGNED_INT: np.uint32, FLOAT: np.float32}
+
+
+def _node_matrix(node: dict) -> np.ndarray:
+    '''Returns the local 4x4 transform of a node (from its matrix or translation/rotation/scale).'''
+    if 'matrix' in node:
+        return np.array(node['matrix'], dtype=np.float64).reshape(4, 4).T # glTF matrices are column-major
+
+    matrix = np.eye(4)
+    x, y, z, w = node.get('rotation', [0, 0, 0, 1])
+    matrix[:3, :3] = [
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ]
+    matrix[:3, :3] *= np.array(node.get('scale', [1, 1, 1]))[None, :]
+    matrix[:3, 3] = node.get('translation', [0, 0, 0])
+
+    return matrix
+
+
+def _quaternion_matrices(rotations: np.ndarray) -> np.ndarray:
+    '''Returns the (n, 3, 3) rotation matrices of (n, 4) unit quaternions (x, y, z, w).'''
+    x, y, z, w = np.asarray(rotations, dtype=np.float64).T
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=1),
+    ], axis=1)
+
+
+class GLBReader:
+
+    def __init__(self, source) -> None:
+        '''Reads a GLB file without copying its binary chunk.
+
+        Args:
+            source (str or bytes-like): Path of the file, which is memory-mapped, or its content (e.g. the bytes
+                returned by GLBBuilder.to_bytes).
+        '''
+        self._file = None
+        self._mmap = None
+
+        if isinstance(source, str) or hasattr(source, '__fspath__'):
+            self._file = open(source, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._mmap)
+        else:
+            self.data = memoryview(source)
+
+        magic, version, length = struct.unpack_from('<III', self.data, 0)
+        if magic != GLB_MAGIC:
+            raise ValueError('Not a GLB file')
+        if version != 2:
+            raise ValueError(f'Unsupported glTF version {version}')
+        self.length = length
+
+        json_length, chunk_type = struct.unpack_from('<II', self.data, 12)
+        if chunk_type != CHUNK_JSON:
+            raise ValueError('The first chunk of a GLB file must be JSON')
+        self.gltf = json.loads(bytes(self.data[20:20 + json_length]))
+
+        self.bin = None
+        offset = 20 + json_length
+        if offset + 8 <= length:
+            bin_length, chunk_type = struct.unpack_from('<II', self.data, offset)
+            if chunk_type == CHUNK_BIN:
+                self.bin = self.data[offset + 8:offset + 8 + bin_length]
+
+    def accessor(self, index: int) -> np.ndarray:
+        '''Returns the data of an accessor as a read-only view into the binary chunk (valid while the reader is
+        open). Sparse accessors are not supported.'''
+        accessor = self.gltf['accessors'][index]
+        dtype = np.dtype(COMPONENT_DTYPES[accessor['componentType']])
+        components = ACCESSOR_SIZES[accessor['type']]
+
+        if 'bufferView' not in accessor:
+            return np.zeros((accessor['count'], components), dtype=dtype)
+
+        view = self.gltf['bufferViews'][accessor['bufferView']]
+        if view.get('buffer', 0) != 0 or self.bin is None:
+            raise ValueError('Only the binary chunk of the GLB file is supported as buffer')
+
+        stride = view.get('byteStride', dtype.itemsize * components)
+        offset = view.get('byteOffset', 0) + accessor.get('byteOffset', 0)
+
+        return np.ndarray((accessor['count'], components), dtype=dtype, buffer=self.bin, offset=offset,
+                          strides=(stride, dtype.itemsize))
+
+    def position_bounds(self, index: int) -> np.ndarray:
+        '''Returns the (2, 3) bounds of a POSITION accessor, from its min/max if present.'''
+        accessor = self.gltf['accessors'][index]
+        if 'min' in accessor and 'max' in accessor:
+            bounds = np.array([accessor['min'][:3], accessor['max'][:3]], dtype=np.float64)
+        else:
+            values = self.accessor(index)[:, :3]
+            bounds = np.array([values.min(axis=0), values.max(axis=0)], dtype=np.float64)
+
+        if accessor.get('normalized'):
+            dtype = COMPONENT_DTYPES[accessor['componentType']]
+            bounds = np.maximum(bounds / np.iinfo(dtype).max, -1)
+
+        return bounds
+
+    def mesh_nodes(self):
+        '''Yields every node of the default scene that has a mesh, with its world transform.'''
+        nodes = self.gltf.get('nodes', [])
+        scenes = self.gltf.get('scenes', [])
+        roots = scenes[self.gltf.get('scene', 0)]['nodes'] if scenes else range(len(nodes))
+
+        stack = [(index, np.eye(4)) for index in roots]
+        while stack:
+            index, parent = stack.pop()
+            node = nodes[index]
+            matrix = parent @ _node_matrix(node)
+            if 'mesh' in node:
+                yield node, matrix
+            stack += [(child, matrix) for child in node.get('children', [])]
+
+    def instance_matrices(self, node: dict) -> np.ndarray:
+        '''Returns the (n, 4, 4) local transforms of the instances of a node (EXT_mesh_gpu_instancing), or None.'''
+        attributes = node.get('extensions', {}).get('EXT_mesh_gpu_instancing', {}).get('attributes')
+        if not attributes:
+            return None
+
+        count = self.gltf['accessors'][next(iter(attributes.values()))]['count']
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        if 'ROTATION' in attributes:
+            matrices[:, :3, :3] = _quaternion_matrices(self.accessor(attributes['ROTATION']))
+        if 'SCALE' in attributes:
+            matrices[:, :3, :3] *= np.asarray(self.accessor(attributes['SCALE']), dtype=np.float64)[:, None, :]
+        if 'TRANSLATION' in attributes:
+            matrices[:, :3, 3] = self.accessor(attributes['TRANSLATION'])
+
+        return matrices
+
+    def triangles(self) -> int:
+        '''Returns the number of triangles that are drawn (instanced meshes count once per instance).'''
+        total = 0
+        for node, _ in self.mesh_nodes():
+            instances = self.instance_matrices(node)
+            for primitive in self.gltf['meshes'][node['mesh']]['primitives']:
+                if 'indices' in primitive:
+                    count = self.gltf['accessors'][primitive['indices']]['count']
+                else:
+                    count = self.gltf['accessors'][primitive['attributes']['POSITION']]['count']
+
+                mode = primitive.get('mode', 4)
+                triangles = count // 3 if mode == 4 else max(count - 2, 0) if mode in (5, 6) else 0
+                total += triangles * (len(instances) if instances is not None else 1)
+
+        return total
+
+    def bounds(self) -> np.ndarray:
+        '''Returns the (2, 3) bounds of the scene in world coordinates, or None if it has no geometry.
+
+        The bounds of every primitive (from the min/max of its positions) are transformed as boxes, so for rotated
+        nodes they may be slightly larger than the tight bounds.
+        '''
+        corners = []
+        for node, matrix in self.mesh_nodes():
+            instances = self.instance_matrices(node)
+            matrices = matrix[None] @ instances if instances is not None else matrix[None]
+
+            for primitive in self.gltf['meshes'][node['mesh']]['primitives']:
+                if 'POSITION' not in primitive['attributes']:
+                    continue
+                lo, hi = self.position_bounds(primitive['attributes']['POSITION'])
+                box = np.array([[x, y, z, 1] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+                corners.append((matrices @ box.T).transpose(0, 2, 1)[:, :, :3].reshape(-1, 3))
+
+        if len(corners) == 0:
+            return None
+
+        corners = np.concatenate(corners)
+        return np.array([corners.min(axis=0), corners.max(axis=0)])
+
+    def close(self) -> None:
+        self.bin = None
+        try:
+            self.data.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass # Views returned by accessor() are still in use; the mapping is closed when they are released
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
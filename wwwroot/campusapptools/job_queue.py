@@ -0,0 +1,633 @@
+'''
+
+This module contains a persistent job queue for the converter, so a conversion run survives crashes and can be spread
+over several workers and machines.
+
+Every floor is one job in a single SQLite file. A worker leases jobs for a limited time, converts them and marks them
+done (or failed, with the error). If a worker dies, its leases expire and the jobs are handed to another worker. A
+failed job is retried until it has been attempted max_attempts times, then it stays failed until it is retried
+explicitly. Restarting an interrupted run only converts the jobs that are not done yet.
+
+Jobs are enqueued with the `updated` timestamp of their floor and the version of its rooms (see
+sync_planner.rooms_updated). Enqueuing a floor again only resets its job if the floor or its rooms changed since, so the
+same queue can be reused for the next run. Workers pass both on to the response cache.
+
+Workers on the same machine can share the file directly (SQLite serializes them). Workers on other machines go through
+a small HTTP front end of the queue (--serve) with RemoteJobQueue, which has the same interface as JobQueue.
+
+The asset manifest of the workers (see asset_manifest.py) is kept in the queue as well: a worker gets the entries of a
+floor with its job and sends the entries of the stored assets back when it completes the job, so workers on different
+machines skip unchanged assets alike and never overwrite each other's entries. The LOD index of all floors is published
+once by the owner of the queue file (--publish), after the queue is drained. A queue describes the assets of one
+destination, so all of its workers must store them in the same sink.
+
+Usage:
+    python job_queue.py --enqueue --buildings BLACKETT HUXLEY       # or --plan sync_plan.json
+    python job_queue.py --work --output-dir out/                    # run any number of these
+    python job_queue.py --status
+    python job_queue.py --retry-failed
+
+    python job_queue.py --serve --port 8766                         # on the machine with the queue
+    python job_queue.py --work --remote http://queue-host:8766      # on any other machine
+
+    python job_queue.py --publish --output-dir out/                 # on the machine with the queue, once drained
+
+'''
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from api_requests import API_Requests
+from api_metrics import metrics
+from sync_planner import SyncPlan, rooms_updated
+from asset_manifest import AssetManifest
+from asset_sink import AssetSink, open_sink
+import converter
+
+
+DEFAULT_QUEUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversion_jobs.db')
+
+JOB_COLUMNS = ['floor_id', 'building_id', 'updated', 'rooms_updated', 'status', 'attempts', 'worker', 'lease_expires',
+               'enqueued_at', 'started_at', 'finished_at', 'seconds', 'assets', 'error']
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+class JobQueue:
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, max_attempts: int = 3) -> None:
+        '''Opens (or creates) a job queue.
+
+        Args:
+            path (str, optional): Path of the SQLite file.
+            max_attempts (int, optional): Number of times a job is attempted before it is marked as failed.
+        '''
+        self.path = path
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        # Autocommit mode: transactions are started explicitly, so leasing can take the write lock up front
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute(
+            '''
+            create table if not exists jobs (
+                floor_id bigint primary key,
+                building_id bigint,
+                updated bigint,
+                rooms_updated bigint,
+                status varchar(16),
+                attempts int,
+                worker text,
+                lease_expires float,
+                enqueued_at float,
+                started_at float,
+                finished_at float,
+                seconds float,
+                assets int,
+                error text
+            );
+            '''
+        )
+        self._conn.execute('create index if not exists jobs_status on jobs(status, lease_expires);')
+        self._conn.execute(
+            '''
+            create table if not exists manifest (
+                asset_path text primary key,
+                floor_id bigint,
+                entry text
+            );
+            '''
+        )
+        self._conn.execute('create index if not exists manifest_floor on manifest(floor_id);')
+        if 'rooms_updated' not in {row[1] for row in self._conn.execute('pragma table_info(jobs)')}:
+            # Queue files of earlier versions
+            self._conn.execute('alter table jobs add column rooms_updated bigint')
+
+    def _rows(self, cursor) -> list:
+        return [dict(zip(JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def enqueue(self, floors: list, building_id: int = None) -> int:
+        '''Adds a job for every floor. Jobs of floors that are already queued are only reset if the floor changed.
+
+        Args:
+            floors (list): Floor ids or records with 'id' (and optionally 'updated', 'roomsUpdated' and 'buildingId').
+            building_id (int, optional): Building of the floors, if the records do not have it.
+
+        Returns:
+            int: Number of jobs that were added or reset.
+        '''
+        floors = [floor if isinstance(floor, dict) else {'id': floor} for floor in floors]
+        rows = [(floor['id'], floor.get('buildingId', building_id), floor.get('updated'), floor.get('roomsUpdated'),
+                 time.time()) for floor in floors]
+
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('begin immediate')
+            try:
+                self._conn.executemany(
+                    '''
+                    insert into jobs (floor_id, building_id, updated, rooms_updated, status, attempts, enqueued_at)
+                    values (?, ?, ?, ?, 'pending', 0, ?)
+                    on conflict(floor_id) do update set
+                        building_id=excluded.building_id, updated=excluded.updated,
+                        rooms_updated=excluded.rooms_updated, status='pending', attempts=0, worker=null,
+                        lease_expires=null, error=null, enqueued_at=excluded.enqueued_at
+                    where jobs.updated is not excluded.updated or jobs.rooms_updated is not excluded.rooms_updated
+                        or excluded.updated is null
+                    ''',
+                    rows,
+                )
+                self._conn.execute('commit')
+            except Exception:
+                self._conn.execute('rollback')
+                raise
+
+            return self._conn.total_changes - before
+
+    def lease(self, worker: str, count: int = 1, lease_seconds: float = 600) -> list:
+        '''Leases pending jobs (and jobs whose lease expired) to a worker.
+
+        Args:
+            worker (str): ID of the worker.
+            count (int, optional): Maximum number of jobs to lease.
+            lease_seconds (float, optional): Time after which the jobs are handed to other workers, unless the lease
+                is extended with heartbeat.
+
+        Returns:
+            list: The leased jobs (empty if there is nothing left to do).
+        '''
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute('begin immediate')
+            try:
+                # Workers that died while holding a job count as an attempt
+                self._conn.execute(
+                    '''
+                    update jobs set status='failed', worker=null, lease_expires=null,
+                        error=coalesce(error || char(10), '') || 'lease of ' || worker || ' expired'
+                    where status='leased' and lease_expires < ? and attempts >= ?
+                    ''',
+                    (now, self.max_attempts),
+                )
+                jobs = self._rows(self._conn.execute(
+                    f'''
+                    select {", ".join(JOB_COLUMNS)} from jobs
+                    where status='pending' or (status='leased' and lease_expires < ?)
+                    order by building_id, floor_id limit ?
+                    ''',
+                    (now, count),
+                ))
+                self._conn.executemany(
+                    '''
+                    update jobs set status='leased', worker=?, lease_expires=?, attempts=attempts + 1, started_at=?
+                    where floor_id=?
+                    ''',
+                    [(worker, now + lease_seconds, now, job['floor_id']) for job in jobs],
+                )
+                self._conn.execute('commit')
+            except Exception:
+                self._conn.execute('rollback')
+                raise
+
+        for job in jobs:
+            job.update(status='leased', worker=worker, lease_expires=now + lease_seconds, attempts=job['attempts'] + 1,
+                       started_at=now)
+
+        return jobs
+
+    def heartbeat(self, floor_id: int, worker: str, lease_seconds: float = 600) -> bool:
+        '''Extends the lease of a job. Returns False if the worker no longer holds it.'''
+        with self._lock:
+            cursor = self._conn.execute(
+                "update jobs set lease_expires=? where floor_id=? and worker=? and status='leased'",
+                (time.time() + lease_seconds, floor_id, worker),
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, floor_id: int, worker: str, seconds: float = None, assets: int = None,
+                 entries: dict = None) -> bool:
+        '''Marks a job as done. Returns False if the worker no longer held it (e.g. its lease expired).
+
+        Args:
+            floor_id (int): ID of the floor of the job.
+            worker (str): ID of the worker.
+            seconds (float, optional): Time the job took.
+            assets (int, optional): Number of assets stored.
+            entries (dict, optional): Manifest entries of all assets the floor has now, by asset path. They replace
+                the entries of the floor in the same transaction, and only if the worker still held the job.
+        '''
+        with self._lock:
+            self._conn.execute('begin immediate')
+            try:
+                cursor = self._conn.execute(
+                    '''
+                    update jobs set status='done', lease_expires=null, finished_at=?, seconds=?, assets=?, error=null
+                    where floor_id=? and worker=? and status='leased'
+                    ''',
+                    (time.time(), seconds, assets, floor_id, worker),
+                )
+                done = cursor.rowcount > 0
+                if done and entries is not None:
+                    self._conn.execute('delete from manifest where floor_id=?', (floor_id,))
+                    self._conn.executemany(
+                        'insert or replace into manifest (asset_path, floor_id, entry) values (?, ?, ?)',
+                        [(asset_path, floor_id, json.dumps(entry)) for asset_path, entry in entries.items()],
+                    )
+                self._conn.execute('commit')
+            except Exception:
+                self._conn.execute('rollback')
+                raise
+
+            return done
+
+    def fail(self, floor_id: int, worker: str, error: str, seconds: float = None) -> bool:
+        '''Records a failed attempt. The job is retried, unless it has been attempted max_attempts times.
+
+        Returns:
+            bool: False if the worker no longer held the job.
+        '''
+        with self._lock:
+            cursor = self._conn.execute(
+                '''
+                update jobs set status=case when attempts >= ? then 'failed' else 'pending' end,
+                    lease_expires=null, finished_at=?, seconds=?, error=?
+                where floor_id=? and worker=? and status='leased'
+                ''',
+                (self.max_attempts, time.time(), seconds, error, floor_id, worker),
+            )
+            return cursor.rowcount > 0
+
+    def manifest_entries(self, floor_id: int = None) -> dict:
+        '''Returns the manifest entries of the assets of a floor (or of all floors) by asset path.'''
+        with self._lock:
+            if floor_id is None:
+                rows = self._conn.execute('select asset_path, entry from manifest').fetchall()
+            else:
+                rows = self._conn.execute('select asset_path, entry from manifest where floor_id=?',
+                                          (floor_id,)).fetchall()
+
+        return {asset_path: json.loads(entry) for asset_path, entry in rows}
+
+    def remove_floors(self, floor_ids: list) -> int:
+        '''Removes the jobs and manifest entries of floors, e.g. of floors removed upstream. Returns their number.'''
+        rows = [(floor_id,) for floor_id in floor_ids]
+
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('begin immediate')
+            try:
+                self._conn.executemany('delete from jobs where floor_id=?', rows)
+                self._conn.executemany('delete from manifest where floor_id=?', rows)
+                self._conn.execute('commit')
+            except Exception:
+                self._conn.execute('rollback')
+                raise
+
+            return self._conn.total_changes - before
+
+    def retry_failed(self) -> int:
+        '''Resets all failed jobs, so they are attempted max_attempts times again. Returns their number.'''
+        with self._lock:
+            cursor = self._conn.execute("update jobs set status='pending', attempts=0 where status='failed'")
+            return cursor.rowcount
+
+    def counts(self) -> dict:
+        '''Returns the number of jobs by status (expired leases are counted as pending).'''
+        with self._lock:
+            rows = self._conn.execute(
+                '''
+                select case when status='leased' and lease_expires < ? then 'pending' else status end, count(*)
+                from jobs group by 1
+                ''',
+                (time.time(),),
+            ).fetchall()
+
+        return dict(rows)
+
+    def jobs(self, status: str = None) -> list:
+        '''Returns all jobs, or the jobs with the given status.'''
+        with self._lock:
+            if status is None:
+                cursor = self._conn.execute(f'select {", ".join(JOB_COLUMNS)} from jobs order by floor_id')
+            else:
+                cursor = self._conn.execute(f'select {", ".join(JOB_COLUMNS)} from jobs where status=? '
+                                            'order by floor_id', (status,))
+            return self._rows(cursor)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RemoteJobQueue:
+
+    def __init__(self, url: str, timeout: float = 30) -> None:
+        '''Accesses a job queue served by serve_queue, with the interface of JobQueue.
+
+        Args:
+            url (str): URL of the queue server, e.g. 'http://queue-host:8766'.
+            timeout (float, optional): Timeout of every request in seconds.
+        '''
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _call(self, method: str, **kwargs):
+        response = self.session.post(f'{self.url}/{method}', json=kwargs, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def enqueue(self, floors: list, building_id: int = None) -> int:
+        return self._call('enqueue', floors=floors, building_id=building_id)
+
+    def lease(self, worker: str, count: int = 1, lease_seconds: float = 600) -> list:
+        return self._call('lease', worker=worker, count=count, lease_seconds=lease_seconds)
+
+    def heartbeat(self, floor_id: int, worker: str, lease_seconds: float = 600) -> bool:
+        return self._call('heartbeat', floor_id=floor_id, worker=worker, lease_seconds=lease_seconds)
+
+    def complete(self, floor_id: int, worker: str, seconds: float = None, assets: int = None,
+                 entries: dict = None) -> bool:
+        return self._call('complete', floor_id=floor_id, worker=worker, seconds=seconds, assets=assets,
+                          entries=entries)
+
+    def fail(self, floor_id: int, worker: str, error: str, seconds: float = None) -> bool:
+        return self._call('fail', floor_id=floor_id, worker=worker, error=error, seconds=seconds)
+
+    def manifest_entries(self, floor_id: int = None) -> dict:
+        return self._call('manifest_entries', floor_id=floor_id)
+
+    def remove_floors(self, floor_ids: list) -> int:
+        return self._call('remove_floors', floor_ids=floor_ids)
+
+    def retry_failed(self) -> int:
+        return self._call('retry_failed')
+
+    def counts(self) -> dict:
+        return self._call('counts')
+
+    def jobs(self, status: str = None) -> list:
+        return self._call('jobs', status=status)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+# Methods of JobQueue that can be called through the HTTP front end
+REMOTE_METHODS = {'enqueue', 'lease', 'heartbeat', 'complete', 'fail', 'manifest_entries', 'remove_floors',
+                  'retry_failed', 'counts', 'jobs'}
+
+
+class _QueueHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        method = self.path.strip('/')
+        if method not in REMOTE_METHODS:
+            return self._send(404, {'error': f'unknown method {method}'})
+
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            result = getattr(self.server.queue, method)(**kwargs)
+        except Exception as e:
+            return self._send(500, {'error': repr(e)})
+
+        self._send(200, result)
+
+    def _send(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_queue(queue: JobQueue, host: str = '127.0.0.1', port: int = 8766) -> ThreadingHTTPServer:
+    '''Creates an HTTP server for remote workers (see RemoteJobQueue). Call serve_forever() on it to start serving.
+
+    The front end has no authentication, so it only listens locally by default. Bind it to another interface (e.g.
+    '0.0.0.0') only on a network restricted to the workers.
+    '''
+    server = ThreadingHTTPServer((host, port), _QueueHandler)
+    server.queue = queue
+
+    return server
+
+
+class _Heartbeat:
+
+    def __init__(self, queue, floor_id: int, worker: str, lease_seconds: float) -> None:
+        '''Extends the lease of a job in the background while it is being converted.
+
+        Stops once the lease is lost (heartbeat returns False, e.g. it expired and another worker took the job over).
+        '''
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self._run, args=(queue, floor_id, worker, lease_seconds), daemon=True)
+
+    def _run(self, queue, floor_id, worker, lease_seconds):
+        while not self.stopped.wait(lease_seconds / 3):
+            try:
+                if not queue.heartbeat(floor_id, worker, lease_seconds):
+                    self.lost = True
+                    return
+            except Exception:
+                pass # The next heartbeat may get through; otherwise the lease expires and the job is retried
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(queue, sink: AssetSink = None, force: bool = False, export_options: dict = None, worker: str = None,
+               lease_seconds: float = 600, max_jobs: int = None) -> dict:
+    '''Converts jobs of a queue until it is drained.
+
+    Assets whose input geometry is unchanged according to the manifest entries kept in the queue are skipped (see
+    converter.create_floor). A job is only marked done once all of its assets are stored, together with their entries,
+    so a crash never loses assets of a finished job. A job whose lease was taken over by another worker is left to
+    that worker, and so are its entries.
+
+    Args:
+        queue (JobQueue or RemoteJobQueue): Queue to drain.
+        sink (AssetSink, optional): Where to store the assets. Defaults to the shared blob storage sink.
+        force (bool, optional): Create all assets, even if they are unchanged according to the manifest.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True}.
+        worker (str, optional): ID of the worker. Defaults to host name, process id and a random suffix.
+        lease_seconds (float, optional): Duration of a lease. It is extended while the job runs.
+        max_jobs (int, optional): Stop after this many jobs.
+
+    Returns:
+        dict: Number of jobs that were done and failed by this worker, and of jobs whose lease it lost.
+    '''
+    worker = worker or default_worker_id()
+    sink = sink or converter.default_sink()
+    stats = {'done': 0, 'failed': 0, 'lost': 0}
+
+    while max_jobs is None or sum(stats.values()) < max_jobs:
+        jobs = queue.lease(worker, 1, lease_seconds)
+        if len(jobs) == 0:
+            break
+        job = jobs[0]
+
+        start = time.perf_counter()
+        with _Heartbeat(queue, job['floor_id'], worker, lease_seconds):
+            try:
+                manifest = AssetManifest(assets=queue.manifest_entries(job['floor_id']))
+                futures = converter.create_floor(job['floor_id'], updated=job['updated'], manifest=manifest,
+                                                 force=force, export_options=export_options, sink=sink,
+                                                 rooms_updated=job['rooms_updated'])
+                for future in futures:
+                    future.result()
+            except Exception:
+                if queue.fail(job['floor_id'], worker, traceback.format_exc(limit=-3), time.perf_counter() - start):
+                    stats['failed'] += 1
+                    print(f"Floor {job['floor_id']} failed (attempt {job['attempts']})")
+                else:
+                    stats['lost'] += 1
+                    print(f"Floor {job['floor_id']} failed, but its lease was taken over by another worker")
+                continue
+
+        if not queue.complete(job['floor_id'], worker, time.perf_counter() - start, len(futures), manifest.assets):
+            stats['lost'] += 1
+            print(f"Floor {job['floor_id']} converted, but its lease was lost; it is left to the worker holding it")
+            continue
+
+        stats['done'] += 1
+        print(f"Floor {job['floor_id']} done in {time.perf_counter() - start:.2f} seconds")
+
+    return stats
+
+
+def publish_lod_index(queue: JobQueue, sink: AssetSink = None) -> bool:
+    '''Publishes the LOD index of the assets recorded in the queue (see converter.publish_lod_index).
+
+    Only the owner of the queue publishes it, once no job is pending or leased any more, so the index is written once
+    per run and never by several workers at a time.
+
+    Returns:
+        bool: False if the queue is not drained yet.
+    '''
+    counts = queue.counts()
+    if counts.get('pending', 0) > 0 or counts.get('leased', 0) > 0:
+        return False
+
+    converter.publish_lod_index(AssetManifest(assets=queue.manifest_entries()), sink)
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Persistent job queue for converting floors.')
+    parser.add_argument('--queue', default=DEFAULT_QUEUE_PATH, help='Path of the queue file')
+    parser.add_argument('--remote', help='URL of a queue server to use instead of the queue file')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Attempts per job before it is marked as failed')
+
+    parser.add_argument('--enqueue', action='store_true', help='Add a job for every floor of the buildings (or plan)')
+    parser.add_argument('--buildings', nargs='*', default=converter.SOUTH_KEN_LIGHT, help='Names of the buildings')
+    parser.add_argument('--plan', help='Sync plan saved by build_db.py --incremental; only its floors are enqueued')
+
+    parser.add_argument('--work', action='store_true', help='Convert jobs until the queue is drained')
+    parser.add_argument('--lease-seconds', type=float, default=600)
+    parser.add_argument('--output-dir', help='Write assets into this directory instead of uploading them')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    parser.add_argument('--upload-workers', type=int, default=8, help='Number of concurrent uploads')
+    parser.add_argument('--force', action='store_true', help='Rebuild all assets, even if their input is unchanged')
+    parser.add_argument('--quantize', action='store_true', help='Write welded, quantized glb files (KHR_mesh_quantization)')
+    parser.add_argument('--tolerance', type=float, default=0.005, help='Maximum position error of quantization in metres')
+    parser.add_argument('--instancing', action='store_true',
+                        help='Store repeated columns once and draw them per instance (EXT_mesh_gpu_instancing)')
+
+    parser.add_argument('--publish', action='store_true',
+                        help='Publish the LOD index of the assets of the queue file, once the queue is drained')
+    parser.add_argument('--status', action='store_true', help='Print the number of jobs by status and the failures')
+    parser.add_argument('--retry-failed', action='store_true', help='Reset failed jobs to pending')
+    parser.add_argument('--serve', action='store_true', help='Serve the queue file to remote workers')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Interface to serve on; the queue API is unauthenticated, only expose it to the workers')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+    if args.publish and args.remote:
+        parser.error('--publish runs on the machine with the queue file')
+
+    queue = RemoteJobQueue(args.remote) if args.remote else JobQueue(args.queue, args.max_attempts)
+
+    if args.enqueue:
+        if args.plan:
+            plan = SyncPlan.load(args.plan)
+            queue.remove_floors(plan['removed_floors'])
+            added = queue.enqueue(plan['floors'])
+        else:
+            api = API_Requests()
+            room_versions = rooms_updated(api.get_workspace())
+            added = 0
+            for building in api.get_building():
+                if building['name'] in args.buildings:
+                    floors = [dict(floor, roomsUpdated=room_versions.get(floor['id']))
+                              for floor in api.get_building_id_floor(building['id'])]
+                    added += queue.enqueue(floors, building['id'])
+        print(f'{added} jobs added or reset')
+
+    if args.retry_failed:
+        print(f'{queue.retry_failed()} failed jobs reset')
+
+    if args.work or args.publish:
+        if args.output_dir:
+            sink = open_sink(args.output_dir)
+        else:
+            sink = open_sink(connection_string=args.connection_string, max_workers=args.upload_workers)
+
+    if args.work:
+        export_options = {}
+        if args.quantize:
+            export_options.update(quantize=True, tolerance=args.tolerance)
+        if args.instancing:
+            export_options['instancing'] = True
+
+        start = time.time()
+        with sink:
+            stats = run_worker(queue, sink, args.force, export_options, lease_seconds=args.lease_seconds)
+        end = time.time()
+
+        print(f"{stats['done']} jobs done, {stats['failed']} failed, {stats['lost']} leases lost")
+        print(f"Time taken: {end - start} seconds")
+        print(metrics.report())
+
+    if args.publish:
+        with sink:
+            if publish_lod_index(queue, sink):
+                print('LOD index published')
+            else:
+                print(f'The queue is not drained yet, the LOD index is not published: {queue.counts()}')
+
+    if args.status:
+        print(queue.counts())
+        for job in queue.jobs('failed'):
+            error = (job['error'] or '').strip().splitlines()
+            print(f"floor {job['floor_id']} failed after {job['attempts']} attempts: {error[-1] if error else ''}")
+
+    if args.serve:
+        server = serve_queue(queue, args.host, args.port)
+        print(f'Serving the queue on {args.host}:{args.port}')
+        server.serve_forever()
@@ -0,0 +1,261 @@
+'''
+
+This module contains a parallel driver for the converter.
+
+Meshing (shapely + trimesh) is CPU bound and runs on one core in converter.py, so the driver distributes floors over a
+process pool. Fetching the floor data from the API is I/O bound and runs in a thread pool of the main process, which
+overlaps it with the meshing of floors that were already fetched. Uploads run in the worker threads of the asset sink
+(see asset_sink.py), so the meshing processes never wait on them.
+
+Every floor is isolated: an exception while fetching, meshing or uploading a floor is recorded in its result and does
+not affect the other floors.
+
+With an asset manifest (see asset_manifest.py), floors whose input geometry is unchanged are neither meshed nor
+uploaded. Every floor gets assets at several levels of detail (see converter.ASSET_LODS); the index of them by floor
+and level is written next to the assets.
+
+Usage:
+    python parallel_converter.py --workers 8                        # all buildings of SOUTH_KEN_LIGHT
+    python parallel_converter.py --buildings BLACKETT HUXLEY
+    python parallel_converter.py --plan sync_plan.json              # only floors of an incremental sync
+    python parallel_converter.py --output-dir out/ --report report.json
+    python parallel_converter.py --bundle                           # also one bundle per building (asset_bundle.py)
+
+'''
+
+import os
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from api_requests import API_Requests
+from api_metrics import metrics
+from sync_planner import SyncPlan, rooms_updated
+from asset_manifest import AssetManifest
+from asset_sink import AssetSink, open_sink
+from asset_bundle import bundle_buildings, buildings_of_floors
+import converter
+
+
+def _mesh_floor(floor_id: int, data_floor: dict, data_outlines: list, offset: list[float], include: set,
+                export_options: dict) -> tuple:
+    # Runs in a worker process
+    start = time.perf_counter()
+    assets = converter.build_floor_assets(floor_id, data_floor, data_outlines, offset, include, export_options)
+
+    return assets, time.perf_counter() - start
+
+
+def _fetch_floor(floor_id: int, updated: int, rooms_updated: int) -> tuple:
+    start = time.perf_counter()
+    data_floor, data_outlines = converter.fetch_floor(floor_id, updated, rooms_updated)
+
+    return data_floor, data_outlines, time.perf_counter() - start
+
+
+def convert_floors(floors: list, workers: int = None, fetch_workers: int = 8, sink: AssetSink = None,
+                   offset: list[float] = [0,0,0,0], manifest: AssetManifest = None, force: bool = False,
+                   export_options: dict = None) -> list:
+    '''Creates the assets of many floors in parallel.
+
+    At most 2 * workers + fetch_workers floors are fetched, meshed or uploaded at any time, so memory stays bounded
+    when fetching is faster than meshing or meshing is faster than uploading.
+
+    Args:
+        floors (list): Floors to convert, either floor ids or records with 'id' (and optionally 'updated' and
+            'roomsUpdated', the version of the rooms, see sync_planner.rooms_updated).
+        workers (int, optional): Number of meshing processes. Defaults to the number of cores.
+        fetch_workers (int, optional): Number of threads fetching floor data from the API.
+        sink (AssetSink, optional): Where to store the assets. Defaults to the shared blob storage sink.
+        offset (list[float], optional): Offset to apply to every floor. Format is [x,y,z,angle around z].
+        manifest (AssetManifest, optional): Skip assets whose input geometry is unchanged, and record the new ones.
+        force (bool, optional): Create all assets, even if they are unchanged according to the manifest.
+        export_options (dict, optional): Options of Scene.to_glb, e.g. {'quantize': True}.
+
+    Returns:
+        list: One result per floor with its status ('ok', 'unchanged' or 'failed'), the error (if any), the time spent
+        per stage and the size of every asset.
+    '''
+    workers = workers or os.cpu_count()
+    sink = sink or converter.default_sink()
+    floors = [floor if isinstance(floor, dict) else {'id': floor} for floor in floors]
+
+    results = {floor['id']: {'floor_id': floor['id'], 'status': 'pending', 'error': None, 'fetch_s': None,
+                             'mesh_s': None, 'upload_s': None, 'assets': {}} for floor in floors}
+
+    def fail(floor_id, stage):
+        results[floor_id]['status'] = 'failed'
+        results[floor_id]['error'] = f'{stage}: {traceback.format_exc(limit=-3)}'
+
+    to_fetch = list(reversed(floors))
+    fetching, meshing, uploading = {}, {}, {}
+    hashes = {}
+    upload_started, upload_remaining = {}, {}
+
+    with ThreadPoolExecutor(fetch_workers) as fetch_pool, ProcessPoolExecutor(workers) as mesh_pool:
+
+        def fill_fetches():
+            while to_fetch and len(fetching) + len(meshing) + len(upload_remaining) < 2 * workers + fetch_workers:
+                floor = to_fetch.pop()
+                fetching[fetch_pool.submit(_fetch_floor, floor['id'], floor.get('updated'),
+                                           floor.get('roomsUpdated'))] = floor['id']
+
+        fill_fetches()
+
+        while fetching or meshing or uploading:
+            done, _ = wait(list(fetching) + list(meshing) + list(uploading), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future in fetching:
+                    floor_id = fetching.pop(future)
+                    try:
+                        data_floor, data_outlines, seconds = future.result()
+                        results[floor_id]['fetch_s'] = seconds
+
+                        hashes[floor_id] = converter.asset_input_hashes(floor_id, data_floor, data_outlines, offset,
+                                                                       export_options)
+                        if manifest is not None:
+                            manifest.remove_floor(floor_id, keep=hashes[floor_id])
+                        include = converter.changed_assets(hashes[floor_id], None if force else manifest)
+                        if len(include) == 0:
+                            results[floor_id]['status'] = 'unchanged'
+                            continue
+
+                        meshing[mesh_pool.submit(_mesh_floor, floor_id, data_floor, data_outlines, offset,
+                                                 include, export_options)] = floor_id
+                    except Exception:
+                        fail(floor_id, 'fetch')
+                    continue
+
+                if future in meshing:
+                    floor_id = meshing.pop(future)
+                    try:
+                        assets, seconds = future.result()
+                        results[floor_id]['mesh_s'] = seconds
+                    except Exception:
+                        fail(floor_id, 'mesh')
+                        continue
+
+                    if len(assets) == 0:
+                        results[floor_id]['status'] = 'ok'
+                        continue
+
+                    # Uploads run in the threads of the sink; the loop keeps feeding the meshing processes
+                    upload_started[floor_id] = time.perf_counter()
+                    upload_remaining[floor_id] = len(assets)
+                    results[floor_id]['assets'] = {path: len(data) for path, data in assets.items()}
+                    for path, data in assets.items():
+                        uploading[sink.put(path, data)] = (floor_id, path, len(data))
+                    continue
+
+                floor_id, path, size = uploading.pop(future)
+                upload_remaining[floor_id] -= 1
+                try:
+                    future.result()
+                    if manifest is not None:
+                        manifest.update(path, hashes[floor_id][path], size=size, **converter.asset_info(path))
+                except Exception:
+                    fail(floor_id, 'upload')
+
+                if upload_remaining[floor_id] == 0:
+                    del upload_remaining[floor_id]
+                    results[floor_id]['upload_s'] = time.perf_counter() - upload_started[floor_id]
+                    if results[floor_id]['status'] != 'failed':
+                        results[floor_id]['status'] = 'ok'
+                    if manifest is not None:
+                        manifest.save()
+
+            fill_fetches()
+
+    if manifest is not None:
+        manifest.save() # Also entries removed of floors without uploads
+    return list(results.values())
+
+
+def summarize(results: list) -> str:
+    ok = [r for r in results if r['status'] == 'ok']
+    unchanged = [r for r in results if r['status'] == 'unchanged']
+    failed = [r for r in results if r['status'] == 'failed']
+
+    lines = [f'{len(ok)}/{len(results)} floors converted, {len(unchanged)} unchanged, {len(failed)} failed']
+    for stage in ('fetch_s', 'mesh_s', 'upload_s'):
+        times = [r[stage] for r in results if r[stage] is not None]
+        if times:
+            lines.append(f'{stage[:-2]:>8}: total {sum(times):.2f}s, mean {sum(times) / len(times):.3f}s, '
+                         f'max {max(times):.3f}s')
+    for r in failed:
+        lines.append(f'floor {r["floor_id"]} failed: {r["error"].strip().splitlines()[-1]}')
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Converts floors into glb assets using a process pool.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of meshing processes (default: all cores)')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--buildings', nargs='*', default=converter.SOUTH_KEN_LIGHT, help='Names of the buildings')
+    parser.add_argument('--plan', help='Sync plan saved by build_db.py --incremental; only its floors are converted')
+    parser.add_argument('--output-dir', help='Write assets into this directory instead of uploading them')
+    parser.add_argument('--connection-string', help='Blob storage connection string, e.g. of a local emulator')
+    parser.add_argument('--upload-workers', type=int, default=8, help='Number of concurrent uploads')
+    parser.add_argument('--bundle', action='store_true', help='Pack the assets of every building into one bundle')
+    parser.add_argument('--report', help='Save per-floor results as JSON to this file')
+    parser.add_argument('--force', action='store_true', help='Rebuild all assets, even if their input is unchanged')
+    parser.add_argument('--quantize', action='store_true', help='Write welded, quantized glb files (KHR_mesh_quantization)')
+    parser.add_argument('--tolerance', type=float, default=0.005, help='Maximum position error of quantization in metres')
+    parser.add_argument('--instancing', action='store_true',
+                        help='Store repeated columns once and draw them per instance (EXT_mesh_gpu_instancing)')
+    args = parser.parse_args()
+
+    export_options = {}
+    if args.quantize:
+        export_options.update(quantize=True, tolerance=args.tolerance)
+    if args.instancing:
+        export_options['instancing'] = True
+
+    start = time.time()
+
+    removed_floors = []
+    if args.plan:
+        plan = SyncPlan.load(args.plan)
+        floors, removed_floors = plan['floors'], plan['removed_floors']
+    else:
+        api = API_Requests()
+        room_versions = rooms_updated(api.get_workspace())
+        floors = []
+        for building in api.get_building():
+            if building['name'] in args.buildings:
+                floors += [dict(floor, roomsUpdated=room_versions.get(floor['id']))
+                           for floor in api.get_building_id_floor(building['id'])]
+
+    if args.output_dir:
+        sink = open_sink(args.output_dir)
+    else:
+        sink = open_sink(connection_string=args.connection_string, max_workers=args.upload_workers)
+
+    manifest = AssetManifest.for_sink(sink)
+    for floor_id in removed_floors:
+        manifest.remove_floor(floor_id)
+
+    with sink:
+        results = convert_floors(floors, args.workers, args.fetch_workers, sink, manifest=manifest, force=args.force,
+                                 export_options=export_options)
+        converter.publish_lod_index(manifest, sink)
+
+        if args.bundle:
+            sink.flush()
+            floor_ids = [floor['id'] if isinstance(floor, dict) else floor for floor in floors]
+            bundle_buildings(buildings_of_floors(floor_ids), sink, manifest)
+
+    end = time.time()
+
+    print(summarize(results))
+    print(f"Time taken: {end - start} seconds")
+    print(metrics.report())
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=4)
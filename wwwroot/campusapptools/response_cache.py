@@ -0,0 +1,207 @@
+'''
+
+This module contains the ResponseCache class, a persistent on-disk cache for responses of the Pythagoras API.
+
+Entries are keyed on the URL and the query string parameters of a request and stored zlib-compressed in a single SQLite
+file. The cache is bounded in size (least recently used entries are evicted first) and entries expire after a TTL.
+Expired entries are not thrown away straight away, they are kept around so the request can be revalidated with the
+ETag/Last-Modified validators of the previous response, or with the `updated` timestamp of the record if the caller
+knows it (e.g. from a list endpoint such as building/{id}/floor).
+
+Usage:
+    cache = ResponseCache()
+    api = API_Requests(cache=cache)
+
+Alternatively, setting the environment variable PYTHAGORAS_CACHE_DIR enables a cache in that directory for every
+API_Requests object that is created without an explicit cache.
+
+'''
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'campusapptools')
+
+
+class ResponseCache:
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 512 * 1024**2, ttl: float = 24 * 3600,
+                 compression_level: int = 6) -> None:
+        '''Opens (or creates) a response cache in the given directory.
+
+        Args:
+            cache_dir (str, optional): Directory the cache file is stored in.
+            max_bytes (int, optional): Upper bound for the total compressed size of all entries.
+            ttl (float, optional): Time in seconds for which an entry is served without contacting the API.
+            compression_level (int, optional): zlib compression level of the stored responses.
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.path = os.path.join(cache_dir, 'responses.db')
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compression_level = compression_level
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute(
+            '''
+            create table if not exists responses (
+                key varchar(64) primary key,
+                url text,
+                body blob,
+                size int,
+                etag text,
+                last_modified text,
+                updated bigint,
+                stored_at float,
+                accessed_at float
+            );
+            '''
+        )
+        self._conn.execute('create index if not exists responses_accessed_at on responses(accessed_at);')
+        self._conn.commit()
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        '''Computes the cache key of a request.
+
+        Args:
+            url (str): URL of the request.
+            params (dict, optional): Query string parameters of the request.
+
+        Returns:
+            str: Hex digest identifying the request.
+        '''
+        canonical = json.dumps([url, params or {}], sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> dict:
+        '''Looks up an entry, regardless of whether it is still fresh.
+
+        Args:
+            key (str): Cache key as returned by ResponseCache.key.
+
+        Returns:
+            dict: The entry with the decompressed body, or None if there is no entry.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'select body, etag, last_modified, updated, stored_at from responses where key=?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self._conn.execute('update responses set accessed_at=? where key=?', (time.time(), key))
+            self._conn.commit()
+
+        body, etag, last_modified, updated, stored_at = row
+
+        return {
+            'body': zlib.decompress(body),
+            'etag': etag,
+            'last_modified': last_modified,
+            'updated': updated,
+            'stored_at': stored_at,
+        }
+
+    def is_fresh(self, entry: dict, updated: int = None) -> bool:
+        '''Checks whether an entry can be served without contacting the API.
+
+        An entry is fresh if it is younger than the TTL, or if the caller knows the `updated` timestamp of the record
+        and it matches the one the entry was stored with.
+
+        Args:
+            entry (dict): Entry as returned by ResponseCache.get.
+            updated (int, optional): Current `updated` timestamp of the record, if known.
+
+        Returns:
+            bool: True if the entry is fresh.
+        '''
+        if updated is not None and entry['updated'] is not None:
+            return entry['updated'] == updated
+
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def put(self, key: str, url: str, body: bytes, etag: str = None, last_modified: str = None,
+            updated: int = None) -> None:
+        '''Stores a response and evicts least recently used entries if the cache grew too large.
+
+        Args:
+            key (str): Cache key as returned by ResponseCache.key.
+            url (str): URL of the request (only stored for inspection).
+            body (bytes): Raw body of the response.
+            etag (str, optional): ETag header of the response.
+            last_modified (str, optional): Last-Modified header of the response.
+            updated (int, optional): `updated` timestamp of the record the response describes.
+        '''
+        compressed = zlib.compress(body, self.compression_level)
+        if len(compressed) > self.max_bytes:
+            return
+
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                '''
+                insert into responses (key, url, body, size, etag, last_modified, updated, stored_at, accessed_at)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                on conflict (key) do update set
+                    url = excluded.url,
+                    body = excluded.body,
+                    size = excluded.size,
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    updated = excluded.updated,
+                    stored_at = excluded.stored_at,
+                    accessed_at = excluded.accessed_at;
+                ''',
+                (key, url, compressed, len(compressed), etag, last_modified, updated, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def revalidated(self, key: str, updated: int = None) -> None:
+        '''Marks an entry as fresh again after the API confirmed it is unchanged (304 Not Modified).
+
+        Args:
+            key (str): Cache key as returned by ResponseCache.key.
+            updated (int, optional): `updated` timestamp of the record, if known.
+        '''
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                'update responses set stored_at=?, accessed_at=?, updated=coalesce(?, updated) where key=?',
+                (now, now, updated, key)
+            )
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Has to be called with the lock held
+        total = self._conn.execute('select coalesce(sum(size), 0) from responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in self._conn.execute('select key, size from responses order by accessed_at').fetchall():
+            self._conn.execute('delete from responses where key=?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self) -> None:
+        '''Removes all entries from the cache.'''
+        with self._lock:
+            self._conn.execute('delete from responses')
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,162 @@
+'''
+
+This module simplifies the floor data of the API before it is meshed.
+
+Pythagoras splits straight walls into many short segments (e.g. at every junction with another wall), and every
+segment becomes a box with its own end caps. Room outlines carry redundant points on straight edges, which add
+triangles to the room floors. The simplification:
+    - merges collinear segments that touch (or overlap) and have the same type, thickness and height into one wall.
+      The doors and windows of all segments are kept; their positions are absolute, so they stay in place,
+    - removes outline vertices that deviate less than a tolerance from the simplified outline (Douglas-Peucker, so
+      every removed vertex is within the tolerance of the result).
+
+The result has the format of the API data, so it can be passed to the converter as is. The geometry does not visibly
+change: merged walls cover exactly the same volume, only the faces between the segments disappear.
+
+Usage:
+    data_floor, data_outlines = simplify_floor(data_floor, data_outlines)
+
+'''
+
+import numpy as np
+import shapely
+
+
+# Walls whose directions differ less than this (radians) and whose lines are closer than DISTANCE_TOLERANCE are
+# considered collinear
+ANGLE_TOLERANCE = 1e-3
+# Maximum gap between two touching segments and maximum deviation of removed outline vertices, in metres
+DISTANCE_TOLERANCE = 0.005
+
+
+def _wall_key(wall: dict) -> tuple:
+    height = round(wall['height'], 6) if wall['height'] is not None else None
+    return wall['typeName'], round(wall['typeThickness'], 6), height
+
+
+def merge_walls(data_walls: list, angle_tolerance: float = ANGLE_TOLERANCE,
+                distance_tolerance: float = DISTANCE_TOLERANCE) -> list:
+    '''Merges collinear, touching wall segments with the same type, thickness and height.
+
+    Args:
+        data_walls (list): The wallInfos of a floor retrieved from the API.
+        angle_tolerance (float, optional): Maximum difference of the directions of collinear walls in radians.
+        distance_tolerance (float, optional): Maximum distance between the lines of collinear walls, and maximum gap
+            between touching segments, in metres.
+
+    Returns:
+        list: The walls, each merged wall replacing its segments (with the fields of its first segment, and the doors
+        and windows of all). Zero length walls are kept as they are.
+    '''
+    groups = {}
+    merged = []
+    for wall in data_walls:
+        start = np.array([wall['startX'], wall['startY']], dtype=float)
+        direction = np.array([wall['endX'], wall['endY']], dtype=float) - start
+        if np.linalg.norm(direction) == 0:
+            merged.append(wall)
+            continue
+
+        # Undirected line: angle in [0, pi) and signed distance from the origin
+        angle = np.arctan2(direction[1], direction[0]) % np.pi
+        if angle > np.pi - angle_tolerance / 2:
+            angle -= np.pi
+        distance = float(np.array([-np.sin(angle), np.cos(angle)]) @ start)
+
+        # Lines that only differ by rounding noise fall into the same cell. Lines near the border of a cell may end up
+        # in different cells, which only means they are not merged.
+        key = _wall_key(wall) + (round(angle / angle_tolerance), round(distance / distance_tolerance))
+        groups.setdefault(key, []).append((wall, angle))
+
+    for members in groups.values():
+        if len(members) == 1:
+            merged.append(members[0][0])
+            continue
+
+        angle = members[0][1]
+        e1 = np.array([np.cos(angle), np.sin(angle)])
+
+        # Every segment as an interval along the line, with the points at its ends
+        intervals = []
+        for wall, _ in members:
+            points = [(wall['startX'], wall['startY']), (wall['endX'], wall['endY'])]
+            t = [float(e1 @ point) for point in points]
+            order = (0, 1) if t[0] <= t[1] else (1, 0)
+            intervals.append((t[order[0]], t[order[1]], points[order[0]], points[order[1]], wall))
+        intervals.sort(key=lambda interval: interval[0])
+
+        runs = [[intervals[0]]]
+        for interval in intervals[1:]:
+            end = max(member[1] for member in runs[-1])
+            if interval[0] <= end + distance_tolerance:
+                runs[-1].append(interval)
+            else:
+                runs.append([interval])
+
+        for run in runs:
+            if len(run) == 1:
+                merged.append(run[0][4])
+                continue
+
+            first = run[0]
+            last = max(run, key=lambda interval: interval[1])
+            wall = dict(first[4])
+            # Keep the direction of the first segment, so the wall is not turned around
+            start, end = first[2], last[3]
+            if first[4]['startX'] != first[2][0] or first[4]['startY'] != first[2][1]:
+                start, end = end, start
+            wall['startX'], wall['startY'] = start
+            wall['endX'], wall['endY'] = end
+            wall['doorInfos'] = [door for interval in run for door in interval[4]['doorInfos']]
+            wall['windowInfos'] = [window for interval in run for window in interval[4]['windowInfos']]
+            merged.append(wall)
+
+    return merged
+
+
+def simplify_outline(outline: dict, tolerance: float = DISTANCE_TOLERANCE) -> dict:
+    '''Removes outline vertices that are within the tolerance of the simplified outline.
+
+    Args:
+        outline (dict): A room outline retrieved from the API (with outline.coords).
+        tolerance (float, optional): Maximum distance of a removed vertex from the simplified outline, in metres.
+
+    Returns:
+        dict: The room with the simplified outline, or the room itself if nothing could be removed (or the outline is
+        not a valid polygon).
+    '''
+    coords = outline['outline']['coords']
+    if len(coords) <= 3:
+        return outline
+
+    polygon = shapely.geometry.Polygon([[v['x'], v['y']] for v in coords])
+    if not polygon.is_valid:
+        return outline
+
+    simplified = polygon.simplify(tolerance, preserve_topology=True)
+    if simplified.is_empty or simplified.geom_type != 'Polygon' or not simplified.is_valid:
+        return outline
+
+    points = list(simplified.exterior.coords)[:-1]
+    if len(points) >= len(coords) or len(points) < 3:
+        return outline
+
+    return dict(outline, outline=dict(outline['outline'], coords=[{'x': x, 'y': y} for x, y in points]))
+
+
+def simplify_floor(data_floor: dict, data_outlines: list, tolerance: float = DISTANCE_TOLERANCE) -> tuple:
+    '''Simplifies the walls and room outlines of a floor (see the module docstring).
+
+    Args:
+        data_floor (dict): Floor info as returned by API_Requests.get_floor_id_info. Not modified.
+        data_outlines (list): Room outlines as returned by API_Requests.get_floor_id_workspace_info. Not modified.
+        tolerance (float, optional): Maximum gap between merged walls and maximum deviation of removed outline vertices.
+
+    Returns:
+        tuple: The simplified floor info and room outlines (None if there are no outlines).
+    '''
+    data_floor = dict(data_floor, wallInfos=merge_walls(data_floor['wallInfos'], distance_tolerance=tolerance))
+    if data_outlines is not None:
+        data_outlines = [simplify_outline(outline, tolerance) for outline in data_outlines]
+
+    return data_floor, data_outlines
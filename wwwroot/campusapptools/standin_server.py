@@ -0,0 +1,447 @@
+'''
+
+This module contains a local stand-in for the Pythagoras API, so ingestion, graph building and the converter can be run
+(and load-tested) offline or in CI.
+
+The server answers every endpoint used by API_Requests, either with recorded responses from a fixtures directory or
+with a synthetic campus generated from a seed. Latency and an error rate can be configured to emulate the real API.
+Responses carry an ETag, so conditional requests of the response cache are answered with 304 Not Modified.
+
+Usage:
+    python standin_server.py --port 8765 --buildings 20 --floors 8 --rooms 40 --latency 0.05 --error-rate 0.01
+
+    PYTHAGORAS_API_URL=http://127.0.0.1:8765/imp_datamanager python build_db.py
+
+Recording fixtures from the live API (every endpoint API_Requests uses, for a set of buildings):
+    python standin_server.py --record fixtures/ --record-buildings 202 203
+
+The files of the fixtures mirror the URL paths of the endpoints. The query string is part of the key, as a hash
+appended to the path (see fixture_filename), so requests that only differ in their parameters (e.g. floor/info with
+different floorIds[]) are replayed with their own responses.
+
+From Python, serve_in_thread starts the server in the background and returns its API URL:
+    server, api_url = serve_in_thread(campus=SyntheticCampus(buildings=5))
+    api = API_Requests(api_url=api_url)
+
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+FLOOR_HEIGHT = 3.0 # Height of the walls, excluding the 0.2 of the floor slab
+
+
+class SyntheticCampus:
+
+    def __init__(self, buildings: int = 20, floors: int = 8, rooms: int = 40, seed: int = 0) -> None:
+        '''Generates a deterministic campus that has the same structure as the Pythagoras data.
+
+        Every floor is a grid of rooms with doors in the walls between neighbouring rooms. One room of each floor is a
+        staircase and one a lift, at the same position on every floor, so floors can be connected in the graph.
+
+        Args:
+            buildings (int, optional): Number of buildings.
+            floors (int, optional): Number of floors per building.
+            rooms (int, optional): Number of rooms per floor.
+            seed (int, optional): Seed for the random parts (room sizes, timestamps, ...).
+        '''
+        self.buildings = {}
+        self.floors = {}
+        self.floor_infos = {}
+        self.workspaces = {}
+
+        rng = random.Random(seed)
+        next_id = 1
+
+        for b in range(buildings):
+            building_id = next_id
+            next_id += 1
+
+            self.buildings[building_id] = {
+                'id': building_id,
+                'uid': f'building-{building_id}',
+                'name': f'SYNTHETIC BUILDING {b}',
+                'updated': 1700000000000 + rng.randrange(10**9),
+                'geoLocation': {'x': rng.uniform(-500, 500), 'y': rng.uniform(-500, 500), 'rotation': rng.uniform(0, 6.28)},
+            }
+
+            cols = max(1, int(round(rooms**0.5)))
+            widths = [rng.uniform(3, 8) for _ in range(cols)]
+            depths = [rng.uniform(3, 8) for _ in range((rooms + cols - 1) // cols)]
+
+            for f in range(floors):
+                floor_id = next_id
+                next_id += 1
+
+                floor = {
+                    'id': floor_id,
+                    'uid': f'floor-{floor_id}',
+                    'buildingId': building_id,
+                    'name': f'{f:02d}',
+                    'updated': 1700000000000 + rng.randrange(10**9),
+                }
+                self.floors[floor_id] = floor
+
+                rooms_floor, walls, next_id = self._generate_floor(floor, rooms, widths, depths, next_id, rng)
+                self.workspaces.update({room['id']: room for room in rooms_floor})
+
+                self.floor_infos[floor_id] = dict(floor, wallInfos=walls, columnInfos=self._generate_columns(widths, depths),
+                                                  floorComponentInfos=[], workspaceComponentInfos=[])
+
+    def _generate_floor(self, floor: dict, num_rooms: int, widths: list, depths: list, next_id: int, rng: random.Random):
+        xs = [0]
+        for w in widths:
+            xs.append(xs[-1] + w)
+        ys = [0]
+        for d in depths:
+            ys.append(ys[-1] + d)
+
+        rooms = []
+        for i in range(num_rooms):
+            c, r = i % len(widths), i // len(widths)
+            x0, x1, y0, y1 = xs[c], xs[c + 1], ys[r], ys[r + 1]
+
+            type_name = 'Stairs' if i == 0 else 'Lift' if i == 1 else rng.choice(['Office', 'Office', 'Teaching', 'Lab'])
+            rooms.append({
+                'id': next_id,
+                'uid': f'workspace-{next_id}',
+                'floorId': floor['id'],
+                'name': f'{floor["name"]}.{i:03d}',
+                'typeName': type_name,
+                'updated': floor['updated'] - rng.randrange(10**6),
+                'utilityCoord': {'x': (x0 + x1) / 2, 'y': (y0 + y1) / 2},
+                'outline': {'coords': [{'x': x0, 'y': y0}, {'x': x1, 'y': y0}, {'x': x1, 'y': y1}, {'x': x0, 'y': y1}]},
+            })
+            next_id += 1
+
+        walls = []
+        num_rows = (num_rooms + len(widths) - 1) // len(widths)
+
+        def wall(x0, y0, x1, y1, external):
+            length = ((x1 - x0)**2 + (y1 - y0)**2)**0.5
+            door = {'x': x0 + (x1 - x0) / 2, 'y': y0 + (y1 - y0) / 2, 'typeWidth': 0.9, 'typeHeight': 2.1, 'typeThreshold': 0}
+            window = {'x': x0 + (x1 - x0) / 4, 'y': y0 + (y1 - y0) / 4, 'typeWidth': 1.0, 'typeHeight': 1.2, 'typeThreshold': 0.9}
+
+            walls.append({
+                'startX': x0, 'startY': y0, 'endX': x1, 'endY': y1,
+                'height': FLOOR_HEIGHT,
+                'typeThickness': 0.3 if external else 0.1,
+                'typeName': 'E30' if external else 'I10',
+                'doorInfos': [] if external or length < 2 else [door],
+                'windowInfos': [window] if external and length > 3 else [],
+            })
+
+        for r in range(num_rows + 1):
+            for c in range(len(widths)):
+                wall(xs[c], ys[r], xs[c + 1], ys[r], r in (0, num_rows))
+        for c in range(len(widths) + 1):
+            for r in range(num_rows):
+                wall(xs[c], ys[r], xs[c], ys[r + 1], c in (0, len(widths)))
+
+        return rooms, walls, next_id
+
+    def _generate_columns(self, widths: list, depths: list) -> list:
+        columns = []
+        x = 0
+        for w in widths[:-1]:
+            x += w
+            columns.append({
+                'height': FLOOR_HEIGHT,
+                'outline': {'coords': [{'x': x - 0.2, 'y': -0.2}, {'x': x + 0.2, 'y': -0.2}, {'x': x + 0.2, 'y': 0.2}, {'x': x - 0.2, 'y': 0.2}]},
+            })
+
+        return columns
+
+    def respond(self, path: str, query: dict):
+        '''Returns the body of an endpoint or None if the endpoint/record does not exist.
+
+        Args:
+            path (str): Path of the request below /rest/v1, e.g. 'floor/930/info'.
+            query (dict): Parsed query string parameters.
+        '''
+        parts = path.strip('/').split('/')
+
+        def list_of(records, **filters):
+            return [r for r in records if all(r.get(k) == v for k, v in filters.items())]
+
+        if parts == ['component']:
+            return []
+        if parts == ['building'] or parts == ['building', 'info']:
+            return list(self.buildings.values())
+        if parts == ['floor']:
+            return list(self.floors.values())
+        if parts == ['floor', 'info']:
+            ids = [int(i) for i in query.get('floorIds[]', [])] or list(self.floor_infos)
+            return [self.floor_infos[i] for i in ids if i in self.floor_infos]
+        if parts == ['workspace']:
+            return [{k: v for k, v in r.items() if k not in ('outline', 'utilityCoord')} for r in self.workspaces.values()]
+        if parts == ['workspace', 'info']:
+            return list(self.workspaces.values())
+
+        if len(parts) >= 2 and parts[1].isdigit():
+            record_id = int(parts[1])
+
+            if parts[0] == 'building' and record_id in self.buildings:
+                if len(parts) == 2 or parts[2:] == ['info']:
+                    return self.buildings[record_id]
+                if parts[2:] == ['floor']:
+                    return list_of(self.floors.values(), buildingId=record_id)
+                if parts[2:] == ['floor', 'info']:
+                    return list_of(self.floor_infos.values(), buildingId=record_id)
+
+            if parts[0] == 'floor' and record_id in self.floors:
+                if parts[2:] == ['info']:
+                    return self.floor_infos[record_id]
+                if parts[2:] == ['workspace', 'info']:
+                    return list_of(self.workspaces.values(), floorId=record_id)
+                if parts[2:] == ['component', 'all', 'info']:
+                    return []
+
+            if parts[0] == 'workspace' and parts[2:] == ['info'] and record_id in self.workspaces:
+                return self.workspaces[record_id]
+
+        return None
+
+
+def fixture_filename(fixtures_dir: str, path: str, query: dict) -> str:
+    '''Returns the file of the recorded response of a request.
+
+    Args:
+        fixtures_dir (str): Directory with the recorded responses.
+        path (str): Path of the request below /rest/v1, e.g. 'floor/930/info'.
+        query (dict): Parsed query string parameters (as returned by parse_qs). Their order does not matter.
+
+    Returns:
+        str: The file, e.g. fixtures/building/202/floor@5e0b1cd3a2f4.json (just building/202/floor.json without query).
+    '''
+    filename = os.path.join(fixtures_dir, *path.strip('/').split('/'))
+
+    canonical = urlencode(sorted((key, value) for key, values in query.items() for value in values))
+    if canonical:
+        filename += '@' + hashlib.sha1(canonical.encode()).hexdigest()[:12]
+
+    return filename + '.json'
+
+
+class FixtureCampus:
+
+    def __init__(self, fixtures_dir: str) -> None:
+        '''Replays responses that were recorded with record_fixtures.
+
+        Responses are looked up by the path and the query string parameters of the request, so a request that was not
+        recorded with exactly the same parameters is answered with 404 Not Found.
+
+        Args:
+            fixtures_dir (str): Directory with the recorded responses.
+        '''
+        self.fixtures_dir = fixtures_dir
+
+    def respond(self, path: str, query: dict):
+        filename = fixture_filename(self.fixtures_dir, path, query)
+        if not os.path.isfile(filename):
+            return None
+
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+
+def record_fixtures(fixtures_dir: str, building_ids: list, api=None) -> None:
+    '''Records the responses of the live API for a set of buildings, so they can be replayed by the stand-in server.
+
+    Every endpoint of API_Requests is called with the parameters the tools use: the campus-wide lists, every building,
+    floor and room of the buildings, and floor/info for the floors of every building and for every single floor. The
+    campus-wide lists are cut down to the recorded buildings, so the fixtures are a consistent (smaller) campus.
+
+    Args:
+        fixtures_dir (str): Directory to store the responses in.
+        building_ids (list): IDs of the buildings to record.
+        api (API_Requests, optional): API to record from. Defaults to the live API.
+    '''
+    import requests
+    from api_requests import API_Requests
+
+    api = api if api is not None else API_Requests()
+    responses = {}
+
+    get = api._get
+
+    def record(url, params=None, warn_only=False, updated=None):
+        data = get(url, params, warn_only, updated)
+        if data is not None:
+            # The query string as requests sends it, so it is keyed like the request the server receives
+            request = urlparse(requests.Request('GET', url, params=params).prepare().url)
+            path = re.search(r'/rest/v1/(.*)$', request.path).group(1)
+            query = parse_qs(request.query, keep_blank_values=True)
+            responses[fixture_filename(fixtures_dir, path, query)] = (path, data)
+        return data
+
+    api._get = record
+    try:
+        api.get_component()
+        api.get_building()
+        api.get_building_info()
+        api.get_floor()
+        api.get_workspace()
+        api.get_workspace_info()
+
+        floor_ids = set()
+        for building_id in building_ids:
+            api.get_building_id(building_id)
+            api.get_building_id_info(building_id)
+            floors = api.get_building_id_floor(building_id)
+            api.get_building_id_floor_info(building_id)
+            api.get_floor_info([floor['id'] for floor in floors])
+
+            for floor in floors:
+                floor_ids.add(floor['id'])
+                api.get_floor_id_info(floor['id'])
+                api.get_floor_id_component_all_info(floor['id'])
+                api.get_floor_info([floor['id']])
+                for room in api.get_floor_id_workspace_info(floor['id']) or []:
+                    api.get_workspace_id_info(room['id'])
+    finally:
+        del api._get
+
+    # Campus-wide lists, restricted to the recorded buildings
+    belongs = {
+        'building': lambda record: record['id'] in building_ids,
+        'building/info': lambda record: record['id'] in building_ids,
+        'floor': lambda record: record['id'] in floor_ids,
+        'workspace': lambda record: record.get('floorId') in floor_ids,
+        'workspace/info': lambda record: record.get('floorId') in floor_ids,
+        'component': lambda record: record.get('floorId') in floor_ids,
+    }
+
+    for filename, (path, data) in responses.items():
+        if path in belongs:
+            data = [record for record in data if belongs[path](record)]
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlparse(self.path)
+
+        if config['latency'] > 0:
+            time.sleep(max(0.0, random.gauss(config['latency'], config['latency'] * config['jitter'])))
+
+        if config['error_rate'] > 0 and random.random() < config['error_rate']:
+            return self._send(503, b'{"error": "injected failure"}')
+
+        match = re.search(r'/rest/v1/(.*)$', url.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        data = config['campus'].respond(match.group(1), query) if match else None
+        if data is None:
+            return self._send(404, b'{"error": "not found"}')
+
+        body = json.dumps(data).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, b'', etag)
+
+        self._send(200, body, etag)
+
+    def _send(self, status: int, body: bytes, etag: str = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.config['verbose']:
+            super().log_message(format, *args)
+
+
+def make_server(campus=None, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.25,
+                error_rate: float = 0.0, verbose: bool = False) -> ThreadingHTTPServer:
+    '''Creates the stand-in server.
+
+    Args:
+        campus (SyntheticCampus | FixtureCampus, optional): Source of the responses. Defaults to a synthetic campus.
+        host (str, optional): Interface to listen on.
+        port (int, optional): Port to listen on, 0 picks a free port.
+        latency (float, optional): Mean latency in seconds added to every response.
+        jitter (float, optional): Standard deviation of the latency relative to its mean.
+        error_rate (float, optional): Fraction of requests answered with 503 Service Unavailable.
+        verbose (bool, optional): Log every request.
+
+    Returns:
+        ThreadingHTTPServer: The server (not started yet).
+    '''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.config = {
+        'campus': campus if campus is not None else SyntheticCampus(),
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+        'verbose': verbose,
+    }
+
+    return server
+
+
+def serve_in_thread(**kwargs):
+    '''Starts the stand-in server in a daemon thread.
+
+    Args:
+        **kwargs: Passed on to make_server.
+
+    Returns:
+        tuple: The server (call server.shutdown() to stop it) and the API URL to pass to API_Requests.
+    '''
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host, port = server.server_address[:2]
+
+    return server, f'http://{host}:{port}/imp_datamanager'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Pythagoras API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', help='Directory with recorded responses (default: synthetic campus)')
+    parser.add_argument('--buildings', type=int, default=20)
+    parser.add_argument('--floors', type=int, default=8)
+    parser.add_argument('--rooms', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.25)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--record', metavar='DIR', help='Record fixtures from the live API into DIR and exit')
+    parser.add_argument('--record-buildings', type=int, nargs='*', default=[])
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record, args.record_buildings)
+        sys.exit(0)
+
+    if args.fixtures:
+        campus = FixtureCampus(args.fixtures)
+    else:
+        campus = SyntheticCampus(args.buildings, args.floors, args.rooms, args.seed)
+
+    server = make_server(campus, args.host, args.port, args.latency, args.jitter, args.error_rate, args.verbose)
+    print(f'Serving stand-in Pythagoras API on http://{args.host}:{args.port}/imp_datamanager')
+    server.serve_forever()
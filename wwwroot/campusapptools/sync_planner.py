@@ -0,0 +1,223 @@
+'''
+
+This module contains the sync planner, which works out what changed in Pythagoras since the last run of build_db.py.
+
+Building, floor and room records all carry an `updated` timestamp, which build_db.py stores in the `timestamp` column of
+the buildings, floors and rooms tables. The planner compares the upstream list endpoints (which are cheap, they do not
+include any geometry) against the stored timestamps and produces the minimal set of floors that have to be refetched
+for the database, re-meshed by the converter, and the buildings whose navigation graph has to be rebuilt.
+
+Usage:
+    plan = plan_sync(api, conn)
+    print(plan.summary())
+    plan.save('sync_plan.json') # consumed by converter.py --plan sync_plan.json
+
+The floors of a saved plan carry the version of their rooms (see rooms_updated), so the converter can serve their room
+outlines from the response cache without asking the API.
+
+'''
+
+import json
+import sqlite3
+
+
+class SyncPlan:
+
+    def __init__(self) -> None:
+        '''Result of plan_sync.
+
+        Attributes:
+            buildings (list): Upstream records of new or changed buildings.
+            floors (dict): Upstream records of the floors to refetch, by floor id. Every record has the version of
+                its rooms as 'roomsUpdated' (see rooms_updated).
+            floor_reasons (dict): Why a floor is refetched, by floor id. Subset of {'new', 'floor', 'rooms'}.
+            removed_buildings (set): IDs of buildings that no longer exist upstream.
+            removed_floors (set): IDs of floors that no longer exist upstream.
+            removed_rooms (set): IDs of rooms that no longer exist upstream.
+        '''
+        self.buildings = []
+        self.floors = {}
+        self.floor_reasons = {}
+
+        self.removed_buildings = set()
+        self.removed_floors = set()
+        self.removed_rooms = set()
+
+    def add_floor(self, floor: dict, reason: str) -> None:
+        self.floors[floor['id']] = floor
+        self.floor_reasons.setdefault(floor['id'], set()).add(reason)
+
+    @property
+    def refetch_floors(self) -> list:
+        '''IDs of floors whose floor info and rooms have to be fetched again.'''
+        return sorted(self.floors)
+
+    @property
+    def remesh_floors(self) -> list:
+        '''IDs of floors whose assets have to be regenerated by the converter.
+
+        Floors assets are made from the walls and columns of the floor info and the outlines of the rooms, so any change
+        of either requires a re-mesh.
+        '''
+        return sorted(self.floors)
+
+    @property
+    def rebuild_graph_buildings(self) -> list:
+        '''IDs of buildings whose navigation graph has to be rebuilt.
+
+        The graph connects the floors of a building, so it is rebuilt per building.
+        '''
+        buildings = {floor['buildingId'] for floor in self.floors.values()}
+        return sorted(buildings | {building['id'] for building in self.buildings})
+
+    def is_empty(self) -> bool:
+        return not (self.buildings or self.floors or self.removed_buildings or self.removed_floors or self.removed_rooms)
+
+    def summary(self) -> str:
+        return (
+            f'{len(self.buildings)} buildings changed, {len(self.floors)} floors to refetch/re-mesh '
+            f'({sum("rooms" in r for r in self.floor_reasons.values())} because of rooms), '
+            f'{len(self.rebuild_graph_buildings)} graphs to rebuild, removed: {len(self.removed_buildings)} buildings, '
+            f'{len(self.removed_floors)} floors, {len(self.removed_rooms)} rooms'
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'buildings': [building['id'] for building in self.buildings],
+            'refetch_floors': self.refetch_floors,
+            'floors': [self.floors[floor_id] for floor_id in self.remesh_floors],
+            'remesh_floors': self.remesh_floors,
+            'rebuild_graph_buildings': self.rebuild_graph_buildings,
+            'floor_reasons': {floor_id: sorted(reasons) for floor_id, reasons in self.floor_reasons.items()},
+            'removed_buildings': sorted(self.removed_buildings),
+            'removed_floors': sorted(self.removed_floors),
+            'removed_rooms': sorted(self.removed_rooms),
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @staticmethod
+    def load(path: str) -> dict:
+        '''Loads a saved plan. Only the ids are stored, so this returns the dictionary written by SyncPlan.save.'''
+        with open(path, 'r') as f:
+            return json.load(f)
+
+
+def _add_room(rooms: dict, room: dict) -> None:
+    floor_id = room.get('floorId')
+    if floor_id is None:
+        return
+
+    latest, count = rooms.get(floor_id, (0, 0))
+    updated = room.get('updated')
+    rooms[floor_id] = (None if latest is None or updated is None else max(latest, updated), count + 1)
+
+
+def _room_versions(rooms: dict) -> dict:
+    return {floor_id: latest + count for floor_id, (latest, count) in rooms.items() if latest is not None}
+
+
+def rooms_updated(rooms) -> dict:
+    '''Returns the version of the rooms of every floor, to pass as `updated` to
+    API_Requests.get_floor_id_workspace_info.
+
+    The timestamp of a floor does not change when only its rooms do, so the room outlines need their own version: the
+    latest `updated` timestamp of the rooms of the floor plus their number. The number makes a removed room count as a
+    change, as it does not change the latest timestamp. Floors with a room without timestamp get no version.
+
+    Args:
+        rooms (iterable): Room records of the list endpoint, e.g. API_Requests.get_workspace().
+
+    Returns:
+        dict: The version by floor id.
+    '''
+    versions = {}
+    for room in rooms:
+        _add_room(versions, room)
+
+    return _room_versions(versions)
+
+
+def _stored(conn, query: str) -> dict:
+    try:
+        return {row[0]: row[1:] for row in conn.execute(query)}
+    except sqlite3.OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+        # Table does not exist yet, everything is new
+        return {}
+
+
+def plan_sync(api, conn) -> SyncPlan:
+    '''Compares the upstream list endpoints against the timestamps stored in the database.
+
+    Args:
+        api (API_Requests): API to query.
+        conn (sqlite3.Connection): Connection to the database written by build_db.py.
+
+    Returns:
+        SyncPlan: The changes to apply.
+    '''
+    plan = SyncPlan()
+
+    stored_buildings = _stored(conn, 'select building_id, timestamp from buildings')
+    stored_floors = _stored(conn, 'select floor_id, timestamp, building_id from floors')
+    stored_rooms = _stored(conn, 'select room_id, timestamp, floor_id from rooms')
+
+    # Buildings
+    buildings = api.get_building()
+    for building in buildings:
+        if building['id'] not in stored_buildings or stored_buildings[building['id']][0] != building['updated']:
+            plan.buildings.append(building)
+
+    plan.removed_buildings = set(stored_buildings) - {building['id'] for building in buildings}
+
+    # Floors, the list endpoint per building is used as it reliably contains the building id
+    upstream_floors = {}
+    for building in buildings:
+        for floor in api.get_building_id_floor(building['id']):
+            # A copy, as the record may be shared with other callers of the API (see API_Requests coalesce)
+            floor = dict(floor, buildingId=floor.get('buildingId', building['id']))
+            upstream_floors[floor['id']] = floor
+
+            if floor['id'] not in stored_floors:
+                plan.add_floor(floor, 'new')
+            elif stored_floors[floor['id']][0] != floor['updated']:
+                plan.add_floor(floor, 'floor')
+
+    plan.removed_floors = set(stored_floors) - set(upstream_floors)
+
+    # Rooms, a changed, added or removed room invalidates the floor it is (or was) on
+    upstream_rooms = set()
+    room_versions = {}
+    # Streamed, as the room list is the largest response of the planner (every room of the campus)
+    for room in api.iter_workspace():
+        upstream_rooms.add(room['id'])
+        _add_room(room_versions, room)
+        floor_id = room.get('floorId')
+
+        if room['id'] in stored_rooms:
+            timestamp, stored_floor_id = stored_rooms[room['id']]
+            if timestamp == room.get('updated') and floor_id in (None, stored_floor_id):
+                continue
+            floor_ids = {stored_floor_id, floor_id}
+        else:
+            floor_ids = {floor_id}
+
+        for floor_id in floor_ids:
+            if floor_id in upstream_floors:
+                plan.add_floor(upstream_floors[floor_id], 'rooms')
+
+    plan.removed_rooms = set(stored_rooms) - upstream_rooms
+    for room_id in plan.removed_rooms:
+        floor_id = stored_rooms[room_id][1]
+        if floor_id in upstream_floors:
+            plan.add_floor(upstream_floors[floor_id], 'rooms')
+
+    room_versions = _room_versions(room_versions)
+    for floor_id, floor in plan.floors.items():
+        floor['roomsUpdated'] = room_versions.get(floor_id)
+
+    return plan
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# The tools are flat modules that import each other by name, as when they are run from their directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_requests
+from api_requests import API_Requests
+from response_cache import ResponseCache
+from standin_server import SyntheticCampus, serve_in_thread
+
+
+@pytest.fixture
+def campus():
+    return SyntheticCampus(buildings=3, floors=2, rooms=6, seed=1)
+
+
+@pytest.fixture
+def api(campus, monkeypatch):
+    '''API_Requests against a stand-in server of the campus, without response cache.'''
+    monkeypatch.delenv('PYTHAGORAS_CACHE_DIR', raising=False)
+    server, url = serve_in_thread(campus=campus)
+    yield API_Requests(api_url=url, max_retries=0)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def env_api(api, tmp_path, monkeypatch):
+    '''Points the API_Requests created by the converter at the stand-in server, with a cache whose TTL has expired.'''
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setenv('PYTHAGORAS_API_URL', api.api_url)
+    monkeypatch.setenv('PYTHAGORAS_CACHE_DIR', cache_dir)
+    monkeypatch.setattr(api_requests, '_env_cache', ResponseCache(cache_dir, ttl=0))
@@ -0,0 +1,125 @@
+import json
+import time
+import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from api_requests import API_Requests, _SingleFlight, _iter_json_array
+from response_cache import ResponseCache
+
+
+RECORDS = [
+    {'id': 1, 'name': 'B\u00e4ck [lab], "north"', 'path': 'C:\\rooms\\', 'area': 12.5},
+    {'id': 2, 'name': '\u6d4b\u8bd5 \U0001f3eb', 'outline': [[0.125, -1e-3], [1.5, 2.0]], 'tags': []},
+    [],
+    3.25,
+    'text with ] and , and \\"',
+    None,
+]
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+def test_iter_json_array_chunk_boundaries(ensure_ascii):
+    data = json.dumps(RECORDS, ensure_ascii=ensure_ascii, indent=1).encode()
+
+    # Every chunk size cuts through strings, escapes, multi-byte characters and numbers somewhere
+    for size in range(1, 24):
+        assert list(_iter_json_array(chunked(data, size))) == RECORDS
+
+
+@pytest.mark.parametrize('data', [b'[]', b'  [ \n ] '])
+def test_iter_json_array_empty(data):
+    assert list(_iter_json_array(chunked(data, 1))) == []
+
+
+@pytest.mark.parametrize('data', [b'', b'  ', b'['])
+def test_iter_json_array_truncated(data):
+    with pytest.raises(ValueError, match='Unexpected end'):
+        list(_iter_json_array(chunked(data, 1)))
+
+
+@pytest.mark.parametrize('data', [b'{"id": 1}', b'[{"id": 1}', b'[1 2]', b'[{"id": 1}, {"id": }]', b'[1.5'])
+def test_iter_json_array_malformed(data):
+    with pytest.raises(ValueError):
+        list(_iter_json_array(chunked(data, 3)))
+
+
+def test_stream(api, campus):
+    assert list(api.iter_workspace()) == api.get_workspace()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert list(api.iter_floor_id_workspace_info(10 ** 9)) == []
+    assert '404' in str(caught[0].message)
+
+
+@pytest.fixture
+def cached_api(api, tmp_path):
+    return API_Requests(ResponseCache(str(tmp_path), ttl=0), api_url=api.api_url, max_retries=0)
+
+
+@pytest.mark.parametrize('method', ['get_floor_id_workspace_info', 'iter_floor_id_workspace_info'])
+def test_workspace_info_served_from_cache_by_timestamp(cached_api, campus, method):
+    floor_id = next(iter(campus.floors))
+
+    def rooms(updated):
+        return sorted(room['id'] for room in getattr(cached_api, method)(floor_id, updated=updated))
+
+    first = rooms(updated=1)
+    removed = first[0]
+    del campus.workspaces[removed]
+
+    # Same timestamp: the cached response is used, even though the cache entry is past its TTL
+    assert rooms(updated=1) == first
+    # A new timestamp refetches
+    assert rooms(updated=2) == first[1:]
+
+
+def single_flight_calls(fn, callers=4):
+    '''Calls fn through one _SingleFlight from several threads at once, while fn is held in flight.'''
+    flight = _SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait()
+        return fn()
+
+    with ThreadPoolExecutor(callers) as pool:
+        futures = [pool.submit(flight.do, 'key', call) for _ in range(callers)]
+        time.sleep(0.2) # every caller arrives while the first call is in flight
+        release.set()
+
+    return flight, calls, futures
+
+
+def test_single_flight_shares_result():
+    result = {'id': 1}
+    flight, calls, futures = single_flight_calls(lambda: result)
+
+    assert len(calls) == 1
+    assert all(future.result()[0] is result for future in futures)
+    assert sorted(future.result()[1] for future in futures) == [False, True, True, True]
+
+    # Once the call finished the key is forgotten
+    assert flight.do('key', lambda: 2) == (2, False)
+
+
+def test_single_flight_shares_error():
+    def fail():
+        raise RuntimeError('API down')
+
+    flight, calls, futures = single_flight_calls(fail)
+
+    assert len(calls) == 1
+    for future in futures:
+        with pytest.raises(RuntimeError, match='API down'):
+            future.result()
+    assert flight.do('key', lambda: 2) == (2, False)
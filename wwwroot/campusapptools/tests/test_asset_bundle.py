@@ -0,0 +1,87 @@
+import os
+import importlib.util
+
+import pytest
+
+import asset_bundle
+import converter
+
+
+def load_client_utils():
+    '''Imports client/utils.py, which has its own copy of the bundle layout, as the client does not ship these tools.'''
+    path = os.path.join(os.path.dirname(__file__), '..', '..', 'client', 'utils.py')
+    spec = importlib.util.spec_from_file_location('client_utils', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+ASSETS = {
+    'model_floors/floor_930_floors.glb': b'floors of 930',
+    'model_shells/floor_930_shells.glb': b'shell',
+    'model_outsides/floor_931_outsides_lod1.glb': os.urandom(1000),
+    'model_shells/floor_931_shells.glb': b'',
+}
+
+
+def test_round_trip():
+    bundle = asset_bundle.pack_bundle(12, ASSETS)
+
+    assert asset_bundle.unpack_bundle(bundle) == ASSETS
+
+    index = asset_bundle.read_index(bundle[:asset_bundle.BUNDLE_PREFIX_SIZE + asset_bundle.index_size(bundle)])
+    assert index['building_id'] == 12
+    assert [(entry['lod'], entry['floor_id']) for entry in index['entries']] == [(0, 930), (1, 931), (2, 930), (2, 931)]
+    assert all(entry['offset'] % 8 == 0 for entry in index['entries'])
+    assert len(bundle) % 8 == 0
+
+
+def test_corrupt_bundle():
+    bundle = bytearray(asset_bundle.pack_bundle(12, ASSETS))
+    entry = asset_bundle.read_index(bundle)['entries'][0]
+    bundle[entry['offset']] ^= 0xFF
+
+    with pytest.raises(ValueError, match='Corrupt asset'):
+        asset_bundle.unpack_bundle(bytes(bundle))
+    assert len(asset_bundle.unpack_bundle(bytes(bundle), verify=False)) == len(ASSETS)
+
+    with pytest.raises(ValueError, match='Not an asset bundle'):
+        asset_bundle.read_index(b'glTF' + bytes(bundle[4:]))
+
+
+@pytest.mark.parametrize('filters', [{}, {'lods': [0]}, {'lods': [1, 2], 'floor_ids': [931]}])
+def test_client_reads_bundle(filters, monkeypatch):
+    client = load_client_utils()
+    assert client.BUNDLE_MAGIC == asset_bundle.BUNDLE_MAGIC
+    assert client.BUNDLE_PREFIX.format == asset_bundle.BUNDLE_PREFIX.format
+
+    bundle = asset_bundle.pack_bundle(12, ASSETS)
+    requested = []
+
+    def get(url, headers=None, params=None):
+        assert url.endswith(asset_bundle.bundle_path(12))
+        if headers is None:
+            return FakeResponse(200, bundle)
+        start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+        requested.append((start, end + 1))
+        return FakeResponse(206, bundle[start:end + 1])
+
+    monkeypatch.setattr(client.requests, 'get', get)
+    monkeypatch.setattr(client, 'INDEX_PREFETCH', 64) # smaller than the index, so it is fetched in two requests
+
+    def wanted(path):
+        info = converter.asset_info(path)
+        return (info['lod'] in filters.get('lods', [info['lod']])
+                and info['floor_id'] in filters.get('floor_ids', [info['floor_id']]))
+
+    assert client.get_building_bundle(12, **filters) == {path: data for path, data in ASSETS.items() if wanted(path)}
+    if filters:
+        assert requested[:2] == [(0, 64), (64, asset_bundle.BUNDLE_PREFIX_SIZE + asset_bundle.index_size(bundle))]
@@ -0,0 +1,64 @@
+import copy
+import json
+
+import converter
+from asset_manifest import AssetManifest, manifest_path
+
+
+def test_hashes_ignore_attributes(campus):
+    floor_id, data_floor = next(iter(campus.floor_infos.items()))
+    data_outlines = [room for room in campus.workspaces.values() if room['floorId'] == floor_id]
+    hashes = converter.asset_input_hashes(floor_id, data_floor, data_outlines)
+
+    renamed = copy.deepcopy(data_floor)
+    renamed['name'], renamed['updated'] = 'renamed', renamed.get('updated', 0) + 1
+    outlines = [dict(room, name='renamed', updated=room['updated'] + 1) for room in data_outlines]
+    assert converter.asset_input_hashes(floor_id, renamed, outlines) == hashes
+
+    # Moving an interior wall only changes the assets made from interior walls
+    moved = copy.deepcopy(data_floor)
+    wall = next(wall for wall in moved['wallInfos'] if converter.wall_category(wall) == (True, False))
+    wall['endX'] += 0.5
+    changed = converter.asset_input_hashes(floor_id, moved, data_outlines)
+    assert {path for path in hashes if changed[path] != hashes[path]} == {
+        converter.asset_path(floor_id, 'insides'), converter.asset_path(floor_id, 'insides_lod1')}
+
+
+def test_remove_floor_keeps_other_floors(tmp_path):
+    manifest = AssetManifest(str(tmp_path / 'manifest.json'))
+    for floor_id in (1, 2):
+        for kind in ('outsides', 'insides'):
+            path = converter.asset_path(floor_id, kind)
+            manifest.update(path, 'hash', **converter.asset_info(path))
+
+    removed = manifest.remove_floor(1, keep={converter.asset_path(1, 'outsides')})
+    assert removed == [converter.asset_path(1, 'insides')]
+    assert manifest.lod_index() == {
+        '1': {'0': [converter.asset_path(1, 'outsides')]},
+        '2': {'0': [converter.asset_path(2, 'insides'), converter.asset_path(2, 'outsides')]},
+    }
+
+
+def test_save_merges_changes_of_other_processes(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    first, second = AssetManifest(path), AssetManifest(path)
+
+    first.update('a.glb', 'hash a')
+    first.update('b.glb', 'hash b')
+    first.save()
+
+    # second was loaded before first saved, so it only writes over its own changes
+    second.update('c.glb', 'hash c')
+    second.remove('a.glb')
+    second.save()
+
+    with open(path, 'r') as f:
+        assert sorted(json.load(f)) == ['b.glb', 'c.glb']
+    assert AssetManifest(path).is_current('b.glb', 'hash b')
+    assert not AssetManifest(path).is_current('b.glb', 'hash c')
+
+
+def test_one_manifest_per_destination(tmp_path):
+    directory = str(tmp_path)
+    assert manifest_path('file:///out', directory) == manifest_path('file:///out', directory)
+    assert manifest_path('file:///out', directory) != manifest_path('https://account/container', directory)
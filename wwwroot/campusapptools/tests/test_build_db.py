@@ -0,0 +1,141 @@
+import os
+import sqlite3
+
+import pytest
+
+import build_db
+import sync_planner
+
+
+def published(path):
+    '''Returns the published snapshot and the snapshot files next to the database.'''
+    directory = os.path.dirname(path)
+    return build_db.current_snapshot(path), sorted(name for name in os.listdir(directory) if name.endswith('.db'))
+
+
+def count(snapshot, table):
+    with sqlite3.connect(snapshot) as conn:
+        return conn.execute(f'select count(*) from {table}').fetchone()[0]
+
+
+def test_full_sync_publishes_snapshot(api, campus, tmp_path):
+    path = str(tmp_path / 'spaces.db')
+    build_db.full_sync(api, path, fetch_workers=2)
+
+    snapshot, files = published(path)
+    assert os.path.basename(snapshot) == open(build_db.pointer_path(path)).read()
+    assert files == [os.path.basename(snapshot)] # no WAL/journal files, nothing else left behind
+    assert not os.path.exists(f'{snapshot}-wal')
+    assert count(snapshot, 'buildings') == len(campus.buildings)
+    assert count(snapshot, 'floors') == len(campus.floors)
+    assert count(snapshot, 'rooms') == len(campus.workspaces)
+
+    with sqlite3.connect(snapshot) as conn:
+        assert conn.execute('pragma journal_mode').fetchone()[0] == 'delete'
+        assert conn.execute('pragma user_version').fetchone()[0] == build_db.SCHEMA_VERSION
+
+
+def test_failed_sync_keeps_published_snapshot(api, tmp_path, monkeypatch):
+    path = str(tmp_path / 'spaces.db')
+    build_db.full_sync(api, path, fetch_workers=2)
+    before = published(path)
+
+    def fetch_floor_rows(api, floor):
+        raise RuntimeError('API down')
+
+    monkeypatch.setattr(build_db, 'fetch_floor_rows', fetch_floor_rows)
+    with pytest.raises(RuntimeError, match='API down'):
+        build_db.full_sync(api, path, fetch_workers=2)
+
+    assert published(path) == before
+    assert sorted(os.listdir(tmp_path)) == sorted(before[1] + [os.path.basename(build_db.pointer_path(path))])
+
+
+def test_sync_rejects_invalid_snapshot(api, campus, tmp_path):
+    path = str(tmp_path / 'spaces.db')
+    campus.floors.clear()
+
+    with pytest.raises(ValueError, match='empty'):
+        build_db.full_sync(api, path, fetch_workers=2)
+
+    assert build_db.current_snapshot(path) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_validate_snapshot(tmp_path):
+    conn = build_db.connect(str(tmp_path / 'spaces.db'))
+    with build_db.transaction(conn) as cursor:
+        build_db.create_tables(cursor)
+        cursor.execute('insert into buildings (building_id) values (1)')
+        cursor.execute('insert into floors (floor_id, building_id) values (10, 1)')
+        cursor.execute('insert into rooms (room_id, floor_id) values (100, 10)')
+
+    build_db.validate_snapshot(conn, buildings=1, floors=1)
+
+    with pytest.raises(ValueError, match='instead of 2'):
+        build_db.validate_snapshot(conn, buildings=2)
+
+    conn.execute('insert into rooms (room_id, floor_id) values (101, 11)')
+    with pytest.raises(ValueError, match='1 rooms without floor'):
+        build_db.validate_snapshot(conn)
+
+    conn.execute('delete from rooms where room_id=101')
+    conn.execute('pragma user_version=1')
+    with pytest.raises(ValueError, match='schema version 1'):
+        build_db.validate_snapshot(conn)
+
+
+def test_incremental_sync(api, campus, tmp_path):
+    path = str(tmp_path / 'spaces.db')
+    build_db.full_sync(api, path, fetch_workers=2)
+    first, _ = published(path)
+
+    # Nothing changed: no new snapshot
+    build_db.incremental_sync(api, path=path, fetch_workers=2)
+    assert published(path)[0] == first
+
+    floor_id = next(iter(campus.floors))
+    room_id = next(room_id for room_id, room in campus.workspaces.items() if room['floorId'] == floor_id)
+    del campus.workspaces[room_id]
+    campus.floors[floor_id]['updated'] += 1
+    campus.floor_infos[floor_id]['updated'] += 1
+
+    build_db.incremental_sync(api, path=path, fetch_workers=2)
+    second, files = published(path)
+    assert second != first
+    assert files == sorted(os.path.basename(snapshot) for snapshot in (first, second))
+    assert count(second, 'rooms') == len(campus.workspaces) == count(first, 'rooms') - 1
+
+    with sqlite3.connect(second) as conn:
+        updated = conn.execute('select timestamp from floors where floor_id=?', (floor_id,)).fetchone()[0]
+    assert updated == campus.floors[floor_id]['updated']
+
+
+def test_publish_keeps_latest_snapshots(tmp_path):
+    path = str(tmp_path / 'spaces.db')
+    for version in range(1, 6):
+        snapshot = build_db.snapshot_path(path, version)
+        build_db.publish_snapshot(path, snapshot, build_db.connect(snapshot), keep=2)
+
+    assert build_db.current_snapshot(path) == build_db.snapshot_path(path, 5)
+    assert sorted(os.listdir(tmp_path)) == ['spaces-4.db', 'spaces-5.db', 'spaces.db.current']
+
+
+def test_plan_of_empty_database(api, campus):
+    plan = sync_planner.plan_sync(api, sqlite3.connect(':memory:'))
+    assert sorted(plan.refetch_floors) == sorted(campus.floors)
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table buildings (building_id int)')
+    with pytest.raises(sqlite3.OperationalError, match='no such column'):
+        sync_planner.plan_sync(api, conn)
+
+
+def test_plan_floors_carry_room_versions(api, campus):
+    plan = sync_planner.plan_sync(api, sqlite3.connect(':memory:')).to_dict()
+    versions = sync_planner.rooms_updated(api.get_workspace())
+
+    assert [floor['id'] for floor in plan['floors']] == plan['remesh_floors']
+    for floor in plan['floors']:
+        rooms = [room for room in campus.workspaces.values() if room['floorId'] == floor['id']]
+        assert floor['roomsUpdated'] == versions[floor['id']] == max(room['updated'] for room in rooms) + len(rooms)
@@ -0,0 +1,74 @@
+import copy
+
+import numpy as np
+import pytest
+
+import converter
+from campus_frame import LEVEL_HEIGHT, SLAB_HEIGHT, CampusFrame, floor_offsets
+
+
+BUILDING_OFFSET = [120.5, -40.25, -3.2, 1.1]
+
+
+@pytest.fixture
+def frame(campus):
+    building_id = next(iter(campus.buildings))
+    floor_ids = [floor_id for floor_id, floor in campus.floors.items() if floor['buildingId'] == building_id]
+
+    frame = CampusFrame()
+    frame.add_building(BUILDING_OFFSET, floor_ids, [campus.floor_infos[floor_id] for floor_id in floor_ids])
+    return frame, floor_ids
+
+
+def test_floor_offsets():
+    walls = [{'height': 2.8}, {'height': 3.5}, {'height': None}]
+    data_floors = [{'wallInfos': walls}, {'wallInfos': [{'height': None}]}, {'wallInfos': []}]
+    offsets = floor_offsets(BUILDING_OFFSET, data_floors)
+
+    x, y, z, angle = BUILDING_OFFSET
+    elevations = [z, z + 3.5 + SLAB_HEIGHT, z + 3.5 + SLAB_HEIGHT + LEVEL_HEIGHT]
+    assert offsets == [[x, y, pytest.approx(elevation), angle] for elevation in elevations]
+
+
+def test_transform_matches_offset_matrix(frame):
+    frame, floor_ids = frame
+    points = np.random.default_rng(0).uniform(-50, 50, (20, 3))
+
+    for floor_id in floor_ids:
+        matrix = converter.offset_matrix(frame.floor_offset(floor_id))
+        expected = points @ matrix[:3, :3].T + matrix[:3, 3]
+        np.testing.assert_allclose(frame.transform(points, floor_id), expected, atol=1e-9)
+        np.testing.assert_allclose(frame.transform(points[:, :2], floor_id), frame.transform(
+            np.hstack([points[:, :2], np.zeros((20, 1))]), floor_id))
+
+    with pytest.raises(KeyError):
+        frame.transform(points, 10 ** 9)
+
+
+def test_campus_floor_meshes_like_the_offset(frame, campus):
+    frame, floor_ids = frame
+
+    for floor_id in floor_ids:
+        data_floor = campus.floor_infos[floor_id]
+        data_outlines = [room for room in campus.workspaces.values() if room['floorId'] == floor_id]
+        before = copy.deepcopy((data_floor, data_outlines))
+
+        moved_floor, moved_outlines, offset = frame.campus_floor(floor_id, data_floor, data_outlines)
+        assert (data_floor, data_outlines) == before
+        assert offset == [0, 0, frame.floor_offset(floor_id)[2], 0]
+
+        # Meshing the moved data with the height offset is the same as meshing the data with the full offset
+        full = frame.floor_offset(floor_id)
+        for moved, original in zip(converter.build_wall_meshes(moved_floor['wallInfos'], offset),
+                                   converter.build_wall_meshes(data_floor['wallInfos'], full)):
+            np.testing.assert_allclose(moved.vertices, original.vertices, atol=1e-9)
+        for moved, original in zip(moved_floor['columnInfos'], data_floor['columnInfos']):
+            np.testing.assert_allclose(converter.Column(moved, offset=offset).mesh.bounds,
+                                       converter.Column(original, offset=full).mesh.bounds, atol=1e-9)
+        for moved, original in zip(moved_outlines, data_outlines):
+            np.testing.assert_allclose(converter.Floor(moved, offset=offset).mesh.bounds,
+                                       converter.Floor(original, offset=full).mesh.bounds, atol=1e-9)
+            utility = frame.transform([[original['utilityCoord']['x'], original['utilityCoord']['y']]], floor_id)
+            assert [moved['utilityCoord']['x'], moved['utilityCoord']['y']] == pytest.approx(utility[0, :2].tolist())
+
+        assert frame.campus_floor(floor_id, data_floor, None)[1] is None
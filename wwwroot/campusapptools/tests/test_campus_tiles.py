@@ -0,0 +1,141 @@
+import gc
+import os
+import json
+import tracemalloc
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+import campus_tiles
+import converter
+from asset_sink import LocalSink
+from glb import GLBReader
+from standin_server import SyntheticCampus
+
+
+@pytest.fixture
+def campus():
+    return SyntheticCampus(buildings=5, floors=2, rooms=6, seed=1)
+
+
+@pytest.fixture
+def corrections(campus):
+    '''Corrections for all but the last building: two pairs of neighbours far apart, so the tree has every level.'''
+    names = [building['name'] for building in campus.buildings.values()]
+    positions = [(0, 0), (60, 10), (500, 300), (560, 320)]
+    return {name: [x, y, 0.0, 0.3 * i] for i, (name, (x, y)) in enumerate(zip(names, positions))}
+
+
+def tiles(node):
+    yield node
+    for child in node.get('children', []):
+        yield from tiles(child)
+
+
+def box_bounds(box):
+    center, half = np.array(box[:3]), np.array([box[3], box[7], box[11]])
+    return np.array([center - half, center + half])
+
+
+def test_tileset(env_api, api, campus, corrections, tmp_path):
+    sink = LocalSink(str(tmp_path / 'assets'))
+    tileset = campus_tiles.create_tileset(api, list(campus.buildings.values()), sink, corrections)
+
+    assert json.loads(sink.get('tiles/tileset.json')) == tileset
+    assert tileset['root']['extras']['buildings'] == sorted(corrections)
+    assert [tile['extras']['lod'] for tile in tiles(tileset['root'])] == [2, 1, 0, 0, 1, 0, 0]
+
+    for tile in tiles(tileset['root']):
+        bounds = box_bounds(tile['boundingVolume']['box'])
+        children = tile.get('children', [])
+
+        if not children:
+            assert len(tile['extras']['buildings']) == 1
+            assert tile['extras']['lod'] == 0 and tile['geometricError'] == 0
+        for child in children:
+            assert child['geometricError'] < tile['geometricError']
+            child_bounds = box_bounds(child['boundingVolume']['box'])
+            assert np.all(child_bounds[0] >= bounds[0] - 1e-6) and np.all(child_bounds[1] <= bounds[1] + 1e-6)
+
+        # The content is in the campus frame and within the bounding volume of its tile
+        with GLBReader(sink.get(f"tiles/{tile['content']['uri']}")) as glb:
+            content = glb.bounds()
+        assert np.all(content[0] >= bounds[0] - 1e-3) and np.all(content[1] <= bounds[1] + 1e-3)
+
+
+class FailingSink(LocalSink):
+
+    def put_file(self, path, filename, delete=False):
+        if 'root_' not in path:
+            return super().put_file(path, filename, delete)
+
+        if delete:
+            os.remove(filename)
+        future = Future()
+        future.set_exception(OSError('upload failed'))
+        return future
+
+
+def test_tileset_not_published_if_a_tile_failed(env_api, api, campus, corrections, tmp_path):
+    sink = FailingSink(str(tmp_path / 'assets'))
+
+    with pytest.raises(OSError, match='upload failed'):
+        campus_tiles.create_tileset(api, list(campus.buildings.values()), sink, corrections)
+    assert not (tmp_path / 'assets' / 'tiles' / 'tileset.json').exists()
+
+
+class CampusAPI:
+    '''The endpoints create_tileset uses, answered in process, so the peak memory only counts the tiling.'''
+
+    def __init__(self, campus):
+        self.campus = campus
+
+    def get_building_id_floor(self, building_id):
+        return self.campus.respond(f'building/{building_id}/floor', {})
+
+    def iter_workspace(self):
+        for room in self.campus.workspaces.values():
+            yield {'id': room['id'], 'floorId': room['floorId'], 'updated': room['updated']}
+
+
+def tiling_peak_memory(buildings, tmp_path, monkeypatch):
+    campus = SyntheticCampus(buildings=buildings, floors=2, rooms=12, seed=1)
+    corrections = {building['name']: [60.0 * (i % 4), 60.0 * (i // 4), 0.0, 0.0]
+                   for i, building in enumerate(campus.buildings.values())}
+
+    def fetch_floor(floor_id, updated=None, rooms_updated=None):
+        rooms = [room for room in campus.workspaces.values() if room['floorId'] == floor_id]
+        return campus.floor_infos[floor_id], rooms
+
+    # trimesh meshes hold reference cycles, so collect them at every floor to measure what is kept alive
+    def collected(function):
+        def call(*args):
+            gc.collect()
+            return function(*args)
+        return call
+
+    monkeypatch.setattr(converter, 'fetch_floor', fetch_floor)
+    monkeypatch.setattr(campus_tiles, 'floor_meshes', collected(campus_tiles.floor_meshes))
+    monkeypatch.setattr(campus_tiles, 'floor_bounds', collected(campus_tiles.floor_bounds))
+
+    sink = LocalSink(str(tmp_path / f'assets_{buildings}'))
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tileset = campus_tiles.create_tileset(CampusAPI(campus), list(campus.buildings.values()), sink, corrections)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        monkeypatch.undo()
+
+    assert len(tileset['root']['extras']['buildings']) == buildings
+    return peak
+
+
+def test_peak_memory_does_not_grow_with_the_campus(tmp_path, monkeypatch):
+    small = tiling_peak_memory(2, tmp_path, monkeypatch)
+    large = tiling_peak_memory(8, tmp_path, monkeypatch)
+
+    # Four times the campus: only the tileset, the placements and the JSON of the tiles near the root grow
+    assert large < 1.2 * small
@@ -0,0 +1,117 @@
+import collections
+
+import numpy as np
+import pytest
+import trimesh
+
+import converter
+from asset_manifest import AssetManifest
+from asset_sink import LocalSink
+
+
+@pytest.fixture
+def hits(campus, monkeypatch):
+    '''Counts the requests the stand-in server answers (including 304 Not Modified), by path.'''
+    hits = collections.Counter()
+    respond = campus.respond
+
+    def counting_respond(path, query):
+        hits[path] += 1
+        return respond(path, query)
+
+    monkeypatch.setattr(campus, 'respond', counting_respond)
+    return hits
+
+
+def floor_requests(hits):
+    return {path: count for path, count in hits.items() if path.startswith('floor/')}
+
+
+def test_unchanged_building_is_not_fetched_again(env_api, campus, hits, tmp_path):
+    building_id = next(iter(campus.buildings))
+    sink = LocalSink(str(tmp_path / 'assets'))
+    manifest = AssetManifest(str(tmp_path / 'manifest.json'))
+
+    converter.create_building(building_id, manifest, sink=sink)
+    sink.flush()
+    assert len(floor_requests(hits)) > 0
+
+    hits.clear()
+    converter.create_building(building_id, manifest, sink=sink)
+    assert floor_requests(hits) == {}
+
+    # A removed room does not change the latest timestamp of the rooms, but their number
+    floor_id = next(floor_id for floor_id, floor in campus.floors.items() if floor['buildingId'] == building_id)
+    room_id = next(room_id for room_id, room in campus.workspaces.items() if room['floorId'] == floor_id)
+    del campus.workspaces[room_id]
+
+    hits.clear()
+    converter.create_building(building_id, manifest, sink=sink)
+    assert floor_requests(hits) == {f'floor/{floor_id}/workspace/info': 1}
+
+
+def stored_files(root):
+    return sorted(str(path.relative_to(root)) for path in root.rglob('*.glb'))
+
+
+def test_unchanged_assets_are_skipped_and_removed_ones_pruned(env_api, campus, tmp_path):
+    floor_id, data_floor = next(iter(campus.floor_infos.items()))
+    sink = LocalSink(str(tmp_path / 'assets'))
+    manifest = AssetManifest(str(tmp_path / 'manifest.json'))
+
+    futures = converter.create_floor(floor_id, manifest=manifest, sink=sink)
+    assert len(futures) == len(converter.ASSET_LODS)
+    for future in futures:
+        future.result()
+    stored = stored_files(tmp_path / 'assets')
+
+    assert converter.create_floor(floor_id, manifest=manifest, sink=sink) == []
+    assert converter.create_floor(floor_id, manifest=manifest, sink=sink, force=True) != []
+
+    # Without interior walls the floor has no insides any more, so they leave the manifest (and the LOD index)
+    data_floor['wallInfos'] = [wall for wall in data_floor['wallInfos'] if converter.wall_category(wall)[1]]
+    assert converter.create_floor(floor_id, manifest=manifest, sink=sink) == []
+
+    insides = {converter.asset_path(floor_id, 'insides'), converter.asset_path(floor_id, 'insides_lod1')}
+    assert insides <= set(stored)
+    assert set(AssetManifest(manifest.path).assets) == set(stored) - insides
+    lods = manifest.lod_index()[str(floor_id)]
+    assert not insides & {path for paths in lods.values() for path in paths}
+
+
+def per_wall_meshes(data_walls, offset):
+    '''The interior and exterior walls built one Wall at a time.'''
+    meshes = ([], [])
+    for data in data_walls:
+        wall = converter.Wall(data, offset=offset)
+        for i, tag in enumerate(('isInternalWall', 'isExternalWall')):
+            if wall.tags[tag]:
+                meshes[i].append(wall.mesh)
+
+    return tuple(trimesh.util.concatenate(parts) if parts else None for parts in meshes)
+
+
+def corners(mesh):
+    return np.unique(mesh.vertices.round(6), axis=0)
+
+
+@pytest.mark.parametrize('openings', [True, False])
+def test_build_wall_meshes_matches_walls(campus, openings):
+    offset = [12.5, -3.0, 6.4, 0.7]
+    data_walls = [wall for info in campus.floor_infos.values() for wall in info['wallInfos']]
+    if not openings:
+        data_walls = [dict(wall, doorInfos=[], windowInfos=[]) for wall in data_walls]
+    assert any(wall['doorInfos'] for wall in data_walls) == openings
+
+    batched = converter.build_wall_meshes(data_walls, offset, openings=openings)
+    expected = per_wall_meshes(data_walls, offset)
+
+    for mesh, reference in zip(batched, expected):
+        assert (mesh is None) == (reference is None)
+        if mesh is None:
+            continue
+        # The boxes are triangulated differently than Wall does, so compare the solids rather than the faces
+        assert mesh.volume == pytest.approx(reference.volume)
+        assert mesh.area == pytest.approx(reference.area)
+        np.testing.assert_allclose(mesh.bounds, reference.bounds, atol=1e-9)
+        np.testing.assert_allclose(corners(mesh), corners(reference), atol=1e-6)
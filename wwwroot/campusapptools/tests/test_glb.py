@@ -0,0 +1,122 @@
+import io
+
+import numpy as np
+import pytest
+import trimesh
+
+import converter
+from glb import GLBBuilder, GLBReader, StreamingGLBBuilder, quantization_grid
+
+
+def scene_objects():
+    box = converter.Object(trimesh.creation.box([4, 2, 3]), 'box', offset=[10, -5, 1.5, 0.3])
+    cylinder = converter.Object(trimesh.creation.cylinder(0.5, 3, sections=12), 'cylinder', offset=[-2, 8, 0, 0])
+
+    angles = [0, np.pi / 2, 1.0]
+    transforms = np.array([trimesh.transformations.rotation_matrix(angle, [0, 0, 1]) for angle in angles])
+    transforms[:, :3, 3] = [[0, 0, 0], [5, 0, 0], [5, 5, 2]]
+    columns = converter.InstancedObject(trimesh.creation.box([0.3, 0.3, 3]), transforms, 'columns')
+
+    return [box, cylinder, columns]
+
+
+def trimesh_bounds(data):
+    return trimesh.load(io.BytesIO(data), file_type='glb', force='scene').bounds
+
+
+def object_bounds(objects):
+    return trimesh.util.concatenate([obj.mesh for obj in objects]).bounds
+
+
+@pytest.mark.parametrize('options', [{}, {'quantize': True}, {'instancing': True}, {'quantize': True, 'instancing': True}])
+def test_reader_matches_trimesh(options):
+    objects = scene_objects()
+    data = converter.Scene(objects).to_glb(**options)
+
+    with GLBReader(data) as glb:
+        assert glb.triangles() == sum(len(obj.mesh.faces) for obj in objects)
+        # The box of a rotated instance is transformed as a box, so its corners may stick out a little
+        assert np.allclose(glb.bounds(), object_bounds(objects), atol=0.1)
+        if not options.get('instancing'):
+            # trimesh does not read EXT_mesh_gpu_instancing
+            assert np.allclose(glb.bounds(), trimesh_bounds(data), atol=0.01)
+
+
+@pytest.mark.parametrize('options', [{}, {'quantize': True, 'instancing': True}])
+def test_streamed_glb_matches_scene(options, tmp_path):
+    objects = scene_objects()
+    bounds = object_bounds([obj for obj in objects if not options.get('instancing')
+                            or not isinstance(obj, converter.InstancedObject)])
+
+    path = tmp_path / 'streamed.glb'
+    size = converter.stream_glb(iter(objects), str(path), bounds, **options)
+    assert size == path.stat().st_size
+
+    expected = GLBBuilder(quantization_grid(bounds, 0.005) if options else None)
+    with StreamingGLBBuilder(expected.quantization, block_size=64) as streamed:
+        for builder in (expected, streamed):
+            for obj in objects:
+                builder.add_mesh(obj.name, obj.mesh)
+        # Copied from the spools in blocks of 64 bytes
+        assert streamed.to_bytes() == expected.to_bytes()
+        assert len(streamed.spools) > 0
+
+    if options:
+        assert path.read_bytes() == converter.Scene(objects).to_glb(**options)
+
+
+def test_reader_from_file(tmp_path):
+    path = tmp_path / 'scene.glb'
+    converter.Scene(scene_objects()).export(str(path), quantize=True)
+
+    with GLBReader(str(path)) as glb:
+        assert glb.length == path.stat().st_size
+        assert 'KHR_mesh_quantization' in glb.gltf['extensionsRequired']
+        assert np.allclose(glb.bounds(), trimesh_bounds(path.read_bytes()), atol=0.01)
+
+
+def test_reader_rejects_other_files():
+    with pytest.raises(ValueError, match='Not a GLB file'):
+        GLBReader(b'\x00' * 20)
+
+
+def decoded_triangles(glb):
+    '''Returns the (n, 3, 3) corners of every triangle of the scene in world coordinates, in the order written.'''
+    triangles = []
+    for node, matrix in sorted(glb.mesh_nodes(), key=lambda item: item[0]['mesh']):
+        for primitive in glb.gltf['meshes'][node['mesh']]['primitives']:
+            positions = np.asarray(glb.accessor(primitive['attributes']['POSITION']), dtype=np.float64)
+            positions = positions @ matrix[:3, :3].T + matrix[:3, 3]
+            triangles.append(positions[np.asarray(glb.accessor(primitive['indices'])).reshape(-1, 3)])
+
+    return np.concatenate(triangles)
+
+
+@pytest.mark.parametrize('tolerance', [0.005, 0.0005])
+def test_quantization_within_tolerance(tolerance):
+    objects = scene_objects()
+    expected = np.concatenate([obj.mesh.vertices[obj.mesh.faces] for obj in objects])
+
+    with GLBReader(converter.Scene(objects).to_glb(quantize=True, tolerance=tolerance)) as glb:
+        assert 'KHR_mesh_quantization' in glb.gltf['extensionsRequired']
+        error = np.abs(decoded_triangles(glb) - expected).max()
+
+    assert 0 < error <= tolerance
+
+
+def test_quantization_grid_too_coarse():
+    bounds = np.array([[0, 0, 0], [300, 20, 10]])
+
+    # 300 m on 65535 steps of 4.6 mm: half a step is within 5 mm, but not within 1 mm
+    translation, scale = quantization_grid(bounds, tolerance=0.005)
+    assert np.allclose(translation, [150, 10, 5])
+    assert scale * 32767 >= 150
+    assert quantization_grid(bounds, tolerance=0.001) is None
+
+    # A scene that is too large for its tolerance keeps float positions
+    objects = [scene_objects()[0], converter.Object(trimesh.creation.box([1, 1, 1]), 'far', offset=[5000, 0, 0, 0])]
+    expected = np.concatenate([obj.mesh.vertices[obj.mesh.faces] for obj in objects])
+
+    with GLBReader(converter.Scene(objects).to_glb(quantize=True, tolerance=0.001)) as glb:
+        assert 'KHR_mesh_quantization' not in glb.gltf.get('extensionsUsed', [])
+        assert np.abs(decoded_triangles(glb) - expected).max() < 1e-3
@@ -0,0 +1,180 @@
+import json
+import shutil
+import threading
+
+import pytest
+
+import converter
+from asset_sink import LocalSink
+from job_queue import JobQueue, RemoteJobQueue, publish_lod_index, run_worker, serve_queue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), max_attempts=2)
+    yield queue
+    queue.close()
+
+
+def test_lease_complete(queue):
+    assert queue.enqueue([{'id': 1, 'updated': 5}, {'id': 2, 'updated': 5}], building_id=7) == 2
+
+    jobs = queue.lease('a', count=5)
+    assert [(job['floor_id'], job['building_id'], job['attempts']) for job in jobs] == [(1, 7, 1), (2, 7, 1)]
+    assert queue.lease('b') == []
+
+    assert queue.complete(1, 'a', seconds=1.0, assets=3)
+    assert not queue.complete(1, 'a')
+    assert queue.counts() == {'done': 1, 'leased': 1}
+
+
+def test_expired_lease_is_handed_over(queue):
+    queue.enqueue([1])
+    queue.lease('a', lease_seconds=-1)
+    assert queue.counts() == {'pending': 1}
+
+    job, = queue.lease('b')
+    assert (job['worker'], job['attempts']) == ('b', 2)
+
+    # The first worker lost the job
+    assert not queue.heartbeat(1, 'a')
+    assert not queue.complete(1, 'a')
+    assert not queue.fail(1, 'a', 'error')
+    assert queue.heartbeat(1, 'b')
+    assert queue.complete(1, 'b')
+
+
+def test_expired_lease_counts_as_attempt(queue):
+    queue.enqueue([1])
+    queue.lease('a', lease_seconds=-1)
+    queue.lease('b', lease_seconds=-1)
+
+    assert queue.lease('c') == []
+    job, = queue.jobs('failed')
+    assert 'lease of b expired' in job['error']
+
+
+def test_retry(queue):
+    queue.enqueue([1])
+
+    queue.lease('a')
+    assert queue.fail(1, 'a', 'first')
+    assert queue.jobs('pending')[0]['error'] == 'first'
+
+    queue.lease('a')
+    assert queue.fail(1, 'a', 'second')
+    assert queue.lease('a') == []
+    assert queue.counts() == {'failed': 1}
+
+    assert queue.retry_failed() == 1
+    job, = queue.lease('a')
+    assert job['attempts'] == 1
+
+
+def test_enqueue_resets_changed_floors(queue):
+    queue.enqueue([{'id': 1, 'updated': 5}, {'id': 2, 'updated': 5}])
+    for job in queue.lease('a', count=2):
+        queue.complete(job['floor_id'], 'a')
+
+    assert queue.enqueue([{'id': 1, 'updated': 5}, {'id': 2, 'updated': 6}]) == 1
+    assert [job['floor_id'] for job in queue.jobs('pending')] == [2]
+
+    # Without a timestamp, a floor is always converted again
+    assert queue.enqueue([1]) == 1
+
+
+def test_enqueue_resets_floors_with_changed_rooms(queue):
+    queue.enqueue([{'id': 1, 'updated': 5, 'roomsUpdated': 7}])
+    job, = queue.lease('a')
+    assert job['rooms_updated'] == 7
+    queue.complete(1, 'a')
+
+    assert queue.enqueue([{'id': 1, 'updated': 5, 'roomsUpdated': 7}]) == 0
+    assert queue.enqueue([{'id': 1, 'updated': 5, 'roomsUpdated': 8}]) == 1
+
+
+def entry(floor_id, lod=0):
+    return {'floor_id': floor_id, 'lod': lod, 'hash': f'hash of {floor_id}'}
+
+
+def test_complete_replaces_the_manifest_entries_of_the_floor(queue):
+    queue.enqueue([1, 2])
+    queue.lease('a', count=2)
+    assert queue.complete(1, 'a', entries={'a.glb': entry(1), 'b.glb': entry(1, 1)})
+    assert queue.complete(2, 'a', entries={'c.glb': entry(2)})
+
+    queue.enqueue([1])
+    queue.lease('b')
+    assert queue.complete(1, 'b', entries={'a.glb': entry(1)})
+    assert queue.manifest_entries(1) == {'a.glb': entry(1)}
+    assert set(queue.manifest_entries()) == {'a.glb', 'c.glb'}
+
+    # A worker that lost the job does not record entries
+    assert not queue.complete(1, 'a', entries={'d.glb': entry(1)})
+    assert queue.manifest_entries(1) == {'a.glb': entry(1)}
+
+    assert queue.remove_floors([2]) == 2
+    assert queue.manifest_entries() == {'a.glb': entry(1)}
+    assert [job['floor_id'] for job in queue.jobs()] == [1]
+
+
+def test_lod_index_is_published_once_drained(queue, tmp_path):
+    sink = LocalSink(str(tmp_path / 'assets'))
+    queue.enqueue([1])
+    assert not publish_lod_index(queue, sink)
+
+    queue.lease('a')
+    assert not publish_lod_index(queue, sink)
+    queue.complete(1, 'a', entries={'a.glb': entry(1), 'b.glb': entry(1, 1)})
+
+    with sink:
+        assert publish_lod_index(queue, sink)
+    assert json.loads(sink.get(converter.LOD_INDEX_PATH)) == {'1': {'0': ['a.glb'], '1': ['b.glb']}}
+
+
+def stored_files(root):
+    return sorted(str(path.relative_to(root)) for path in root.rglob('*.glb'))
+
+
+def test_remote_workers_keep_the_manifest_in_the_queue(env_api, campus, queue, tmp_path):
+    server = serve_queue(queue, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    floor_ids = sorted(campus.floors)
+    queue.enqueue(floor_ids)
+
+    # Two workers as on separate machines, each with its own connection and sink
+    root = tmp_path / 'assets'
+    remotes = [RemoteJobQueue(url) for _ in range(2)]
+    sinks = [LocalSink(str(root)) for _ in range(2)]
+    threads = [threading.Thread(target=run_worker, args=(remote, sink), kwargs={'worker': f'w{i}'})
+               for i, (remote, sink) in enumerate(zip(remotes, sinks))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert queue.counts() == {'done': len(floor_ids)}
+    entries = queue.manifest_entries()
+    assert sorted(entries) == stored_files(root)
+    assert {entry['floor_id'] for entry in entries.values()} == set(floor_ids)
+    # The workers leave the LOD index to the owner of the queue
+    assert not (root / converter.LOD_INDEX_PATH).exists()
+
+    # Converting again skips every asset, as the entries come from the queue
+    shutil.rmtree(root)
+    queue.enqueue(floor_ids)
+    assert run_worker(remotes[0], sinks[0]) == {'done': len(floor_ids), 'failed': 0, 'lost': 0}
+    assert not root.exists() or stored_files(root) == []
+    assert queue.manifest_entries() == entries
+
+    with sinks[0]:
+        assert publish_lod_index(queue, sinks[0])
+    index = json.loads(sinks[0].get(converter.LOD_INDEX_PATH))
+    assert set(index) == {str(floor_id) for floor_id in floor_ids}
+
+    server.shutdown()
+    server.server_close()
+    for remote in remotes:
+        remote.close()
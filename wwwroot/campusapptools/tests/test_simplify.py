@@ -0,0 +1,101 @@
+import copy
+
+import numpy as np
+import pytest
+
+import converter
+from simplify import merge_walls, simplify_floor, simplify_outline
+
+
+def wall(x0, y0, x1, y1, type_name='I10', thickness=0.1, height=3.0, doors=()):
+    return {
+        'startX': x0, 'startY': y0, 'endX': x1, 'endY': y1, 'typeName': type_name, 'typeThickness': thickness,
+        'height': height, 'doorInfos': list(doors), 'windowInfos': [],
+    }
+
+
+def door(x, y):
+    return {'x': x, 'y': y, 'typeWidth': 0.9, 'typeHeight': 2.0, 'typeThreshold': 0.0}
+
+
+def ends(data_walls):
+    return sorted((w['startX'], w['startY'], w['endX'], w['endY']) for w in data_walls)
+
+
+def test_merge_walls():
+    data_walls = [
+        wall(0, 0, 2, 0),
+        wall(4, 0, 2, 1e-4, doors=[door(3, 0)]), # reversed, rounding noise at the joint
+        wall(3.5, 0, 5, 0), # overlaps the previous segment
+        wall(7, 0, 9, 0), # gap of 2 m
+        wall(9, 0, 10, 0, type_name='E30'), # other type
+        wall(0, 1, 5, 1), # parallel line
+        wall(1, 1, 1, 1), # zero length
+    ]
+    merged = merge_walls(data_walls)
+
+    assert ends(merged) == [(0, 0, 5, 0), (0, 1, 5, 1), (1, 1, 1, 1), (7, 0, 9, 0), (9, 0, 10, 0)]
+    assert next(w for w in merged if w['startX'] == 0 and w['startY'] == 0)['doorInfos'] == [door(3, 0)]
+
+
+def test_merge_walls_keeps_direction_and_input():
+    data_walls = [wall(5, 0, 3, 0), wall(3, 0, 0, 0)]
+    before = copy.deepcopy(data_walls)
+
+    assert ends(merge_walls(data_walls)) == [(5, 0, 0, 0)]
+    assert data_walls == before
+
+
+@pytest.mark.parametrize('angle', [0.0, 0.7, np.pi / 2, 3.0])
+def test_merged_walls_have_the_same_volume(angle):
+    # Touching segments of a rotated line: the merged box covers exactly the segments
+    direction = np.array([np.cos(angle), np.sin(angle)])
+    points = [direction * t for t in (0.0, 1.5, 2.0, 4.25)]
+    data_walls = [wall(*a, *b) for a, b in zip(points[:-1], points[1:])]
+
+    merged = merge_walls(data_walls)
+    assert len(merged) == 1
+
+    volume = converter.build_wall_meshes(merged)[0].volume
+    assert volume == pytest.approx(converter.build_wall_meshes(data_walls)[0].volume)
+    assert volume == pytest.approx(4.25 * 0.1 * 3.2)
+
+
+def outline(points):
+    return {'id': 1, 'name': 'room', 'outline': {'coords': [{'x': x, 'y': y} for x, y in points]}}
+
+
+def coords(room):
+    return [(v['x'], v['y']) for v in room['outline']['coords']]
+
+
+def test_simplify_outline():
+    room = outline([(0, 0), (2, 0), (4, 0.001), (4, 3), (2, 3.01), (0, 3)])
+    simplified = simplify_outline(room)
+
+    # (4, 0.001) is within 5 mm of the simplified edge, (2, 3.01) is not
+    assert sorted(coords(simplified)) == [(0, 0), (0, 3), (2, 3.01), (4, 0.001), (4, 3)]
+    assert simplified['name'] == 'room' and len(coords(room)) == 6
+
+
+@pytest.mark.parametrize('points', [
+    [(0, 0), (4, 0), (0, 3)], # nothing to remove
+    [(0, 0), (4, 3), (4, 0), (0, 3)], # self-intersecting
+])
+def test_simplify_outline_unchanged(points):
+    room = outline(points)
+    assert simplify_outline(room) is room
+
+
+def test_simplify_floor(campus):
+    floor_id, data_floor = next(iter(campus.floor_infos.items()))
+    data_outlines = [room for room in campus.workspaces.values() if room['floorId'] == floor_id]
+    before = copy.deepcopy((data_floor, data_outlines))
+
+    simplified_floor, simplified_outlines = simplify_floor(data_floor, data_outlines)
+
+    assert (data_floor, data_outlines) == before
+    assert len(simplified_floor['wallInfos']) <= len(data_floor['wallInfos'])
+    doors = sorted((d['x'], d['y']) for w in data_floor['wallInfos'] for d in w['doorInfos'])
+    assert sorted((d['x'], d['y']) for w in simplified_floor['wallInfos'] for d in w['doorInfos']) == doors
+    assert simplify_floor(data_floor, None)[1] is None
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+
+import pytest
+
+import build_db
+from api_requests import API_Requests
+from standin_server import FixtureCampus, fixture_filename, record_fixtures, serve_in_thread
+from sync_planner import plan_sync
+
+
+@pytest.fixture
+def fixtures(api, campus, tmp_path):
+    '''Records two of the three buildings of the campus and serves them from the fixtures.'''
+    fixtures_dir = str(tmp_path / 'fixtures')
+    building_ids = sorted(campus.buildings)[:2]
+    record_fixtures(fixtures_dir, building_ids, api)
+
+    server, url = serve_in_thread(campus=FixtureCampus(fixtures_dir))
+    yield API_Requests(api_url=url, max_retries=0), building_ids
+    server.shutdown()
+    server.server_close()
+
+
+def count(snapshot, table):
+    with sqlite3.connect(snapshot) as conn:
+        return conn.execute(f'select count(*) from {table}').fetchone()[0]
+
+
+def test_fixture_filename_ignores_parameter_order(tmp_path):
+    a = fixture_filename(str(tmp_path), 'floor/info', {'floorIds[]': ['1', '2'], 'x': ['']})
+    b = fixture_filename(str(tmp_path), '/floor/info/', {'x': [''], 'floorIds[]': ['2', '1']})
+    assert a == b
+    assert a != fixture_filename(str(tmp_path), 'floor/info', {'floorIds[]': ['1']})
+    assert fixture_filename(str(tmp_path), 'floor/info', {}) == os.path.join(str(tmp_path), 'floor', 'info.json')
+
+
+def test_replay_build_db_and_plan_sync(fixtures, campus, tmp_path):
+    replay, building_ids = fixtures
+    floor_ids = {floor_id for floor_id, floor in campus.floors.items() if floor['buildingId'] in building_ids}
+    room_ids = {room_id for room_id, room in campus.workspaces.items() if room['floorId'] in floor_ids}
+
+    path = str(tmp_path / 'spaces.db')
+    build_db.full_sync(replay, path, fetch_workers=2)
+
+    snapshot = build_db.current_snapshot(path)
+    assert count(snapshot, 'buildings') == len(building_ids)
+    assert count(snapshot, 'floors') == len(floor_ids)
+    assert count(snapshot, 'rooms') == len(room_ids)
+
+    # Replaying the same responses again finds nothing to do
+    with sqlite3.connect(snapshot) as conn:
+        assert plan_sync(replay, conn).is_empty()
+
+
+def test_replay_keys_by_query(fixtures, campus):
+    replay, building_ids = fixtures
+    floor_ids = sorted(floor_id for floor_id, floor in campus.floors.items() if floor['buildingId'] in building_ids)
+
+    for floor_id in floor_ids:
+        assert replay.get_floor_info([floor_id]) == [campus.floor_infos[floor_id]]
+
+    # A request with parameters that were not recorded is not answered with another recording
+    with pytest.raises(AssertionError):
+        replay.get_floor_info([floor_ids[0], floor_ids[-1]])
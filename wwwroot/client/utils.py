@@ -2,11 +2,19 @@ import requests
 import time
 import json
 import ast
+import struct
+import hashlib
 
 
 base_url = 'https://campusmap-dev-campusmap.to1azure.imperialapp.io'
 blobstore_url = 'https://campusmaps.blob.core.windows.net/assets'
 
+# Bundles of all assets of a building, see campusapptools/asset_bundle.py for the layout. The client does not ship
+# campusapptools, so the layout is repeated here; campusapptools/tests/test_asset_bundle.py checks that they match.
+BUNDLE_PREFIX = struct.Struct('<4sII') # magic, version, index size
+BUNDLE_MAGIC = b'CMAB'
+INDEX_PREFETCH = 64 * 1024 # the first request for the index also returns the assets in the first 64 KB
+
 def update_assets():
     with open('assets/versions.json', 'r') as f:
         versions = json.load(f)
@@ -94,6 +102,80 @@ def _save_assets(ids):
 
 
 
+def get_building_bundle(building_id, lods=None, floor_ids=None):
+    '''Downloads the assets of a building from its bundle.
+
+    Without filters, the whole bundle is downloaded in one request. Otherwise the index is read first and only the
+    matching assets are downloaded with HTTP range requests, one per contiguous run of assets (assets of the same level
+    of detail are stored next to each other).
+
+    Args:
+        building_id (int): ID of the building.
+        lods (list, optional): Only download assets of these levels of detail (0 is full detail).
+        floor_ids (list, optional): Only download assets of these floors.
+
+    Returns:
+        dict: The glb files by their path, e.g. {'model_floors/floor_930_floors.glb': b'...'}.
+    '''
+    url = f"{blobstore_url}/bundles/building_{building_id}.bundle"
+
+    if lods is None and floor_ids is None:
+        r = requests.get(url)
+        assert r.status_code == 200
+        index = _read_bundle_index(r.content)
+        return {entry['path']: _bundle_asset(r.content, 0, entry) for entry in index['entries']}
+
+    head = _get_range(url, 0, INDEX_PREFETCH)
+    index_end = BUNDLE_PREFIX.size + BUNDLE_PREFIX.unpack(head[:BUNDLE_PREFIX.size])[2]
+    if len(head) < index_end:
+        head += _get_range(url, len(head), index_end)
+    index = _read_bundle_index(head)
+
+    entries = [entry for entry in index['entries']
+               if (lods is None or entry['lod'] in lods) and (floor_ids is None or entry['floor_id'] in floor_ids)]
+
+    # Merges assets that are next to each other in the bundle (up to the 8 byte alignment) into one range
+    spans = []
+    for entry in sorted(entries, key=lambda entry: entry['offset']):
+        end = entry['offset'] + entry['length']
+        if len(spans) > 0 and entry['offset'] - spans[-1][1] < 8:
+            spans[-1][1] = end
+            spans[-1][2].append(entry)
+        else:
+            spans.append([entry['offset'], end, [entry]])
+
+    assets = {}
+    for start, end, span_entries in spans:
+        data = head[start:end] if end <= len(head) else _get_range(url, start, end)
+        for entry in span_entries:
+            assets[entry['path']] = _bundle_asset(data, start, entry)
+
+    return assets
+
+
+def _get_range(url, start, end):
+    r = requests.get(url, headers={'Range': f'bytes={start}-{end - 1}'})
+    assert r.status_code in (200, 206)
+
+    # A server that does not support ranges sends the whole file
+    return r.content[start:end] if r.status_code == 200 else r.content
+
+
+def _read_bundle_index(data):
+    magic, version, size = BUNDLE_PREFIX.unpack(data[:BUNDLE_PREFIX.size])
+    assert magic == BUNDLE_MAGIC, 'not an asset bundle'
+
+    return json.loads(data[BUNDLE_PREFIX.size:BUNDLE_PREFIX.size + size])
+
+
+def _bundle_asset(data, data_offset, entry):
+    start = entry['offset'] - data_offset
+    asset = data[start:start + entry['length']]
+    assert hashlib.sha256(asset).hexdigest() == entry['sha256'], f"corrupt asset {entry['path']}"
+
+    return asset
+
+
 if __name__ == '__main__':
     start = time.time()
     #assets = get_building_assets(202)
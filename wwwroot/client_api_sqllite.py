@@ -1,10 +1,12 @@
 import os
 import json
 from functools import wraps
+from urllib.request import pathname2url
 
 from flask import Flask, request, abort
 import logging
 import sqlite3
+import numpy as np
 
 app = Flask(__name__)  
 API_KEY = '12345'
@@ -22,8 +24,48 @@ def require_api_key(view_function):
     return decorated_function
 
 
+# build_db.py publishes snapshots of the database by replacing this file, which names the current one
+pointer_path = f'{db_path}.current'
+
+# (stat of the pointer file, snapshot it names), replaced as a whole so concurrent requests never see a mixed pair
+_current = (None, db_path)
+
+
+def current_db_path():
+    '''Returns the current snapshot of the database, reading the pointer file again only when it was replaced.'''
+    global _current
+
+    try:
+        stat = os.stat(pointer_path)
+    except FileNotFoundError:
+        return db_path # Database written before snapshots
+
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _current[0] != key:
+        with open(pointer_path, 'r') as f:
+            _current = (key, os.path.join(os.path.dirname(db_path), f.read().strip()))
+
+    return _current[1]
+
+
 def get_db_conn():
-    return sqlite3.connect(db_path)
+    # Read-only, so a missing snapshot is an error instead of a new empty database. Requests that already opened the
+    # previous snapshot finish on it.
+    return sqlite3.connect(f'file:{pathname2url(current_db_path())}?mode=ro', uri=True)
+
+
+def decode_outline(blob: bytes) -> list:
+    '''Unpacks a room outline stored by build_db.py (little-endian float32 x0, y0, x1, y1, ...) into [[x, y], ...].'''
+    if not blob:
+        return []
+    # Rounded to what float32 can hold at campus scale, so the JSON does not show float32 noise
+    return np.frombuffer(blob, dtype='<f4').reshape(-1, 2).astype(np.float64).round(4).tolist()
+
+
+def room_record(row: sqlite3.Row) -> dict:
+    room = dict(row)
+    room['outline'] = decode_outline(room['outline'])
+    return room
 
 
 @app.route('/buildings', methods=['GET'])
@@ -145,7 +187,7 @@ def rooms():
     ans = cur.fetchall()
     rooms = []
     for row in ans:
-        rooms.append(dict(row))
+        rooms.append(room_record(row))
 
     cur.close()
     conn.close()
@@ -153,6 +195,21 @@ def rooms():
     return rooms 
 
 
+@app.route('/floors/<int:id>/rooms')
+def floors_id_rooms(id):
+    conn = get_db_conn()
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("select * from rooms where floor_id=?", (id,))
+
+    rooms = [room_record(row) for row in cur.fetchall()]
+
+    cur.close()
+    conn.close()
+
+    return rooms
+
+
 @app.route('/rooms/<int:id>/')
 def rooms_id(id):
     conn = get_db_conn()
@@ -161,7 +218,7 @@ def rooms_id(id):
     cur.execute("select * from rooms where room_id=?", (id,))
 
     ans = cur.fetchone()
-    room = dict(ans)
+    room = room_record(ans)
 
     cur.close()
     conn.close()